@@ -20,6 +20,7 @@ import argparse
 import sys
 sys.path.append("../modules")
 from Server.database import Database
+from Server.shardedDatabase import ShardedDatabase
 from Server.Lock.readWriteLock import ReadWriteLock
 
 # -----------------------------------------------------------------------------
@@ -43,6 +44,16 @@ parser.add_argument(
     "-f", "--file", metavar="FILE", dest="file", default="dbs/fortune.db",
     help="Set the database file. Default: dbs/fortune.db."
 )
+parser.add_argument(
+    "-s", "--shards", metavar="SHARDS", dest="shards", type=int, default=1,
+    help="Spread the database over this many shard files. The database "
+         "file is split on the first start. Default: 1 (no sharding)."
+)
+parser.add_argument(
+    "--watch", metavar="SECONDS", dest="watch", type=float, default=0,
+    help="Poll the database file every SECONDS for fortunes appended by "
+         "other processes. Default: 0 (do not watch)."
+)
 opts = parser.parse_args()
 
 db_file = opts.file
@@ -57,30 +68,24 @@ class Server(object):
 
     """Class that provides synchronous access to the database."""
 
-    def __init__(self, db_file):
-        self.db = Database(db_file)
+    def __init__(self, db_file, shards=1):
+        self.sharded = shards > 1
+        if self.sharded:
+            self.db = ShardedDatabase(db_file, shards)
+        else:
+            self.db = Database(db_file)
         self.rwlock = ReadWriteLock()
 
     # Public methods
 
     def read(self):
-        #
-        # Your code here.
-        #
-        # Remember the rule:
-        # 1. Open the lock
-        # 2. Perform action
-        # 3. Close the lock
-        # We do this so that if after opening the lock,
-        # the database can crash while performing the action
-        # So even if that happens, the lock should always be placed at the end
-        # Hence the 'finally' 
-        try:
-            self.rwlock.read_acquire()
-            fortune = self.db.read()
-        finally:
-            self.rwlock.read_release()
-        return fortune
+        # The database publishes immutable snapshots, so readers get a
+        # consistent view without taking the lock and never wait for
+        # writers to finish.
+        return self.db.read()
+
+    def read_at(self, version):
+        return self.db.read_at(version)
 
     def write(self, fortune):
         #
@@ -94,6 +99,11 @@ class Server(object):
         # the database can crash while performing the action
         # So even if that happens, the lock should always be placed at the end
         # Hence the 'finally' 
+        if self.sharded:
+            # Every shard locks its own writes: writes to different
+            # shards must not wait for each other.
+            self.db.write(fortune)
+            return
         try:
             self.rwlock.write_acquire()
             self.db.write(fortune)
@@ -154,7 +164,13 @@ class Request(threading.Thread):
                 # Run this to test the exception handling
                 # print(1/0)
                 return response
-                
+
+            # Read as of a given database version
+            elif requestFromClient.get("method") == "read_at":
+                version = requestFromClient.get("args")
+                fortune = self.db_server.read_at(version)
+                response = json.dumps({"result": fortune})
+                return response
 
             # Call the write function and return the result
             elif requestFromClient.get("method") == "write":
@@ -200,7 +216,9 @@ print("Listening to: {}:{}".format(socket.getfqdn(), opts.port))
 with open("srv_address.tmp", "w") as f:
     f.write("{}:{}\n".format(socket.getfqdn(), opts.port))
 
-sync_db = Server(db_file)
+sync_db = Server(db_file, opts.shards)
+if opts.watch > 0:
+    sync_db.db.watch(opts.watch)
 
 server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 server.bind(server_address)
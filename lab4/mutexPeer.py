@@ -22,7 +22,9 @@ from Common.nameServiceLocation import name_service_address
 from Common.objectType import object_type
 
 from Server.peerList import PeerList
-from Server.Lock.distributedLock import DistributedLock
+from Server.Lock.mutexAlgorithms import ALGORITHMS, create_lock
+from Server.Lock.distributedLock import RING_ROUTING, LATENCY_ROUTING
+from Server.Lock.lockManager import LockManager
 
 # -----------------------------------------------------------------------------
 # Initialize and read the command line arguments
@@ -42,6 +44,28 @@ parser.add_argument(
     "-t", "--type", metavar="TYPE", dest="type", default=object_type,
     help="Set the type of the client."
 )
+parser.add_argument(
+    "-a", "--algorithm", metavar="ALGORITHM", dest="algorithm",
+    default="ricart-agrawala", choices=sorted(ALGORITHMS.keys()),
+    help="Set the mutual exclusion algorithm, one of: {}. "
+         "Default: ricart-agrawala.".format(", ".join(sorted(ALGORITHMS)))
+)
+parser.add_argument(
+    "--delta-tokens", dest="delta_tokens", action="store_true",
+    help="Send only the token entries the next holder has not seen."
+)
+parser.add_argument(
+    "--routing", metavar="ROUTING", dest="routing", default=RING_ROUTING,
+    choices=[RING_ROUTING, LATENCY_ROUTING],
+    help="Choose the next token holder by ring order of the ids (ring) or "
+         "by round trip time (latency). Default: ring."
+)
+parser.add_argument(
+    "--fairness-window", metavar="SECONDS", dest="fairness_window",
+    type=float, default=0.05,
+    help="With latency routing, a request can only be overtaken by "
+         "requests made at most SECONDS later. Default: 0.05."
+)
 opts = parser.parse_args()
 
 local_port = opts.port
@@ -57,18 +81,42 @@ class Client(orb.Peer):
 
     """Distributed mutual exclusion client class."""
 
-    def __init__(self, local_address, ns_address, client_type):
+    def __init__(self, local_address, ns_address, client_type,
+                 algorithm="ricart-agrawala", delta_tokens=False,
+                 routing=RING_ROUTING, fairness_window=0.05):
         """Initialize the client."""
         orb.Peer.__init__(self, local_address, ns_address, client_type)
         self.peer_list = PeerList(self)
-        self.distributed_lock = DistributedLock(self, self.peer_list)
+        self.distributed_lock = create_lock(algorithm, self, self.peer_list,
+                                            delta_tokens=delta_tokens,
+                                            routing=routing,
+                                            fairness_window=fairness_window)
+        self.lock_manager = LockManager(self, self.peer_list)
         self.dispatched_calls = {
             "display_peers":      self.peer_list.display_peers,
             "acquire":            self.distributed_lock.acquire,
+            "try_acquire":        self.distributed_lock.try_acquire,
             "release":            self.distributed_lock.release,
             "request_token":      self.distributed_lock.request_token,
             "obtain_token":       self.distributed_lock.obtain_token,
-            "display_status":     self.distributed_lock.display_status
+            "withdraw_request":   self.distributed_lock.withdraw_request,
+            "redirect":           self.distributed_lock.redirect,
+            "probe_token":        self.distributed_lock.probe_token,
+            "regenerate_token":   self.distributed_lock.regenerate_token,
+            "rtt_row":            self.distributed_lock.rtt_row,
+            "rtt_matrix":         self.distributed_lock.rtt_matrix,
+            "display_status":     self.distributed_lock.display_status,
+            "lock_stats":         self.distributed_lock.lock_stats,
+            "acquire_named":      self.lock_manager.acquire,
+            "release_named":      self.lock_manager.release,
+            "request_named_token": self.lock_manager.request_named_token,
+            "obtain_named_token": self.lock_manager.obtain_named_token,
+            "withdraw_named_request":
+                self.lock_manager.withdraw_named_request,
+            "probe_named_token":  self.lock_manager.probe_named_token,
+            "regenerate_named_token":
+                self.lock_manager.regenerate_named_token,
+            "display_named":      self.lock_manager.display_status
         }
         orb.Peer.start(self)
         self.peer_list.initialize()
@@ -79,6 +127,7 @@ class Client(orb.Peer):
     def destroy(self):
         orb.Peer.destroy(self)
         self.distributed_lock.destroy()
+        self.lock_manager.destroy()
         self.peer_list.destroy()
 
     def __getattr__(self, attr):
@@ -92,10 +141,12 @@ class Client(orb.Peer):
     def register_peer(self, pid, paddr):
         self.peer_list.register_peer(pid, paddr)
         self.distributed_lock.register_peer(pid)
+        self.lock_manager.register_peer(pid)
 
     def unregister_peer(self, pid):
         self.peer_list.unregister_peer(pid)
         self.distributed_lock.unregister_peer(pid)
+        self.lock_manager.unregister_peer(pid)
 
 # -----------------------------------------------------------------------------
 # The main program
@@ -103,7 +154,8 @@ class Client(orb.Peer):
 
 # Initialize the client object.
 local_address = (socket.getfqdn(), local_port)
-p = Client(local_address, name_service_address, client_type)
+p = Client(local_address, name_service_address, client_type, opts.algorithm,
+           opts.delta_tokens, opts.routing, opts.fairness_window)
 
 
 def menu():
@@ -113,6 +165,9 @@ Choose one of the following commands:
     s  ::  display status,
     a  ::  acquire the lock,
     r  ::  release the lock,
+    n  ::  display the status of the named locks,
+    a NAME  ::  acquire the lock called NAME,
+    r NAME  ::  release the lock called NAME,
     h  ::  print this menu,
     q  ::  exit.\
 """)
@@ -134,6 +189,12 @@ while command != "q":
         elif command == "r":
             p.release()
             cursor = "{}({}):{}> ".format(p.type, p.id, "RELEASED")
+        elif command == "n":
+            p.display_named()
+        elif command.startswith("a "):
+            p.acquire_named(command[2:].strip())
+        elif command.startswith("r "):
+            p.release_named(command[2:].strip())
         elif command == "h":
             menu()
     except KeyboardInterrupt:
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+# -----------------------------------------------------------------------------
+# Distributed Systems (TDDD25)
+# -----------------------------------------------------------------------------
+# Author: Sergiu Rafiliu (sergiu.rafiliu@liu.se)
+# Modified: 31 July 2013
+#
+# Copyright 2012 Linkoping University
+# -----------------------------------------------------------------------------
+
+"""Benchmark of the write fan-out of serverPeer.py.
+
+Starts a number of replicas in this process, each listening on its own
+local port (no name service is needed), and times the write of one
+fortune to all of them: one replica after the other, as serverPeer.py
+used to do, and in parallel through a FanOut.
+
+"""
+
+import sys
+import time
+import argparse
+
+sys.path.append("../modules")
+from Common import orb
+from Server.replication import FanOut
+
+# -----------------------------------------------------------------------------
+# Initialize and read the command line arguments
+# -----------------------------------------------------------------------------
+
+description = """Benchmark of the write fan-out to the replicas."""
+parser = argparse.ArgumentParser(description=description)
+parser.add_argument(
+    "-r", "--replicas", metavar="N", dest="replicas", type=int, nargs="+",
+    default=[2, 8, 32],
+    help="Numbers of replicas to measure. Default: 2 8 32."
+)
+parser.add_argument(
+    "-d", "--delay", metavar="SECONDS", dest="delay", type=float,
+    default=0.005,
+    help="Time each replica takes to write a fortune. Default: 0.005."
+)
+parser.add_argument(
+    "-n", "--writes", metavar="WRITES", dest="writes", type=int, default=20,
+    help="Number of writes to average over. Default: 20."
+)
+parser.add_argument(
+    "-w", "--workers", metavar="WORKERS", dest="workers", type=int,
+    default=16,
+    help="Size of the fan-out pool. Default: 16."
+)
+opts = parser.parse_args()
+
+# -----------------------------------------------------------------------------
+# Auxiliary classes
+# -----------------------------------------------------------------------------
+
+
+class Replica(object):
+
+    """Stand-in for a server peer, it only pretends to write."""
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.skeleton = orb.Skeleton(self, ("", 0))
+        self.address = ("localhost", self.skeleton.server.getsockname()[1])
+        self.skeleton.start()
+
+    def write_local(self, fortune):
+        time.sleep(self.delay)
+
+# -----------------------------------------------------------------------------
+# The main program
+# -----------------------------------------------------------------------------
+
+replicas = []
+fan_out = FanOut(max_workers=opts.workers)
+
+print("{:>9}  {:>15}  {:>13}  {:>7}".format(
+    "replicas", "sequential (ms)", "parallel (ms)", "speedup"))
+for n in opts.replicas:
+    while len(replicas) < n:
+        replicas.append(Replica(opts.delay))
+    addresses = dict((pid, replica.address)
+                     for pid, replica in enumerate(replicas[:n]))
+
+    start = time.time()
+    for i in range(opts.writes):
+        for pid, address in addresses.items():
+            orb.Stub(address).write_local("fortune")
+    sequential = (time.time() - start) / opts.writes
+
+    start = time.time()
+    for i in range(opts.writes):
+        result = fan_out.call(addresses, "write_local", "fortune")
+        if not result.ok():
+            print("Failed replicas: {}".format(result.errors()))
+    parallel = (time.time() - start) / opts.writes
+
+    print("{:>9}  {:>15.2f}  {:>13.2f}  {:>6.1f}x".format(
+        n, sequential * 1000, parallel * 1000, sequential / parallel))
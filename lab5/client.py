@@ -9,15 +9,27 @@
 # Copyright 2012 Linkoping University
 # -----------------------------------------------------------------------------
 
-"""Client reader/writer for a fortune database."""
+"""Client reader/writer for a fortune database.
+
+Unless a particular server is asked for, every call goes to one of the
+replicas, chosen by their latency and load (see
+Common/replicaSelector.py), and to another one if it fails. With
+--hedge-percentile, a slow read is also sent to a second replica (see
+Common/hedging.py).
+
+"""
 
 import sys
+import time
 import argparse
+import threading
 
 sys.path.append("../modules")
 from Common import orb
 from Common.nameServiceLocation import name_service_address
 from Common.objectType import object_type
+from Common.replicaSelector import ReplicaSelector
+from Common.hedging import Hedger
 
 # -----------------------------------------------------------------------------
 # Initialize and read the command line arguments
@@ -44,6 +56,28 @@ parser.add_argument(
     "-p", "--peer", metavar="PEER_ID", dest="peer_id", type=int,
     help="The identifier of a particular server peer."
 )
+parser.add_argument(
+    "-b", "--benchmark", metavar="READS", dest="benchmark", type=int,
+    help="Time READS reads sent to a single server, then spread over the "
+         "replicas, and print the latency percentiles."
+)
+parser.add_argument(
+    "-c", "--concurrency", metavar="THREADS", dest="concurrency", type=int,
+    default=8,
+    help="Number of concurrent readers in the benchmark. Default: 8."
+)
+parser.add_argument(
+    "--hedge-percentile", metavar="P", dest="hedge_percentile", type=float,
+    default=0,
+    help="Send a read to a second replica as well when it has taken longer "
+         "than the P-th percentile of the recent reads. Default: 0 (no "
+         "hedging)."
+)
+parser.add_argument(
+    "--hedge-rate", metavar="FRACTION", dest="hedge_rate", type=float,
+    default=0.1,
+    help="Hedge at most FRACTION of the reads. Default: 0.1."
+)
 opts = parser.parse_args()
 
 server_type = opts.type
@@ -57,21 +91,90 @@ assert server_type != "object", "Change the object type to something unique!"
 # Connect to the name service to obtain the address of the server.
 ns = orb.Stub(name_service_address)
 
-if server_id is None:
-    server_address = tuple(ns.require_any(server_type))
-else:
-    server_address = tuple(ns.require_object(server_type, server_id))
 
-print("Connecting to server: {}".format(server_address))
+def replicas():
+    return dict((pid, tuple(address))
+                for pid, address in ns.require_all(server_type))
 
-# Create the database object.
-db = orb.Stub(server_address)
 
-if not opts.interactive:
+def selector():
+    hedger = None
+    if opts.hedge_percentile > 0:
+        hedger = Hedger(opts.hedge_percentile, opts.hedge_rate)
+    return ReplicaSelector(replicas(), replicas, hedger=hedger)
+
+if server_id is None:
+    # Create the database object.
+    db = selector()
+    print("Connecting to the replicas: {}".format(
+        sorted(db.replicas.items())))
+else:
+    server_address = tuple(ns.require_object(server_type, server_id))
+    print("Connecting to server: {}".format(server_address))
+    # Create the database object.
+    db = orb.Stub(server_address)
+
+
+def write(fortune):
+    """Write a fortune, the server may be too busy to do it."""
+    try:
+        db.write(fortune)
+    except BaseException as e:
+        # Errors are rebuilt by name on this side of the connection.
+        if type(e).__name__ != "LockTimeout":
+            raise
+        print("The database is busy, try again later.")
+
+
+def benchmark(db, reads, concurrency):
+    """Return the sorted latencies of 'reads' reads."""
+    latencies = []
+    lock = threading.Lock()
+
+    def reader(n):
+        for i in range(n):
+            start = time.time()
+            db.read()
+            with lock:
+                latencies.append(time.time() - start)
+    threads = [threading.Thread(target=reader,
+                                args=(reads // concurrency,))
+               for i in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return sorted(latencies)
+
+if opts.benchmark:
+    # Compare with pinning all the calls to one server.
+    pinned = orb.Stub(tuple(ns.require_any(server_type)))
+    targets = [("pinned", pinned), ("selected", ReplicaSelector(replicas()))]
+    if server_id is None and db.hedger is not None:
+        targets.append(("hedged", db))
+    print("{:>9}  {:>8}  {:>8}  {:>8}  {:>8}".format(
+        "(ms)", "p50", "p90", "p99", "max"))
+    p99 = {}
+    for name, target in targets:
+        latencies = benchmark(target, opts.benchmark, opts.concurrency)
+        p99[name] = latencies[int(0.99 * (len(latencies) - 1))]
+        print("{:>9}  {:>8.2f}  {:>8.2f}  {:>8.2f}  {:>8.2f}".format(
+            name, *[latencies[int(q * (len(latencies) - 1))] * 1000
+                    for q in (0.5, 0.9, 0.99, 1.0)]))
+    for pid, stats in sorted(targets[-1][1].stats().items()):
+        print("Replica {}: {}".format(pid, stats))
+    if "hedged" in p99:
+        stats = db.hedger.stats()
+        print("Hedged {:.1%} of the reads (won {}), after {:.2f} ms; "
+              "p99 {:+.1%} against no hedging.".format(
+                  stats["hedge_rate"], stats["hedge_wins"], stats["delay_ms"],
+                  p99["hedged"] / p99["selected"] - 1))
+
+elif not opts.interactive:
     # Run in the normal mode.
     if opts.fortune is not None:
         print("Writing '{}' to the fortune database.".format(opts.fortune))
-        db.write(opts.fortune)
+        write(opts.fortune)
     else:
         print(db.read())
 
@@ -95,6 +198,6 @@ Choose one of the following commands:
             print(db.read())
         elif (len(command) > 1 and command[0] == "w" and
                 command[1] in [" ", "\t"]):
-            db.write(command[2:].strip())
+            write(command[2:].strip())
         elif command == "h":
             menu()
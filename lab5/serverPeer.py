@@ -13,7 +13,22 @@
 a database.
 
 This server is one in a group of servers that all replicate the same
-data, so they implement 'read any write all' protocol.
+data, so they implement 'read any write all' protocol. Alternatively
+(--replication quorum), writes need W acknowledgements and reads consult
+R replicas, see Server/quorumReplication.py. With --replication
+primary-backup a primary sequences the writes and ships them to the
+others, see Server/primaryBackup.py. With --replication partitioned
+each server only stores the fortunes a consistent-hash ring gives it,
+see Server/consistentHash.py.
+
+In write-all mode the replicas also compare Merkle trees of their
+databases in the background and exchange the fortunes one of them has
+missed (e.g. while it was down), see Server/antiEntropy.py.
+
+A new replica started with --bootstrap HOST:PORT first downloads a
+snapshot of the database of the replica at that address and replays the
+writes made since, see Server/snapshot.py. It serves reads only once it
+has caught up.
 
 """
 
@@ -21,6 +36,7 @@ import sys
 import random
 import socket
 import argparse
+import threading
 
 sys.path.append("../modules")
 from Common import orb
@@ -28,9 +44,24 @@ from Common.nameServiceLocation import name_service_address
 from Common.objectType import object_type
 
 from Server import database
+from Server.shardedDatabase import ShardedDatabase, shard_file_names
+from Server.replication import FanOut, WriteBatcher
+from Server.quorumReplication import QuorumReplica
+from Server.primaryBackup import PrimaryBackup
+from Server.antiEntropy import MerkleTree, AntiEntropy
+from Server import snapshot
+from Server.consistentHash import Partitioning
+from Common.hedging import Hedger
 from Server.peerList import PeerList
-from Server.Lock.distributedLock import DistributedLock
-from Server.Lock.distributedReadWriteLock import DistributedReadWriteLock
+from Server.Lock.mutexAlgorithms import ALGORITHMS, create_lock
+from Server.Lock.lockManager import LockManager
+from Server.Lock.distributedReadWriteLock import (DistributedReadWriteLock,
+                                                  LockTimeout)
+
+WRITE_ALL = "write-all"
+QUORUM = "quorum"
+PRIMARY_BACKUP = "primary-backup"
+PARTITIONED = "partitioned"
 
 # -----------------------------------------------------------------------------
 # Initialize and read the command line arguments
@@ -50,10 +81,126 @@ parser.add_argument(
     "-t", "--type", metavar="TYPE", dest="type", default=object_type,
     help="Set the type of the client."
 )
+parser.add_argument(
+    "-a", "--algorithm", metavar="ALGORITHM", dest="algorithm",
+    default="ricart-agrawala", choices=sorted(ALGORITHMS.keys()),
+    help="Set the mutual exclusion algorithm, one of: {}. "
+         "Default: ricart-agrawala.".format(", ".join(sorted(ALGORITHMS)))
+)
 parser.add_argument(
     "-f", "--file", metavar="FILE", dest="file", default="dbs/fortune.db",
     help="Set the database file. Default: dbs/fortune.db."
 )
+parser.add_argument(
+    "-s", "--shards", metavar="SHARDS", dest="shards", type=int, default=1,
+    help="Spread the database over this many shard files. The database "
+         "file is split on the first start. Default: 1 (no sharding)."
+)
+parser.add_argument(
+    "--watch", metavar="SECONDS", dest="watch", type=float, default=0,
+    help="Poll the database file every SECONDS for fortunes appended by "
+         "other processes. Default: 0 (do not watch)."
+)
+parser.add_argument(
+    "--lease-writes", metavar="WRITES", dest="lease_writes", type=int,
+    default=1,
+    help="Keep the distributed lock for up to WRITES consecutive local "
+         "writes while no other server waits for it. Default: 1 (no lease)."
+)
+parser.add_argument(
+    "--lease-time", metavar="SECONDS", dest="lease_time", type=float,
+    default=0.1,
+    help="Maximum time to keep the distributed lock leased. Default: 0.1."
+)
+parser.add_argument(
+    "--write-timeout", metavar="SECONDS", dest="write_timeout", type=float,
+    default=10.0,
+    help="Give up a write (the client gets a LockTimeout error) if the "
+         "distributed lock cannot be obtained within SECONDS. 0 means "
+         "wait forever. Default: 10."
+)
+parser.add_argument(
+    "--fan-out", metavar="WORKERS", dest="fan_out", type=int, default=16,
+    help="Write to at most WORKERS replicas at the same time. Default: 16."
+)
+parser.add_argument(
+    "--replica-timeout", metavar="SECONDS", dest="replica_timeout",
+    type=float, default=5.0,
+    help="Report a replica as failed if it has not written a fortune "
+         "within SECONDS. Default: 5."
+)
+parser.add_argument(
+    "--batch-size", metavar="WRITES", dest="batch_size", type=int,
+    default=64,
+    help="Send the writes to each replica in batches of at most WRITES "
+         "fortunes. Default: 64."
+)
+parser.add_argument(
+    "--batch-delay", metavar="SECONDS", dest="batch_delay", type=float,
+    default=0.002,
+    help="Send a batch once its oldest write has waited SECONDS, even if "
+         "it is not full. Default: 0.002."
+)
+parser.add_argument(
+    "--anti-entropy", metavar="SECONDS", dest="anti_entropy", type=float,
+    default=10.0,
+    help="Synchronize with a random replica about every SECONDS, in "
+         "write-all mode. Default: 10. 0 disables it."
+)
+parser.add_argument(
+    "--bootstrap", metavar="HOST:PORT", dest="bootstrap", default=None,
+    help="Start from a snapshot of the database of the replica listening "
+         "at HOST:PORT, instead of the local database file."
+)
+parser.add_argument(
+    "--replication", metavar="MODE", dest="replication", default=WRITE_ALL,
+    choices=[WRITE_ALL, QUORUM, PRIMARY_BACKUP, PARTITIONED],
+    help="Replication protocol: write-all (read any, write all under the "
+         "distributed lock), quorum, primary-backup or partitioned. "
+         "Default: write-all."
+)
+parser.add_argument(
+    "-W", "--write-quorum", metavar="W", dest="write_quorum", type=int,
+    default=2,
+    help="With quorum replication, a write succeeds once W replicas have "
+         "stored it. Default: 2."
+)
+parser.add_argument(
+    "-R", "--read-quorum", metavar="R", dest="read_quorum", type=int,
+    default=2,
+    help="With quorum replication, a read consults R replicas. Choose "
+         "W + R larger than the number of replicas. Default: 2."
+)
+parser.add_argument(
+    "--hedge-percentile", metavar="P", dest="hedge_percentile", type=float,
+    default=0,
+    help="With quorum replication, read from a second up to date replica "
+         "as well when the first has taken longer than the P-th percentile "
+         "of the recent reads. Default: 0 (no hedging)."
+)
+parser.add_argument(
+    "--hedge-rate", metavar="FRACTION", dest="hedge_rate", type=float,
+    default=0.1,
+    help="Hedge at most FRACTION of the reads. Default: 0.1."
+)
+parser.add_argument(
+    "--replication-factor", metavar="N", dest="replication_factor",
+    type=int, default=2,
+    help="With partitioned replication, store every fortune on N servers. "
+         "Default: 2."
+)
+parser.add_argument(
+    "--vnodes", metavar="N", dest="vnodes", type=int, default=64,
+    help="With partitioned replication, place every server at N points of "
+         "the hash ring. Default: 64."
+)
+parser.add_argument(
+    "--load-interval", metavar="SECONDS", dest="load_interval", type=float,
+    default=2.0,
+    help="Report the load of this server to the name service every SECONDS, "
+         "for require_any to pick the least loaded server. 0 disables it. "
+         "Default: 2."
+)
 opts = parser.parse_args()
 
 local_port = opts.port
@@ -71,31 +218,117 @@ class Server(orb.Peer):
 
     """Distributed mutual exclusion client class."""
 
-    def __init__(self, local_address, ns_address, server_type, db_file):
+    def __init__(self, local_address, ns_address, server_type, db_file,
+                 shards=1, algorithm="ricart-agrawala", lease_writes=1,
+                 lease_time=0.1, write_timeout=None, fan_out=16,
+                 replica_timeout=5.0, replication=WRITE_ALL, write_quorum=2,
+                 read_quorum=2, batch_size=64, batch_delay=0.002,
+                 anti_entropy=10.0, bootstrap=None, replication_factor=2,
+                 vnodes=64, hedge_percentile=0, hedge_rate=0.1,
+                 load_interval=2.0):
         """Initialize the client."""
 
-        orb.Peer.__init__(self, local_address, ns_address, server_type)
+        orb.Peer.__init__(self, local_address, ns_address, server_type,
+                          load_interval)
         self.peer_list = PeerList(self)
-        self.distributed_lock = DistributedLock(self, self.peer_list)
-        self.drwlock = DistributedReadWriteLock(self.distributed_lock)
-        self.db = database.Database(db_file)
+        self.distributed_lock = create_lock(algorithm, self, self.peer_list)
+        self.drwlock = DistributedReadWriteLock(self.distributed_lock,
+                                                lease_writes=lease_writes,
+                                                lease_time=lease_time)
+        # Writes to different shards do not need to exclude each other,
+        # each shard has its own named lock.
+        self.lock_manager = LockManager(self, self.peer_list)
+        self.shards = shards
+        self.write_timeout = write_timeout
+        self.replicas = FanOut(fan_out, replica_timeout)
+        self.batcher = WriteBatcher(self.replicas, batch_size, batch_delay)
+        self.ready = threading.Event()
+        self.catch_up = None
+        if bootstrap is not None:
+            files = shard_file_names(db_file, shards) if shards > 1 \
+                else [db_file]
+            versions = snapshot.fetch(bootstrap, files, replica_timeout)
+        if shards > 1:
+            self.db = ShardedDatabase(db_file, shards)
+        else:
+            self.db = database.Database(db_file)
+        self.donor = snapshot.SnapshotDonor(self.db)
+        if bootstrap is not None:
+            # Get almost up to date before joining the group.
+            self.catch_up = snapshot.CatchUp(self.db, bootstrap, versions,
+                                             replica_timeout)
+            self.catch_up.replay()
+        self.hedger = None
+        if hedge_percentile > 0:
+            self.hedger = Hedger(hedge_percentile, hedge_rate,
+                                 timeout=replica_timeout)
+        self.quorum = None
+        if replication == QUORUM:
+            self.quorum = QuorumReplica(self, self.db, self.replicas,
+                                        write_quorum, read_quorum,
+                                        self.hedger, db_file + ".versions")
+        self.primary_backup = None
+        if replication == PRIMARY_BACKUP:
+            self.primary_backup = PrimaryBackup(self, self.db,
+                                                replica_timeout,
+                                                log_file=db_file + ".log")
+        self.partitions = None
+        if replication == PARTITIONED:
+            self.partitions = Partitioning(self, self.db, self.replicas,
+                                           self._addresses,
+                                           replication_factor, vnodes)
+        self.merkle = MerkleTree(self.db)
+        self.anti_entropy = AntiEntropy(
+            self.merkle, self._write_unknown,
+            lambda: list(self._addresses().values()), anti_entropy,
+            replica_timeout)
         self.dispatched_calls = {
             "display_peers":      self.peer_list.display_peers,
             "acquire":            self.distributed_lock.acquire,
             "release":            self.distributed_lock.release,
             "request_token":      self.distributed_lock.request_token,
             "obtain_token":       self.distributed_lock.obtain_token,
-            "display_status":     self.distributed_lock.display_status
+            "withdraw_request":   self.distributed_lock.withdraw_request,
+            "redirect":           self.distributed_lock.redirect,
+            "probe_token":        self.distributed_lock.probe_token,
+            "regenerate_token":   self.distributed_lock.regenerate_token,
+            "rtt_row":            self.distributed_lock.rtt_row,
+            "rtt_matrix":         self.distributed_lock.rtt_matrix,
+            "display_status":     self.distributed_lock.display_status,
+            "acquire_named":      self.lock_manager.acquire,
+            "release_named":      self.lock_manager.release,
+            "request_named_token": self.lock_manager.request_named_token,
+            "obtain_named_token": self.lock_manager.obtain_named_token,
+            "withdraw_named_request":
+                self.lock_manager.withdraw_named_request,
+            "probe_named_token":  self.lock_manager.probe_named_token,
+            "regenerate_named_token":
+                self.lock_manager.regenerate_named_token
         }
         orb.Peer.start(self)
         self.peer_list.initialize()
         self.distributed_lock.initialize()
+        if self.catch_up is not None:
+            self.catch_up.finish()
+        self.ready.set()
+        if self.partitions is not None:
+            self.partitions.start()
+        if anti_entropy > 0 and replication == WRITE_ALL:
+            # The other modes repair the replicas on their own.
+            self.anti_entropy.start()
 
     # Public methods
 
     def destroy(self):
         orb.Peer.destroy(self)
         self.distributed_lock.destroy()
+        self.lock_manager.destroy()
+        self.batcher.destroy()
+        self.anti_entropy.destroy()
+        if self.primary_backup is not None:
+            self.primary_backup.destroy()
+        if self.partitions is not None:
+            self.partitions.destroy()
         self.peer_list.destroy()
 
     def __getattr__(self, attr):
@@ -112,26 +345,41 @@ class Server(orb.Peer):
     def read(self):
         """Read a fortune from the database."""
 
-        #
-        # Your code here.
-        #
+        # A joining replica answers once it has caught up.
+        self.ready.wait()
+        if self.quorum is not None:
+            return self.quorum.read(self._addresses(True))
+        if self.partitions is not None:
+            return self.partitions.read()
         # "Read Any - Write All"
-        # Simply read it from the obtained server's database
-        # Note that you should use the new 'Distributed Read Write Lock'
-        try:
-            self.drwlock.read_acquire()
-            fortune = self.db.read()
-        finally:
-            self.drwlock.read_release()
-        return fortune
+        # Simply read it from the obtained server's database. The
+        # database publishes immutable snapshots, so reads neither take
+        # the distributed read-write lock nor wait for writers.
+        return self.db.read()
+
+    def read_local(self):
+        """Read a fortune from this replica only."""
+
+        return self.db.read()
+
+    def read_at(self, version):
+        """Read a fortune from the database as it was at 'version'."""
+
+        return self.db.read_at(version)
+
+    def version(self):
+        """Return the version of this replica's database."""
+
+        return self.db.version()
 
     def write(self, fortune):
         """Write a fortune to the database.
 
         Obtain the distributed lock and call all other servers to write
-        the fortune as well. Call their 'write_local' as they cannot
-        attempt to obtain the distributed lock when writing their
-        copies.
+        the fortune as well. Call their 'write_local_batch' as they
+        cannot attempt to obtain the distributed lock when writing their
+        copies. Raise LockTimeout if the lock cannot be obtained within
+        write_timeout seconds; the client may retry later.
 
         """
 
@@ -141,14 +389,47 @@ class Server(orb.Peer):
         # "Read Any - Write All"
         # When you write in this server's database,
         # tell all others that they should write in
-        # their own local databases too
+        # their own local databases too. Concurrent writes are combined
+        # into a single critical section (i.e., a single token round).
+        if self.quorum is not None:
+            # Versioned writes, no distributed lock needed.
+            self.quorum.write(self._addresses(True), fortune)
+        elif self.primary_backup is not None:
+            # Sequenced by the primary, no distributed lock needed.
+            self.primary_backup.write(self._addresses(), fortune)
+        elif self.partitions is not None:
+            # Only the replica set of the fortune writes it.
+            self.partitions.write(fortune)
+        else:
+            if self.shards > 1:
+                ticket = self._write_shard(fortune)
+            else:
+                ticket = self.drwlock.write_combined(
+                    self._write_all, fortune, timeout=self.write_timeout)
+            # The replicas get the fortune in the next batch, in the
+            # order the lock has given to the writes. The ones that fail
+            # are reported, they do not stop the others.
+            for pid, error in sorted(
+                    ticket.wait(self.replicas.timeout).items()):
+                print("Replica {} has not written the fortune: {}".format(
+                    pid, error))
+
+    def _write_shard(self, fortune):
+        """Write a fortune everywhere, holding only the lock of its shard."""
+
+        name = "shard{}".format(self.db.shard_of(fortune))
+        if not self.lock_manager.acquire(name, self.write_timeout):
+            raise LockTimeout("busy, retry")
         try:
-            self.drwlock.write_acquire()
-            self.db.write(fortune)
-            for pid in self.peer_list.get_peers():
-                self.peer_list.peer(pid).write_local(fortune)
+            return self._write_all(fortune)
         finally:
-            self.drwlock.write_release()
+            self.lock_manager.release(name)
+
+    def _write_all(self, fortune):
+        """Write a fortune here and queue it for the other replicas."""
+
+        self.db.write(fortune)
+        return self.batcher.submit(self._addresses(), fortune)
 
     def write_local(self, fortune):
         """Write a fortune to the database.
@@ -158,31 +439,184 @@ class Server(orb.Peer):
 
         """
 
+        self.write_local_batch([fortune])
+
+    def write_local_batch(self, fortunes):
+        """Write a batch of fortunes, holding the local lock once."""
+
+        if self.catch_up is not None:
+            # Some of them may have been replayed from the snapshot.
+            fortunes = self.catch_up.received(fortunes)
+        self.drwlock.write_acquire_local()
+        try:
+            self.db.write_batch(fortunes)
+        finally:
+            self.drwlock.write_release_local()
+
+    def lock_stats(self):
+        """Return the contention metrics of both lock layers."""
+
+        return {
+            "distributed": self.distributed_lock.lock_stats(),
+            "named": self.lock_manager.lock_stats(),
+            "local": self.drwlock.stats()
+        }
+
+    def queue_depth(self):
+        """Return the writes waiting for the lock, for the load report."""
+
+        return (self.drwlock.writers_pending +
+                len(self.drwlock.combine_queue))
+
+    def replication_stats(self):
+        """Return the counters of the calls to the other replicas."""
+
+        stats = self.replicas.stats()
+        stats["batches"] = self.batcher.stats()
+        if self.quorum is not None:
+            stats["quorum"] = self.quorum.stats()
+        if self.hedger is not None:
+            stats["hedging"] = self.hedger.stats()
+        if self.primary_backup is not None:
+            stats["primary_backup"] = self.primary_backup.stats()
+        if self.partitions is not None:
+            stats["partitions"] = self.partitions.stats()
+        stats["anti_entropy"] = self.anti_entropy.stats()
+        stats["snapshot"] = self.donor.stats()
+        if self.catch_up is not None:
+            stats["catch_up"] = self.catch_up.stats()
+        return stats
+
+    # Snapshots, called by the joining replicas
+
+    def snapshot_offer(self):
+        return self.donor.offer()
+
+    def snapshot_tail(self, versions):
+        return self.donor.tail(versions)
+
+    # Partitioned replication, called by the other servers
+
+    def partition_store(self, fortunes):
+        return self.partitions.store(fortunes)
+
+    def partition_size(self):
+        return self.partitions.size()
+
+    def partition_read(self):
+        return self.partitions.read_local()
+
+    # Anti-entropy, called by the other replicas
+
+    def ae_nodes(self, indices):
+        return self.merkle.nodes(indices)
+
+    def ae_leaf_digests(self, indices):
+        return self.merkle.leaf_digests(indices)
+
+    def ae_fortunes(self, digests):
+        return self.merkle.fortunes(digests)
+
+    def ae_store(self, fortunes):
+        self._write_unknown(fortunes)
+
+    def _write_unknown(self, fortunes):
+        """Write the synchronized fortunes this replica does not have.
+
+        Two rounds (ours and a peer's) may bring the same fortune: check
+        it against the Merkle tree holding the write lock.
+
+        """
+
+        if self.catch_up is not None:
+            fortunes = self.catch_up.received(fortunes)
         self.drwlock.write_acquire_local()
         try:
-            self.db.write(fortune)
+            fortunes = self.merkle.unknown(fortunes)
+            if fortunes:
+                self.db.write_batch(fortunes)
         finally:
             self.drwlock.write_release_local()
 
+    # Quorum replication, called by the other replicas
+
+    def quorum_store(self, version, fortune):
+        return self.quorum.store(version, fortune)
+
+    def quorum_store_batch(self, records):
+        return self.quorum.store_batch(records)
+
+    def quorum_state(self):
+        return self.quorum.state()
+
+    def quorum_versions(self):
+        return self.quorum.versions()
+
+    def quorum_fetch(self, versions):
+        return self.quorum.fetch(versions)
+
+    # Primary-backup replication, called by the other replicas
+
+    def pb_submit(self, fortune):
+        return self.primary_backup.submit(self._addresses(), fortune)
+
+    def pb_apply(self, first, fortunes):
+        return self.primary_backup.apply(first, fortunes)
+
+    def pb_fetch(self, first):
+        return self.primary_backup.fetch(first)
+
+    def pb_join(self, epochs, length):
+        return self.primary_backup.join(epochs, length)
+
+    def pb_epochs(self):
+        return self.primary_backup.epochs()
+
+    def _addresses(self, include_self=False):
+        """Return the addresses of the replicas, by id."""
+
+        addresses = dict((pid, self.peer_list.peer(pid).address)
+                         for pid in self.peer_list.get_peers())
+        if include_self:
+            addresses[self.id] = self.address
+        return addresses
+
     def register_peer(self, pid, paddr):
         """Register a server peer in this server's peer list."""
 
         self.peer_list.register_peer(pid, paddr)
         self.distributed_lock.register_peer(pid)
+        self.lock_manager.register_peer(pid)
 
     def unregister_peer(self, pid):
         """Remove a server peer from this server's peer list."""
 
         self.peer_list.unregister_peer(pid)
         self.distributed_lock.unregister_peer(pid)
+        self.lock_manager.unregister_peer(pid)
+        self.batcher.forget(pid)
 
 # -----------------------------------------------------------------------------
 # The main program
 # -----------------------------------------------------------------------------
 
+bootstrap_address = None
+if opts.bootstrap is not None:
+    host, port = opts.bootstrap.rsplit(":", 1)
+    bootstrap_address = (host, int(port))
+
 # Initialize the client object.
 local_address = (socket.getfqdn(), local_port)
-p = Server(local_address, name_service_address, server_type, db_file)
+p = Server(local_address, name_service_address, server_type, db_file,
+           opts.shards, opts.algorithm, opts.lease_writes, opts.lease_time,
+           opts.write_timeout or None, opts.fan_out, opts.replica_timeout,
+           opts.replication, opts.write_quorum, opts.read_quorum,
+           opts.batch_size, opts.batch_delay, opts.anti_entropy,
+           bootstrap_address, opts.replication_factor, opts.vnodes,
+           opts.hedge_percentile, opts.hedge_rate,
+           opts.load_interval or None)
+if opts.watch > 0:
+    p.db.watch(opts.watch)
 
 
 def menu():
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+# -----------------------------------------------------------------------------
+# Distributed Systems (TDDD25)
+# -----------------------------------------------------------------------------
+# Author: Sergiu Rafiliu (sergiu.rafiliu@liu.se)
+# Modified: 31 July 2013
+#
+# Copyright 2012 Linkoping University
+# -----------------------------------------------------------------------------
+
+"""Benchmark of the snapshot bootstrap of serverPeer.py.
+
+Generates a database of the given size in a temporary directory, serves
+it from a donor in this process (no name service is needed) and times
+a joining replica: the download of the snapshot, the loading of the
+database and the replay of the writes the donor got in the meantime.
+
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+
+sys.path.append("../modules")
+from Common import orb
+from Server.database import Database, SEPARATOR
+from Server import snapshot
+
+# -----------------------------------------------------------------------------
+# Initialize and read the command line arguments
+# -----------------------------------------------------------------------------
+
+description = """Benchmark of the snapshot bootstrap of a joining replica."""
+parser = argparse.ArgumentParser(description=description)
+parser.add_argument(
+    "-s", "--size", metavar="MB", dest="size", type=int, default=1024,
+    help="Size of the database. Default: 1024."
+)
+parser.add_argument(
+    "-w", "--writes", metavar="WRITES", dest="writes", type=int,
+    default=1000,
+    help="Fortunes written to the donor during the download. Default: 1000."
+)
+opts = parser.parse_args()
+
+# -----------------------------------------------------------------------------
+# Auxiliary classes
+# -----------------------------------------------------------------------------
+
+
+class Donor(object):
+
+    """Stand-in for a live server peer."""
+
+    def __init__(self, db_file):
+        self.db = Database(db_file)
+        self.donor = snapshot.SnapshotDonor(self.db)
+        self.skeleton = orb.Skeleton(self, ("", 0))
+        self.address = ("localhost", self.skeleton.server.getsockname()[1])
+        self.skeleton.start()
+
+    def snapshot_offer(self):
+        return self.donor.offer()
+
+    def snapshot_tail(self, versions):
+        return self.donor.tail(versions)
+
+# -----------------------------------------------------------------------------
+# The main program
+# -----------------------------------------------------------------------------
+
+directory = tempfile.mkdtemp()
+try:
+    donor_file = os.path.join(directory, "donor.db")
+    joiner_file = os.path.join(directory, "joiner.db")
+    record = b"x" * 200 + SEPARATOR
+    with open(donor_file, "wb") as f:
+        chunk = record * (1 << 12)
+        for i in range(opts.size * (1 << 20) // len(chunk)):
+            f.write(chunk)
+    size = os.path.getsize(donor_file)
+    print("Loading the donor ({:.0f} MB)...".format(size / (1 << 20)))
+    donor = Donor(donor_file)
+
+    def write():
+        for i in range(opts.writes):
+            donor.db.write("fortune {}".format(i))
+    writer = threading.Thread(target=write)
+
+    start = time.time()
+    writer.start()
+    versions = snapshot.fetch(donor.address, [joiner_file])
+    downloaded = time.time()
+    db = Database(joiner_file)
+    loaded = time.time()
+    writer.join()
+    catch_up = snapshot.CatchUp(db, donor.address, versions)
+    catch_up.replay()
+    catch_up.finish()
+    done = time.time()
+
+    print("download   {:8.2f} s  ({:.0f} MB/s)".format(
+        downloaded - start, size / (1 << 20) / (downloaded - start)))
+    print("load       {:8.2f} s".format(loaded - downloaded))
+    print("catch up   {:8.2f} s  ({} fortunes)".format(
+        done - loaded, catch_up.stats()["replayed"]))
+    print("total      {:8.2f} s".format(done - start))
+    print("in sync: {}".format(db.version() == donor.db.version()))
+finally:
+    shutil.rmtree(directory)
@@ -50,7 +50,10 @@ done
 # Run servers.
 for ((i=1; i <= $no_servers ; i++)) ; do
     dbfile="${dbdir}${database}_${i}${dbext}"
+    # Every run starts from the pristine database, without the logs of
+    # the quorum and primary-backup modes.
     cp "${dbdir}${database}${dbext}" $dbfile
+    rm -f "${dbfile}.versions" "${dbfile}.log"
     $term -T "Server $i" -e $wrap "s$i" $server -f $dbfile &
 done
 
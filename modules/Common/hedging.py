@@ -0,0 +1,191 @@
+# -----------------------------------------------------------------------------
+# Distributed Systems (TDDD25)
+# -----------------------------------------------------------------------------
+# Author: Sergiu Rafiliu (sergiu.rafiliu@liu.se)
+# Modified: 31 July 2013
+#
+# Copyright 2012 Linkoping University
+# -----------------------------------------------------------------------------
+
+"""Hedged calls: ask a second replica when the first one is slow.
+
+A hedged call goes to the first of the replicas it is given. If it has
+not answered after the 'percentile'-th percentile of the recent
+latencies, the same call goes to the second replica as well. The first
+answer wins and the other call is aborted.
+
+At most 'max_rate' of the calls are hedged (with max_rate < 1 hedging
+can never double the load). A replica that fails before the delay is
+simply replaced by the next one, whatever the rate.
+
+"""
+
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from . import orb
+
+# Latencies needed before hedging starts.
+MIN_SAMPLES = 16
+
+
+def percentile(values, p):
+    """Return the p-th percentile of a sorted list."""
+    return values[min(len(values) - 1, int(p / 100.0 * len(values)))]
+
+
+class Hedger(object):
+
+    """Make hedged calls and keep track of their latency.
+
+    Public methods:
+        --  __init__(percentile=95, max_rate=0.1, window=256, timeout=5.0,
+                     max_workers=32)
+        --  call(addresses, method, *args, on_done=None)
+        --  delay()
+        --  stats()
+
+    """
+
+    def __init__(self, percentile=95, max_rate=0.1, window=256, timeout=5.0,
+                 max_workers=32):
+        self.percentile = percentile
+        self.max_rate = max_rate
+        self.window = window
+        self.timeout = timeout
+        self.pool = ThreadPoolExecutor(max_workers=max_workers)
+        self.lock = threading.Lock()
+        self.attempt_latencies = []
+        self.latencies = []
+        self.counters = {"calls": 0, "hedged": 0, "hedge_wins": 0,
+                         "failovers": 0, "aborted": 0}
+
+    def call(self, addresses, method, *args, on_done=None):
+        """Call 'method' on the replicas at 'addresses', in that order.
+
+        'on_done(i, outcome, latency)', if given, is called for every
+        attempt, with outcome "ok" (the replica has answered, possibly
+        with an error), "failed" or "aborted".
+
+        """
+
+        start = time.time()
+        with self.lock:
+            self.counters["calls"] += 1
+        delay = self.delay()
+        stubs, futures = [], {}
+        error, winner, hedged = None, None, False
+
+        def launch():
+            i = len(stubs)
+            stub = orb.Stub(addresses[i], self.timeout)
+            stubs.append(stub)
+            futures[self.pool.submit(self._attempt, stub, method, args)] = i
+
+        launch()
+        pending = set(futures)
+        while pending:
+            hedge_now = (delay is not None and len(stubs) == 1 and
+                         len(addresses) > 1)
+            timeout = None
+            if hedge_now:
+                timeout = max(0, start + delay - time.time())
+            done, pending = wait(pending, timeout=timeout,
+                                 return_when=FIRST_COMPLETED)
+            if not done:
+                # Still nothing after the delay.
+                if self._may_hedge():
+                    hedged = True
+                    launch()
+                    pending.add(list(futures)[-1])
+                delay = None
+                continue
+            for future in done:
+                i = futures[future]
+                outcome, result, latency = future.result()
+                if outcome in ("ok", "error") and winner is None:
+                    winner = (i, outcome, result)
+                elif outcome == "failed":
+                    error = result
+                if on_done is not None and not stubs[i].aborted:
+                    on_done(i, "failed" if outcome == "failed" else "ok",
+                            latency)
+            if winner is not None:
+                break
+            if not pending and len(stubs) < len(addresses):
+                # The replica has failed, try the next one.
+                with self.lock:
+                    self.counters["failovers"] += 1
+                launch()
+                pending = {list(futures)[-1]}
+        for future in pending:
+            i = futures[future]
+            stubs[i].abort_call()
+            with self.lock:
+                self.counters["aborted"] += 1
+            if on_done is not None:
+                on_done(i, "aborted", None)
+        if winner is None:
+            raise error
+        with self.lock:
+            if hedged and winner[0] == 1:
+                self.counters["hedge_wins"] += 1
+            self._record(self.latencies, time.time() - start)
+        if winner[1] == "error":
+            raise winner[2]
+        return winner[2]
+
+    def delay(self):
+        """Return the current hedging delay, None before enough calls."""
+        with self.lock:
+            if len(self.attempt_latencies) < MIN_SAMPLES:
+                return None
+            return percentile(sorted(self.attempt_latencies),
+                              self.percentile)
+
+    def stats(self):
+        """Return the hedge rate, the delay and the latency percentiles."""
+        delay = self.delay()
+        with self.lock:
+            stats = dict(self.counters)
+            latencies = sorted(self.latencies)
+        stats["hedge_rate"] = stats["hedged"] / (stats["calls"] or 1)
+        stats["delay_ms"] = delay * 1000 if delay is not None else None
+        if latencies:
+            stats["p50_ms"] = percentile(latencies, 50) * 1000
+            stats["p99_ms"] = percentile(latencies, 99) * 1000
+        return stats
+
+    # Private methods
+
+    def _attempt(self, stub, method, args):
+        start = time.time()
+        try:
+            result = getattr(stub, method)(*args)
+        except (OSError, ValueError) as e:
+            return "aborted" if stub.aborted else "failed", e, None
+        except BaseException as e:
+            # Raised by the server itself: an answer like another.
+            latency = time.time() - start
+            with self.lock:
+                self._record(self.attempt_latencies, latency)
+            return "error", e, latency
+        latency = time.time() - start
+        with self.lock:
+            self._record(self.attempt_latencies, latency)
+        return "ok", result, latency
+
+    def _may_hedge(self):
+        with self.lock:
+            if self.counters["hedged"] + 1 > (self.max_rate *
+                                              self.counters["calls"]):
+                return False
+            self.counters["hedged"] += 1
+            return True
+
+    def _record(self, latencies, latency):
+        # Must be called with 'lock' held.
+        latencies.append(latency)
+        if len(latencies) > self.window:
+            del latencies[0]
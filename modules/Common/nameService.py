@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+
+# -----------------------------------------------------------------------------
+# Distributed Systems (TDDD25)
+# -----------------------------------------------------------------------------
+# Author: Sergiu Rafiliu (sergiu.rafiliu@liu.se)
+# Modified: 31 July 2013
+#
+# Copyright 2012 Linkoping University
+# -----------------------------------------------------------------------------
+
+"""Local stand-in for the name service, to run the labs offline.
+
+It implements the protocol the labs use (register, unregister,
+require_object, require_any, require_all) plus report_load, through
+which the peers send their load vector every few seconds.
+
+require_any picks one of the objects of a type at random, with a
+weight inversely proportional to its cost
+
+    (1 + active requests + queued requests) * (1 + p95 latency in ms)
+
+so that the clients go to the least loaded replicas without all of them
+piling onto the single best one. An object that has not reported its
+load recently counts as idle.
+
+Run it with: nameService.py [-p PORT], and point the labs to it with
+TDDD25_NAME_SERVICE=localhost:PORT.
+
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+import threading
+
+if __name__ == "__main__":
+    sys.path.append(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))))
+    from Common import orb
+else:
+    from . import orb
+
+
+class NameService(object):
+
+    """Registry of the objects of each type, and of their load.
+
+    Public methods:
+        --  __init__(expire=10.0)
+        --  register(type, address)
+        --  unregister(id, type, hash)
+        --  require_object(type, id)
+        --  require_any(type)
+        --  require_all(type)
+        --  report_load(id, type, hash, load)
+        --  load_table(type)
+
+    """
+
+    def __init__(self, expire=10.0):
+        self.expire = expire
+        self.lock = threading.Lock()
+        self.rand = random.Random()
+        self.next_id = 0
+        self.objects = {}
+
+    def register(self, type, address):
+        """Register an object, return its id and its secret hash."""
+        with self.lock:
+            self.next_id += 1
+            oid = self.next_id
+            ohash = "{:016x}".format(self.rand.getrandbits(64))
+            self.objects.setdefault(type, {})[oid] = {
+                "address": list(address), "hash": ohash, "load": None,
+                "reported": 0}
+            return [oid, ohash]
+
+    def unregister(self, id, type, hash):
+        with self.lock:
+            self._entry(type, id, hash)
+            del self.objects[type][id]
+
+    def require_object(self, type, id):
+        with self.lock:
+            return self._entry(type, id)["address"]
+
+    def require_any(self, type):
+        """Return the address of a lightly loaded object of 'type'."""
+        with self.lock:
+            entries = list(self.objects.get(type, {}).values())
+            if not entries:
+                raise LookupError("No object of type {}".format(type))
+            now = time.time()
+            weights = [1.0 / self._cost(entry, now) for entry in entries]
+            return self.rand.choices(entries, weights)[0]["address"]
+
+    def require_all(self, type):
+        with self.lock:
+            return [[oid, entry["address"]] for oid, entry in
+                    sorted(self.objects.get(type, {}).items())]
+
+    def report_load(self, id, type, hash, load):
+        """Record the load vector of an object."""
+        with self.lock:
+            entry = self._entry(type, id, hash)
+            entry["load"] = load
+            entry["reported"] = time.time()
+
+    def load_table(self, type):
+        """Return the last load vector and the cost of every object."""
+        with self.lock:
+            now = time.time()
+            return [[oid, entry["load"], self._cost(entry, now)]
+                    for oid, entry in
+                    sorted(self.objects.get(type, {}).items())]
+
+    # Private methods
+
+    def _entry(self, type, id, hash=None):
+        entry = self.objects.get(type, {}).get(id)
+        if entry is None:
+            raise LookupError("No object {} of type {}".format(id, type))
+        if hash is not None and hash != entry["hash"]:
+            raise PermissionError("Wrong hash for object {}".format(id))
+        return entry
+
+    def _cost(self, entry, now):
+        load = entry["load"]
+        if load is None or now - entry["reported"] > self.expire:
+            return 1.0
+        return ((1 + load["active"] + load["queue"]) *
+                (1 + load["p95_ms"]))
+
+# -----------------------------------------------------------------------------
+# The main program
+# -----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    description = """Local stand-in for the name service."""
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument(
+        "-p", "--port", metavar="PORT", dest="port", type=int,
+        default=42424,
+        help="Set the port to listen to. Default: 42424."
+    )
+    opts = parser.parse_args()
+
+    skeleton = orb.Skeleton(NameService(), ("", opts.port))
+    skeleton.start()
+    print("Name service listening on port {}.".format(opts.port))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
@@ -10,8 +10,15 @@
 """ Simple module to obtain the name service location.
 
 This module's role is simply to allow easy maintenance of the lab
-structure if the name service changes address.
+structure if the name service changes address. Set TDDD25_NAME_SERVICE
+to HOST:PORT to use another one, e.g. the local stand-in of
+nameService.py.
 
 """
 
+import os
+
 name_service_address = ("ns-tddd25.edu.liu.se", 42424)
+if os.environ.get("TDDD25_NAME_SERVICE"):
+    host, port = os.environ["TDDD25_NAME_SERVICE"].rsplit(":", 1)
+    name_service_address = (host, int(port))
@@ -7,7 +7,9 @@
 # Copyright 2012-2017 Linkoping University
 # -----------------------------------------------------------------------------
 
+import time
 import threading
+import collections
 import socket
 import json
 
@@ -26,6 +28,9 @@ objects that communicate via networks. This infrastructure consists of:
         Class that implements basic bidirectional (Stub/Skeleton)
         communication. Any object wishing to transparently interact with
         remote objects should extend this class.
+--  LoadMonitor ::
+        Keeps track of the load of a Skeleton, which the Peer reports
+        to the name service every 'load_interval' seconds, if given.
 
 """
 
@@ -40,10 +45,31 @@ class Stub(object):
 
     This is  wrapper object for a socket.
 
+    If connect_timeout is given, connecting to a dead object fails after
+    that many seconds instead of the (long) default of the system. Once
+    connected, the call waits for the answer as long as it takes (at most
+    call_timeout seconds without hearing from the object, if given),
+    unless another thread calls abort_call(). After a failed call,
+    'connected' tells whether the request may have reached the object.
+
     """
 
-    def __init__(self, address):
+    def __init__(self, address, connect_timeout=None, call_timeout=None):
         self.address = tuple(address)
+        self.connect_timeout = connect_timeout
+        self.call_timeout = call_timeout
+        self.call_socket = None
+        self.aborted = False
+        self.connected = False
+
+    def abort_call(self):
+        """Make the call in progress on this stub fail with an OSError."""
+        self.aborted = True
+        if self.call_socket is not None:
+            try:
+                self.call_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
 
     def _rmi(self, method, *args):
         #
@@ -51,7 +77,14 @@ class Stub(object):
         #
         # Establish connection with the remote object
         mySocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.call_socket = mySocket
+        mySocket.settimeout(self.connect_timeout)
         mySocket.connect(self.address)
+        self.connected = True
+        mySocket.settimeout(self.call_timeout)
+        if self.aborted:
+            mySocket.close()
+            raise ConnectionAbortedError("The call has been aborted")
         connection = mySocket.makefile(mode="rw")
         
         # Prepare and send the request to remote object
@@ -61,8 +94,11 @@ class Stub(object):
         connection.flush()
 
         # Receive the response from remote object 
-        responseFromNS = json.loads(connection.readline())
+        response = connection.readline()
         connection.close()
+        if self.aborted:
+            raise ConnectionAbortedError("The call has been aborted")
+        responseFromNS = json.loads(response)
 
         #Show the response from remote object
         if responseFromNS.get("error"):
@@ -78,15 +114,61 @@ class Stub(object):
         return rmi_call
 
 
+class LoadMonitor(object):
+
+    """Requests being served and latency of the recent ones.
+
+    Latencies older than 'max_age' seconds are forgotten, so that a
+    server that was slow for a while, and got little traffic since, does
+    not look slow forever.
+
+    """
+
+    def __init__(self, window=256, max_age=30.0):
+        self.window = window
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.active = 0
+        # (time, latency) of the recent requests, oldest first.
+        self.latencies = collections.deque()
+
+    def started(self):
+        with self.lock:
+            self.active += 1
+
+    def finished(self, latency):
+        with self.lock:
+            self.active -= 1
+            self.latencies.append((time.time(), latency))
+            if len(self.latencies) > self.window:
+                self.latencies.popleft()
+
+    def active_requests(self):
+        with self.lock:
+            return self.active
+
+    def p95(self):
+        """Return the 95th percentile of the recent latencies."""
+        with self.lock:
+            oldest = time.time() - self.max_age
+            while self.latencies and self.latencies[0][0] < oldest:
+                self.latencies.popleft()
+            latencies = sorted(latency for _, latency in self.latencies)
+        if not latencies:
+            return 0.0
+        return latencies[int(0.95 * (len(latencies) - 1))]
+
+
 class Request(threading.Thread):
 
     """Run the incoming requests on the owner object of the skeleton."""
 
-    def __init__(self, owner, conn, addr):
+    def __init__(self, owner, conn, addr, monitor=None):
         threading.Thread.__init__(self)
         self.addr = addr
         self.conn = conn
         self.owner = owner
+        self.monitor = monitor
         self.daemon = True
 
     # Need a function to process request just like in Lab 1
@@ -115,7 +197,14 @@ class Request(threading.Thread):
             request = worker.readline()
             
             # Process the request.
-            result = self.process_request(request)
+            start = time.time()
+            if self.monitor is not None:
+                self.monitor.started()
+            try:
+                result = self.process_request(request)
+            finally:
+                if self.monitor is not None:
+                    self.monitor.finished(time.time() - start)
             # Send the result.
             worker.write(result + '\n')
             worker.flush()
@@ -142,6 +231,7 @@ class Skeleton(threading.Thread):
         self.address = address
         self.owner = owner
         self.daemon = True
+        self.monitor = LoadMonitor()
         #
         # Your code here.
         #
@@ -164,7 +254,7 @@ class Skeleton(threading.Thread):
                 conn, addr = self.server.accept()
                 # Initialize the Request class and let it handle everything
                 # Remember Skeleton only acts as a bridge
-                req = Request(self.owner, conn, addr)
+                req = Request(self.owner, conn, addr, self.monitor)
                 print("Serving a request from {0}".format(addr))
                 # .start() will make a new thread of Request and
                 # execute its run()
@@ -176,9 +266,16 @@ class Skeleton(threading.Thread):
 
 class Peer:
 
-    """Class, extended by objects that communicate over the network."""
+    """Class, extended by objects that communicate over the network.
 
-    def __init__(self, l_address, ns_address, ptype):
+    Once registered, the peer reports its load() to the name service
+    every 'load_interval' seconds (never if None, the default), so that
+    require_any can send the clients to the least loaded peers. A name
+    service that does not know report_load is left alone.
+
+    """
+
+    def __init__(self, l_address, ns_address, ptype, load_interval=None):
         self.type = ptype
         self.hash = ""
         self.id = -1
@@ -186,6 +283,8 @@ class Peer:
         self.skeleton = Skeleton(self, ('', l_address[1]))
         self.name_service_address = ns_address
         self.name_service = Stub(self.name_service_address)
+        self.load_interval = load_interval
+        self.reporting = threading.Event()
 
     # Public methods
 
@@ -195,13 +294,47 @@ class Peer:
         self.skeleton.start()
         self.id, self.hash = self.name_service.register(self.type,
                                                         self.address)
+        if self.load_interval is not None:
+            self.reporting.set()
+            reporter = threading.Thread(target=self._report_load)
+            reporter.daemon = True
+            reporter.start()
 
     def destroy(self):
         """Unregister the object before removal."""
 
+        self.reporting.clear()
         self.name_service.unregister(self.id, self.type, self.hash)
 
     def check(self):
         """Checking to see if the object is still alive."""
 
         return (self.id, self.type)
+
+    def load(self):
+        """Return the load vector of this peer."""
+
+        return {"active": self.skeleton.monitor.active_requests(),
+                "queue": self.queue_depth(),
+                "p95_ms": self.skeleton.monitor.p95() * 1000}
+
+    def queue_depth(self):
+        """Return the number of requests waiting inside the object (e.g.
+        for a lock). Overridden by the objects that queue requests."""
+
+        return 0
+
+    # Private methods
+
+    def _report_load(self):
+        while self.reporting.is_set():
+            try:
+                self.name_service.report_load(self.id, self.type, self.hash,
+                                              self.load())
+            except BaseException as e:
+                # Errors are rebuilt by name on this side of the connection.
+                if type(e).__name__ == "AttributeError":
+                    # This name service does not take load reports.
+                    return
+                print("Could not report the load: {}".format(e))
+            time.sleep(self.load_interval)
@@ -0,0 +1,216 @@
+# -----------------------------------------------------------------------------
+# Distributed Systems (TDDD25)
+# -----------------------------------------------------------------------------
+# Author: Sergiu Rafiliu (sergiu.rafiliu@liu.se)
+# Modified: 31 July 2013
+#
+# Copyright 2012 Linkoping University
+# -----------------------------------------------------------------------------
+
+"""Load-aware choice of a replica for every call of a client.
+
+For every replica the selector keeps an exponentially weighted moving
+average (EWMA) of its latency and the number of calls in flight to it.
+A call picks two replicas at random and goes to the one with the lower
+cost, EWMA times (in flight + 1): the "power of two choices" avoids both
+a slow replica and the herd that always picking the best one would
+cause. A replica nobody has called yet costs nothing, so it is tried.
+
+A replica that cannot be reached is set aside for 'retry_after'
+seconds and the call goes on to another one. A call to a method that is
+not 'idempotent' (e.g. write) only goes on to another replica if it
+could not even connect to the first one: once sent, it may have been
+applied even though the answer got lost. Errors raised by the server
+itself (e.g. LockTimeout) are not retried.
+
+With a Hedger, the calls of the 'hedged' methods (reads) also go to
+the next best replica when the first one is slow, see hedging.py.
+
+"""
+
+import time
+import random
+import threading
+
+from . import orb
+
+
+class ReplicaSelector(object):
+
+    """Send every call to a lightly loaded replica.
+
+    Public methods:
+        --  __init__(replicas, refresh=None, alpha=0.3, timeout=5.0,
+                     retry_after=5.0, hedger=None, hedged=("read",),
+                     idempotent=("read",))
+        --  call(method, *args)
+        --  stats()
+
+    'replicas' maps the id of each replica to its address, 'refresh()'
+    returns such a map again, when all the known replicas have failed.
+    Like a Stub, selector.method(*args) is selector.call("method", *args).
+
+    """
+
+    def __init__(self, replicas, refresh=None, alpha=0.3, timeout=5.0,
+                 retry_after=5.0, hedger=None, hedged=("read",),
+                 idempotent=("read",)):
+        self.refresh = refresh
+        self.hedger = hedger
+        self.hedged = hedged
+        self.idempotent = idempotent
+        self.alpha = alpha
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.lock = threading.Lock()
+        self.rand = random.Random()
+        self.replicas = {}
+        self._follow(replicas)
+
+    def call(self, method, *args):
+        """Call 'method' on a replica, failing over to the others."""
+        if self.hedger is not None and method in self.hedged:
+            return self._hedged_call(method, *args)
+        tried = set()
+        refreshed = False
+        while True:
+            pid = self._choose(tried)
+            if pid is None:
+                if self.refresh is None or refreshed:
+                    raise orb.CommunicationError(
+                        "No replica has answered {}()".format(method))
+                # Maybe the group has changed: ask once, for new replicas.
+                self._follow(self.refresh())
+                refreshed = True
+                continue
+            tried.add(pid)
+            replica = self.replicas[pid]
+            with self.lock:
+                replica["in_flight"] += 1
+                replica["calls"] += 1
+            start = time.time()
+            stub = orb.Stub(replica["address"], self.timeout)
+            try:
+                result = getattr(stub, method)(*args)
+            except (OSError, ValueError) as e:
+                # Could not reach the replica or got no (valid) answer.
+                with self.lock:
+                    replica["in_flight"] -= 1
+                    replica["failures"] += 1
+                    replica["down_until"] = time.time() + self.retry_after
+                if stub.connected and method not in self.idempotent:
+                    # Calling another replica could apply it twice.
+                    raise
+                print("Replica {} has failed, trying another one: {}".format(
+                    pid, e))
+                continue
+            except BaseException:
+                self._observe(replica, time.time() - start)
+                raise
+            self._observe(replica, time.time() - start)
+            return result
+
+    def __getattr__(self, attr):
+        """Forward the call to one of the replicas."""
+        if attr.startswith("_"):
+            raise AttributeError(attr)
+
+        def rmi_call(*args):
+            return self.call(attr, *args)
+        return rmi_call
+
+    def stats(self):
+        """Return the calls, failures, latency and load of each replica."""
+        with self.lock:
+            return dict((pid, {"address": r["address"],
+                               "calls": r["calls"],
+                               "failures": r["failures"],
+                               "latency_ms": (r["ewma"] or 0.0) * 1000,
+                               "in_flight": r["in_flight"]})
+                        for pid, r in self.replicas.items())
+
+    # Private methods
+
+    def _follow(self, replicas):
+        with self.lock:
+            for pid in list(self.replicas):
+                if pid not in replicas:
+                    del self.replicas[pid]
+            for pid, address in replicas.items():
+                if pid not in self.replicas:
+                    self.replicas[pid] = {"address": tuple(address),
+                                          "ewma": None, "in_flight": 0,
+                                          "calls": 0, "failures": 0,
+                                          "down_until": 0}
+
+    def _cost(self, replica):
+        if replica["ewma"] is None:
+            return 0.0
+        return replica["ewma"] * (replica["in_flight"] + 1)
+
+    def _choose(self, tried):
+        """Return the better of two random replicas, None if none is
+        left."""
+        now = time.time()
+        with self.lock:
+            candidates = [pid for pid, r in self.replicas.items()
+                          if pid not in tried and r["down_until"] <= now]
+            if not candidates:
+                # All set aside: the ones we have not tried yet will do.
+                candidates = [pid for pid in self.replicas
+                              if pid not in tried]
+            if not candidates:
+                return None
+            if len(candidates) == 1:
+                return candidates[0]
+            a, b = self.rand.sample(candidates, 2)
+            if self._cost(self.replicas[b]) < self._cost(self.replicas[a]):
+                return b
+            return a
+
+    def _hedged_call(self, method, *args):
+        first = self._choose(set())
+        second = self._choose({first})
+        pids = [pid for pid in (first, second) if pid is not None]
+        if not pids:
+            raise orb.CommunicationError(
+                "No replica to call {}() on".format(method))
+        replicas = [self.replicas[pid] for pid in pids]
+        reported = set()
+        with self.lock:
+            for replica in replicas:
+                # Busy until the hedger tells us otherwise.
+                replica["in_flight"] += 1
+
+        def on_done(i, outcome, latency):
+            reported.add(i)
+            replica = replicas[i]
+            with self.lock:
+                if outcome != "aborted":
+                    replica["calls"] += 1
+                if outcome == "failed":
+                    replica["failures"] += 1
+                    replica["down_until"] = time.time() + self.retry_after
+            if outcome == "ok":
+                self._observe(replica, latency)
+            else:
+                with self.lock:
+                    replica["in_flight"] -= 1
+
+        try:
+            return self.hedger.call([r["address"] for r in replicas],
+                                    method, *args, on_done=on_done)
+        finally:
+            with self.lock:
+                for i, replica in enumerate(replicas):
+                    if i not in reported:
+                        # Never called.
+                        replica["in_flight"] -= 1
+
+    def _observe(self, replica, latency):
+        with self.lock:
+            replica["in_flight"] -= 1
+            if replica["ewma"] is None:
+                replica["ewma"] = latency
+            else:
+                replica["ewma"] += self.alpha * (latency - replica["ewma"])
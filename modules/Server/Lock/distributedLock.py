@@ -23,8 +23,35 @@ The implementation should satisfy the following requests:
         dictionaries should be updated accordingly.
     --  when the peer that has the token (either TOKEN_PRESENT or
         TOKEN_HELD) quits, it should pass the token to some other peer.
-    --  For simplicity, we shall not handle the case when the peer
-        holding the token dies unexpectedly.
+    --  when the peer holding the token dies unexpectedly, the token
+        is regenerated (see below).
+
+Token regeneration: a peer that has waited suspect_timeout seconds for
+the token suspects that its holder has died. It asks the live peer with
+the smallest id (the coordinator) to regenerate the token. The
+coordinator starts a new epoch and probes all the live peers with it. A
+peer that answers a probe refuses, from then on, tokens of an older
+epoch, so that a token still on its way cannot show up next to the new
+one. If no peer reports having the token, the coordinator rebuilds it
+from the token and request dictionaries of the survivors and hands it
+out as usual. A peer that did not answer is taken for dead: if it was
+only slow and holds the token, there may be two tokens.
+
+Token encoding: the token travels in the compact form of tokenCodec.
+Every hand-off increases the version of the token, and requests carry
+the version of the token their sender saw last. With delta_tokens, the
+holder sends the requester only the entries that changed since then
+(the requester asks for the full token if its copy does not match).
+The 'token_bytes' and 'token_payloads' counters give the average size
+of a hand-off.
+
+Routing: every remote call measures the round trip time to its peer
+(the estimate is the smallest of the recent samples, since a call may
+also include some work on the other side). With LATENCY_ROUTING, the
+token goes to the closest requester among those whose request reached
+us at most fairness_window seconds after the oldest pending request, so
+nobody is overtaken by requests made more than fairness_window seconds
+later. RING_ROUTING (the default) keeps the order of the ring of ids.
 
 """
 
@@ -32,7 +59,20 @@ NO_TOKEN = 0
 TOKEN_PRESENT = 1
 TOKEN_HELD = 2
 
+RING_ROUTING = "ring"
+LATENCY_ROUTING = "latency"
+
 import time
+import json
+import bisect
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from Common import orb
+from . import tokenCodec
+from .lockProfiler import LockProfiler
+from .failureDetector import FailureDetector
 
 
 class DistributedLock(object):
@@ -45,33 +85,107 @@ class DistributedLock(object):
         --  destroy()
         --  register_peer(pid)
         --  unregister_peer(pid)
-        --  acquire()
+        --  redirect(pid, holder)
+        --  acquire(timeout=None)
+        --  try_acquire(timeout)
+        --  cancel()
+        --  has_pending_requests()
         --  release()
-        --  request_token(time, pid)
-        --  obtain_token(token)
+        --  request_token(timestamp, pid, seen=None)
+        --  withdraw_request(timestamp, pid)
+        --  obtain_token(token, epoch=0)
+        --  probe_token(epoch)
+        --  regenerate_token()
+        --  rtt_row()
+        --  rtt_matrix()
         --  display_status()
+        --  lock_stats()
 
     """
 
-    def __init__(self, owner, peer_list):
+    def __init__(self, owner, peer_list, rpc_timeout=2.0, max_parallel=16,
+                 pool=None, suspect_timeout=5.0, delta_tokens=False,
+                 routing=RING_ROUTING, fairness_window=0.05):
         self.peer_list = peer_list
         self.owner = owner
+        # Calls to other peers run in parallel on this pool (which may be
+        # shared between several locks). A peer that cannot be reached
+        # within rpc_timeout is considered dead.
+        self.rpc_timeout = rpc_timeout
+        self.pool = pool or ThreadPoolExecutor(max_workers=max_parallel)
         self.time = 0
         self.token = None
         self.request = {}
+        # Sorted ids of the peers whose request has not been satisfied
+        # yet (as far as the last token we have seen tells), so that the
+        # next holder is found by bisection instead of by a full scan.
+        self.pending = []
         self.state = NO_TOKEN
-
-    def _prepare(self, token):
+        self.profiler = LockProfiler()
+        # When we got hold of the lock, to measure hold times.
+        self.acquired_at = None
+        # When the pending request of each peer reached us, to measure
+        # the request-to-grant latency of the peers we hand the token to.
+        self.request_arrival = {}
+        # obtain_token wakes up the thread waiting for the token in
+        # acquire through this condition. It shares its lock with the
+        # peer list, i.e., it protects the very same state.
+        self.token_arrived = threading.Condition(self.peer_list.lock)
+        self.cancelled = False
+        # Time of the last request we stopped waiting for.
+        self.abandoned = 0
+        # Token regeneration. suspect_timeout=None disables it.
+        self.suspect_timeout = suspect_timeout
+        self.detector = FailureDetector(
+            lambda pids: self._call_all(pids, "check"))
+        self.epoch = 0
+        self.regenerating = threading.Lock()
+        # Token encoding: the version and epoch of the last token we
+        # have seen, the version at which each of its entries changed,
+        # and the [epoch, version] each requester has seen last.
+        self.delta_tokens = delta_tokens
+        self.token_version = 0
+        self.token_epoch = 0
+        self.changed_at = {}
+        self.seen = {}
+        # Round trip times of the recent calls to each peer.
+        self.routing = routing
+        self.fairness_window = fairness_window
+        self.rtt_samples = {}
+        self.rtt_lock = threading.Lock()
+
+    def _prepare(self, token, base=0):
         """Prepare the token to be sent as a JSON message.
         This step is necessary because in the JSON standard, the key to
         a dictionary must be a string whild in the token the key is
-        integer.
+        integer. With base, only the entries changed after version base
+        are sent.
         """
-        return list(token.items())
+        return tokenCodec.encode(token, self.changed_at, self.token_version,
+                                 base)
 
     def _unprepare(self, token):
-        """The reverse operation to the one above."""
-        return dict(token)
+        """The reverse operation to the one above.
+
+        Raise ValueError if the token is a delta to a version we do not
+        have.
+
+        """
+        version, base, entries = tokenCodec.decode(token)
+        if base:
+            if self.token is None or base != self.token_version:
+                raise ValueError("No token of version {}".format(base))
+            merged = dict(self.token)
+        else:
+            merged = {}
+            self.changed_at = {}
+        for pid, timestamp, changed in entries:
+            merged[pid] = timestamp
+            self.changed_at[pid] = changed
+        for pid in self.request:
+            merged.setdefault(pid, 0)
+        self.token_version = version
+        return merged
 
     # Public methods
 
@@ -129,7 +243,10 @@ class DistributedLock(object):
             if (self.state == TOKEN_PRESENT or self.state == TOKEN_HELD) and self.peer_list.get_peers():
                 # If we have it and there are other peers present in the list, 
                 # then release it
-                self.release()
+                if self.state == TOKEN_HELD:
+                    self.release()
+                else:
+                    self._pass_token()
 
                 #After releasing, check if we still have it (i.e nobody took it)
                 if self.state != NO_TOKEN:
@@ -137,20 +254,11 @@ class DistributedLock(object):
                     # Sort the peer list
                     # Give it to the first peer
                     peersList = sorted(self.peer_list.peers.keys())
-                    for pid in peersList:
-                        # Careful not to give to yourself again lol
-                        if pid != self.owner.id:
-                            # Since it will be remote call, you try-except
-                            try:
-                                # Ask the other peer to take it
-                                self.peer_list.peer(pid).obtain_token(self._prepare(self.token))
-                                # If the call was successful (i.e the peer did not quit suddenly)
-                                # break the loop since the token's been given
-                                break
-                            except:
-                                # If the peer was not available for some reason
-                                # Handle the exception and iterate the loop for next peer
-                                print("Peer not unavailable")
+                    # Careful not to give to yourself again lol
+                    pid = self._hand_off([pid for pid in peersList
+                                          if pid != self.owner.id])
+                    if pid is not None:
+                        self.profiler.count("token_sent")
 
                     #Finally say that we no longer have the token
                     self.state = NO_TOKEN
@@ -183,36 +291,56 @@ class DistributedLock(object):
         if self.token:
             self.token.pop(pid)
         self.request.pop(pid)
+        self.request_arrival.pop(pid, None)
+        self.seen.pop(pid, None)
+        self._remove_pending(pid)
+        with self.rtt_lock:
+            self.rtt_samples.pop(pid, None)
         self.peer_list.lock.release()
+        self.detector.forget(pid)
+
+    def redirect(self, pid, holder):
+        """Called by peer pid, which leaves the system: the peers that
+        reach the token through pid go through 'holder' instead.
+
+        Here every peer knows all the others, there is nothing to do.
+
+        """
+        pass
+
+    def acquire(self, timeout=None):
+        """Called when this object tries to acquire the lock.
+
+        Wait at most 'timeout' seconds (forever if None) for the token.
+        Return True if the lock has been acquired, False if the timeout
+        expired or the wait has been cancelled with cancel(). When we
+        give up, the request is withdrawn from the other peers, and a
+        token arriving anyway is passed on to the next requester.
 
-    def acquire(self):
-        """Called when this object tries to acquire the lock."""
+        """
         print("Trying to acquire the lock...")
+        start = time.time()
         #
         # Your code here.
         #
         self.peer_list.lock.acquire()
+        self.cancelled = False
         # Increment the time and also update your entry in the request dictionary
         self.time = self.time + 1
         self.request[self.owner.id] = self.time
-        # These prints are not necessary
-        print("Aquire Request: ", self.request)
-        print("Aquire Token: ", self.token)
-        print("Aquire Time: ", self.time)
         try:
             if self.state == TOKEN_PRESENT:
                 # If we have the token, simply use it
                 self.state = TOKEN_HELD
             elif self.state == NO_TOKEN:
                 # Request token from others
-                peersList = sorted(self.peer_list.peers.keys())
+                peersList = list(self.peer_list.peers.keys())
                 # It is important to release the lock
                 # since we are going to request others
                 # If we never release it,
                 # they will not be able to acquire the lock
                 # to process the request (hence deadlock)
                 self.peer_list.lock.release()
-                print(peersList)
                 # We need to send the request to everyone
                 # since we don't know who has it
                 # Also note that even if the first one has it
@@ -221,115 +349,142 @@ class DistributedLock(object):
                 # while a lot of peers have requested and we don't receive it first
                 # then the next peer who gets it should already have a
                 # pending request from us
-                for pid in peersList:
-                    if pid != self.owner.id:
-                        print("Hey ID {}, give me token".format(pid))
-                        try:
-                            self.peer_list.peer(pid).request_token(self.time, self.owner.id)
-                        except:
-                            print("Peer not available")
+                # The requests are sent in parallel, each peer gets at
+                # most rpc_timeout seconds to answer.
+                others = self._request_targets(peersList)
+                reached = self._call_all(others, "request_token",
+                                         self.time, self.owner.id,
+                                         self._seen())
+                self.profiler.count("request_sent", len(reached))
+                for pid in others:
+                    if pid not in reached:
+                        print("Peer {} not available".format(pid))
 
                 # Acquire the lock again that you released above
                 self.peer_list.lock.acquire()
-                while self.state != TOKEN_HELD:
-                    # Keeping waiting for the token
-                    # sleep and come back later to avoid the deadlock
-                    # We do this to give a chance to others
-                    # to process their request_token function
-                    # Remember to import time
+                # Keep waiting for the token. The wait releases the lock
+                # so that others can still run request_token, and
+                # obtain_token wakes us up as soon as the token is here.
+                # If it takes too long, make sure the token still exists.
+                deadline = None if timeout is None else start + timeout
+                suspected_at = None
+                while True:
+                    wait = self.suspect_timeout
+                    if deadline is not None:
+                        remaining = max(0, deadline - time.time())
+                        wait = remaining if wait is None else min(wait,
+                                                                  remaining)
+                    if self.token_arrived.wait_for(
+                            lambda: self.state == TOKEN_HELD or
+                            self.cancelled, wait):
+                        break
+                    if deadline is not None and time.time() >= deadline:
+                        break
+                    if suspected_at is None:
+                        suspected_at = time.time()
+                    now, seen = self.time, self._seen()
                     self.peer_list.lock.release()
-                    time.sleep(0.1)
-                    self.peer_list.lock.acquire()
-                    pass
-                      
+                    try:
+                        self._recover(now, seen)
+                    finally:
+                        self.peer_list.lock.acquire()
+                if self.state != TOKEN_HELD:
+                    # Give up on this request.
+                    self.abandoned = self.time
+                    self.profiler.count("acquire_abandoned")
+                    self.peer_list.lock.release()
+                    try:
+                        self._call_all(others, "withdraw_request",
+                                       self.abandoned, self.owner.id)
+                    finally:
+                        self.peer_list.lock.acquire()
+                    return False
+                if suspected_at is not None:
+                    self.profiler.record("recovery_wait",
+                                         time.time() - suspected_at)
+            self.acquired_at = time.time()
+            self.profiler.record("acquire_wait", self.acquired_at - start)
+            return True
+
+        finally:
+            self.peer_list.lock.release()
+
+    def try_acquire(self, timeout):
+        """Acquire the lock if it can be done within 'timeout' seconds.
+
+        Return False (having withdrawn our request) otherwise.
+
+        """
+        return self.acquire(timeout)
+
+    def has_pending_requests(self):
+        """Return True if some other peer is waiting for the token."""
+        self.peer_list.lock.acquire()
+        try:
+            return any(pid != self.owner.id for pid in self._candidates())
+        finally:
+            self.peer_list.lock.release()
+
+    def cancel(self):
+        """Stop the thread waiting in acquire (if any)."""
+        self.peer_list.lock.acquire()
+        try:
+            self.cancelled = True
+            self.token_arrived.notify_all()
         finally:
             self.peer_list.lock.release()
 
 
 
     def release(self):
-        """Called when this object releases the lock."""
+        """Called when this object releases the lock.
+
+        Return False, doing nothing, if we do not hold the lock.
+
+        """
         print("Releasing the lock...")
         #
         # Your code here.
         #
         self.peer_list.lock.acquire()
         try:
+            if self.state != TOKEN_HELD:
+                print("The lock is not held, nothing to release.")
+                return False
+            if self.acquired_at is not None:
+                self.profiler.record("hold", time.time() - self.acquired_at)
+                self.acquired_at = None
             self.state = TOKEN_PRESENT
-            # Sort the peer list
-            # Loop through it
-            # Split the list into two parts
-            # Right part is from IDs > current peer to the end of the list
-            # Left part is from start of the list to IDs < current peer
-            # Go through the Right one first and find the deserving peer
-            # If not found, go through the Left.
-            
-            foundReceiver = False
-            rightList = []
-            leftList = []
-            sortedList = sorted(self.peer_list.peers.keys())
-            for pid in sortedList:
-                if pid < self.owner.id:
-                    leftList.append(pid)
-                elif pid > self.owner.id:
-                    rightList.append(pid)
-            
-            print(sortedList)
-            print(leftList)
-            print(rightList)
-            
-            for pid in rightList:
-                if self.request[pid] > self.token[pid]: # Condition to check for a pending request    
-                    print("Found receiver {} in rightList".format(pid))
-                    self.token[self.owner.id] = self.time
-                    #Send it to the that peer           
-                    try:
-                        self.peer_list.peer(pid).obtain_token(self._prepare(self.token))
-                        self.state = NO_TOKEN
-                        foundReceiver = True
-                        break
-                    except:
-                        print("Peer id {} unavailable".format(pid))
-                    
-
-
-            if foundReceiver == False:
-                for pid in leftList:
-                    if self.request[pid] > self.token[pid]:        
-                        print("Found receiver {} in leftList".format(pid))
-                        self.token[self.owner.id] = self.time
-                        #Send it to the that peer
-                        try:
-                            # Remember to send it in prepare
-                            self.peer_list.peer(pid).obtain_token(self._prepare(self.token))
-                            self.state = NO_TOKEN
-                            foundReceiver = True
-                            break
-                        except:
-                            print("Peer id {} unavailable".format(pid))
-                        
-
+            self._pass_token()
+            return True
         finally:
             self.peer_list.lock.release()
 
-    def request_token(self, time, pid):
-        """Called when some other object requests the token from us."""
+    def request_token(self, timestamp, pid, seen=None):
+        """Called when some other object requests the token from us.
+
+        'seen' is the [epoch, version] of the last token pid has seen.
+
+        """
         #
         # Your code here.
         #
         print("Received a request from peer {}".format(pid))
+        self.detector.heard(pid)
         self.peer_list.lock.acquire()
+        self.profiler.count("request_received")
+        if timestamp > self.request[pid]:
+            self.request_arrival[pid] = time.time()
+            self._add_pending(pid)
+            if seen:
+                self.seen[pid] = seen
         # Updating the dictionary for that peer's request with the latest time
-        self.request[pid] = max(time, self.request[pid])
-        # More unnecessary prints
-        print("Request Token Request: ", self.request)
-        print("Request Token Token: ", self.token)
-        print("Request Token Time: ", self.time)
+        self.request[pid] = max(timestamp, self.request[pid])
         try:
             if self.state == TOKEN_PRESENT:
                 # Release the token
                 print("Token present")
-                self.release()
+                self._pass_token()
             elif self.state == TOKEN_HELD:
                 # Ain't gonna give it to nobody
                 print("Token held")
@@ -339,29 +494,144 @@ class DistributedLock(object):
             self.peer_list.lock.release()
 
 
-    def obtain_token(self, token):
-        """Called when some other object is giving us the token."""
+    def withdraw_request(self, timestamp, pid):
+        """Called when peer pid gives up its request of time 'timestamp'."""
+        self.peer_list.lock.acquire()
+        try:
+            if self.request.get(pid) != timestamp:
+                # We have not seen this request, or a newer one.
+                return
+            self.profiler.count("request_withdrawn")
+            self._remove_pending(pid)
+            self.request_arrival.pop(pid, None)
+            if self.state != NO_TOKEN and self.token.get(pid, 0) < timestamp:
+                # Nobody needs to serve this request any more.
+                self.token[pid] = timestamp
+                self.token_version = self.token_version + 1
+                self.changed_at[pid] = self.token_version
+        finally:
+            self.peer_list.lock.release()
+
+    def obtain_token(self, token, epoch=0):
+        """Called when some other object is giving us the token.
+
+        Return False if the token is a delta we cannot apply, i.e., the
+        full token should be sent instead.
+
+        """
         print("Receiving the token...")
         #
         # Your code here.
         #
         self.peer_list.lock.acquire()
-        # Remember to receive it in unprepare
-        self.token = self._unprepare(token)
-        # MOAR prints
-        print("Obtain Request: ", self.request)
-        print("Obtain Token: ", self.token)
-        print("Obtain Time: ", self.time)
         try:
-            if self.time > self.token[self.owner.id]:
-                # If we requested it, we should use it
-                self.state = TOKEN_HELD
-            else:
-                # Never requested, still received? (lucky me) Keep it
-                self.state = TOKEN_PRESENT
+            if epoch < self.epoch:
+                # The token has been regenerated since this one left.
+                self.profiler.count("stale_token_dropped")
+                return
+            self.epoch = epoch
+            if epoch != self.token_epoch:
+                # Our copy of the token is from before a regeneration.
+                self.token_version = 0
+            try:
+                # Remember to receive it in unprepare
+                token = self._unprepare(token)
+            except ValueError:
+                self.profiler.count("token_delta_refused")
+                return False
+            self.token_epoch = epoch
+            self.profiler.count("token_received")
+            self._take_token(token)
+        finally:
+            self.peer_list.lock.release()
+
+    def probe_token(self, epoch):
+        """Called by a coordinator looking for the token.
+
+        From now on, tokens older than 'epoch' are refused (if we have
+        the token, it moves to the new epoch). Return whether we have
+        the token, and our token and request dictionaries.
+
+        """
+        self.peer_list.lock.acquire()
+        try:
+            self.epoch = max(self.epoch, epoch)
+            token = list(self.token.items()) if self.token else []
+            return [self.state != NO_TOKEN, token,
+                    list(self.request.items())]
         finally:
             self.peer_list.lock.release()
 
+    def regenerate_token(self):
+        """Rebuild the token if no live peer has it.
+
+        Called on the coordinator, i.e., the live peer with the
+        smallest id.
+
+        """
+        with self.regenerating:
+            start = time.time()
+            self.peer_list.lock.acquire()
+            try:
+                if self.state != NO_TOKEN:
+                    return
+                self.epoch = self.epoch + 1
+                epoch = self.epoch
+                others = [pid for pid in self.peer_list.get_peers()
+                          if pid != self.owner.id]
+            finally:
+                self.peer_list.lock.release()
+            answers = self._gather(others, "probe_token", epoch)
+            if any(has_token for has_token, _, _ in answers.values()):
+                self.profiler.count("regeneration_aborted")
+                return
+            self.peer_list.lock.acquire()
+            try:
+                if self.state != NO_TOKEN or self.epoch != epoch:
+                    # Somebody else is regenerating it.
+                    return
+                token = dict((pid, 0) for pid in self.request)
+                for entries in [list((self.token or {}).items())] + [
+                        answer[1] for answer in answers.values()]:
+                    for pid, timestamp in entries:
+                        if pid in token:
+                            token[pid] = max(token[pid], timestamp)
+                for _, _, requests in answers.values():
+                    for pid, timestamp in requests:
+                        if pid in self.request and (timestamp >
+                                                    self.request[pid]):
+                            self.request[pid] = timestamp
+                            self.request_arrival.setdefault(pid, start)
+                            if pid != self.owner.id:
+                                self._add_pending(pid)
+                # Every entry is new to everybody.
+                self.token_epoch = epoch
+                self.token_version = self.token_version + 1
+                self.changed_at = dict((pid, self.token_version)
+                                       for pid in token)
+                self.seen = {}
+                print("Regenerated the token (epoch {})".format(epoch))
+                self.profiler.count("token_regenerated")
+                self.profiler.record("token_recovery", time.time() - start)
+                self._take_token(token)
+            finally:
+                self.peer_list.lock.release()
+
+    def rtt_row(self):
+        """Return our round trip time estimates, as [pid, seconds]."""
+        with self.rtt_lock:
+            return [[pid, min(samples)]
+                    for pid, samples in self.rtt_samples.items() if samples]
+
+    def rtt_matrix(self):
+        """Return the round trip times measured by all the live peers,
+        as [pid, rtt_row] pairs."""
+        others = [pid for pid in self.peer_list.get_peers()
+                  if pid != self.owner.id]
+        rows = self._gather(others, "rtt_row")
+        rows[self.owner.id] = self.rtt_row()
+        return sorted([pid, row] for pid, row in rows.items())
+
     def display_status(self):
         """Print the status of this peer."""
         self.peer_list.lock.acquire()
@@ -374,6 +644,265 @@ class DistributedLock(object):
             print("           token held    : {0}".format(th))
             print("Request :: {0}".format(self.request))
             print("Token   :: {0}".format(self.token))
+            print("Pending :: {0}".format(self.pending))
             print("Time    :: {0}".format(self.time))
+            print("Epoch   :: {0}".format(self.epoch))
+            print("Suspects:: {0}".format(self.detector.suspects()))
+            print("RTT     :: {0}".format(dict(
+                (pid, round(rtt, 6)) for pid, rtt in self.rtt_row())))
+            self.profiler.display()
         finally:
             self.peer_list.lock.release()
+
+    def lock_stats(self):
+        """Return the contention metrics of this peer (JSON friendly)."""
+        self.peer_list.lock.acquire()
+        try:
+            stats = self.profiler.to_dict()
+            stats["state"] = self.state
+            stats["time"] = self.time
+            stats["epoch"] = self.epoch
+            stats["suspects"] = self.detector.suspects()
+            counters = stats["counters"]
+            if counters.get("token_payloads"):
+                stats["bytes_per_hand_off"] = (counters["token_bytes"] /
+                                               counters["token_payloads"])
+            return stats
+        finally:
+            self.peer_list.lock.release()
+
+    # Private methods
+
+    def _pass_token(self):
+        """Hand the token (TOKEN_PRESENT) to the next requester, if any.
+
+        Must be called with 'peer_list.lock' held.
+
+        """
+        candidates = self._route(self._candidates())
+        self.profiler.gauge("queue_depth", len(candidates))
+        if candidates:
+            self.token[self.owner.id] = self.time
+            self.token_version = self.token_version + 1
+            self.changed_at[self.owner.id] = self.token_version
+            pid = self._hand_off(candidates)
+            if pid is not None:
+                self.state = NO_TOKEN
+                self._granted(pid)
+
+    def _request_targets(self, peers):
+        """Return the peers to send our token requests to."""
+        return [pid for pid in peers if pid != self.owner.id]
+
+    def _candidates(self):
+        """Return the peers with a pending request, in the order in
+        which they should get the token."""
+        # Go around the ring of peer ids: first the peers with an id
+        # larger than ours, then the ones with a smaller id. The pending
+        # list is sorted, so the first of them is found by bisection.
+        i = bisect.bisect_right(self.pending, self.owner.id)
+        return self.pending[i:] + self.pending[:i]
+
+    def _add_pending(self, pid):
+        """Peer pid has a request that has not been satisfied."""
+        i = bisect.bisect_left(self.pending, pid)
+        if i == len(self.pending) or self.pending[i] != pid:
+            self.pending.insert(i, pid)
+
+    def _remove_pending(self, pid):
+        i = bisect.bisect_left(self.pending, pid)
+        if i < len(self.pending) and self.pending[i] == pid:
+            del self.pending[i]
+
+    def _stub(self, pid):
+        """Return a stub to peer pid which gives up connecting after
+        rpc_timeout seconds."""
+        return orb.Stub(self.peer_list.peer(pid).address, self.rpc_timeout)
+
+    def _call(self, pid, method, *args):
+        """Call 'method' of peer pid."""
+        return self._invoke(pid, self._stub(pid), method, *args)
+
+    def _invoke(self, pid, stub, method, *args):
+        """Call 'method' of peer pid through stub, measuring the round
+        trip time."""
+        start = time.time()
+        result = self._remote(stub, method, *args)
+        with self.rtt_lock:
+            samples = self.rtt_samples.get(pid)
+            if samples is None:
+                samples = collections.deque(maxlen=16)
+                self.rtt_samples[pid] = samples
+            samples.append(time.time() - start)
+        return result
+
+    def _remote(self, stub, method, *args):
+        return getattr(stub, method)(*args)
+
+    def _rtt(self, pid):
+        """Return the round trip time estimate to peer pid (None if we
+        have not called it yet)."""
+        with self.rtt_lock:
+            samples = self.rtt_samples.get(pid)
+            return min(samples) if samples else None
+
+    def _route(self, candidates):
+        """Reorder the candidates for the token according to the routing
+        policy."""
+        if self.routing != LATENCY_ROUTING or len(candidates) < 2:
+            return candidates
+        arrival = [self.request_arrival.get(pid, 0) for pid in candidates]
+        limit = min(arrival) + self.fairness_window
+        eligible = [pid for pid, t in zip(candidates, arrival) if t <= limit]
+        # Peers we have never called go last among the eligible ones.
+        unknown = max([self._rtt(pid) or 0 for pid in eligible]) + 1
+        best = min(eligible, key=lambda pid: (
+            self._rtt(pid) if self._rtt(pid) is not None else unknown))
+        if best != candidates[0]:
+            self.profiler.count("routing_bypass")
+        return [best] + [pid for pid in candidates if pid != best]
+
+    def _call_all(self, pids, method, *args):
+        """Call 'method' of all the peers in pids in parallel.
+
+        Return the set of peers that answered within rpc_timeout.
+
+        """
+        return set(self._gather(pids, method, *args))
+
+    def _gather(self, pids, method, *args):
+        """Call 'method' of all the peers in pids in parallel.
+
+        Return a dictionary with the answers of the peers that answered
+        within rpc_timeout.
+
+        """
+        # The stubs are created here and not in the pool: the caller may
+        # hold peer_list.lock, which is needed to look the peers up.
+        futures = dict((self.pool.submit(self._invoke, pid, self._stub(pid),
+                                         method, *args), pid)
+                       for pid in pids)
+        done, _ = wait(futures, timeout=self.rpc_timeout)
+        return dict((futures[f], f.result()) for f in done
+                    if f.exception() is None)
+
+    def _send_token(self, pid):
+        """Give the token to peer pid, return False if it is dead."""
+        try:
+            base = self._delta_base(pid)
+            if base and self._send_encoded(pid, base) is not False:
+                return True
+            self._send_encoded(pid, 0)
+            return True
+        except BaseException:
+            # Remote errors come back as BaseException too.
+            print("Peer id {} unavailable".format(pid))
+            self.detector.suspect(pid)
+            return False
+
+    def _send_encoded(self, pid, base):
+        """Send the token (as a delta to version base) to peer pid."""
+        # Remember to send it in prepare
+        token = self._prepare(self.token, base)
+        self.profiler.count("token_bytes", len(json.dumps(token)))
+        self.profiler.count("token_payloads")
+        return self._call(pid, "obtain_token", token, self.epoch)
+
+    def _delta_base(self, pid):
+        """Return the token version to send peer pid a delta against,
+        or 0 for the full token."""
+        seen = self.seen.pop(pid, None)
+        if not self.delta_tokens or not seen:
+            return 0
+        epoch, version = seen
+        if epoch != self.token_epoch or not 0 < version <= self.token_version:
+            return 0
+        return version
+
+    def _seen(self):
+        """Return the [epoch, version] of the last token we have seen."""
+        if self.token is None:
+            return [0, 0]
+        return [self.token_epoch, self.token_version]
+
+    def _take_token(self, token):
+        """We have just got the token: use it or pass it on."""
+        self.token = token
+        # The token tells which of the requests we know about have been
+        # satisfied meanwhile.
+        self.pending = [pid for pid in self.pending
+                        if self.request[pid] > self.token.get(pid, 0)]
+        if (self.time > self.token[self.owner.id] and
+                self.abandoned < self.time):
+            # If we requested it, we should use it
+            self.state = TOKEN_HELD
+            self.token_arrived.notify_all()
+        else:
+            # Never requested (or gave up waiting), still received?
+            # Keep it, unless somebody else is waiting for it.
+            self.state = TOKEN_PRESENT
+            self._pass_token()
+
+    def _recover(self, timestamp, seen):
+        """We have waited too long for the token, it may be lost.
+
+        Have the coordinator regenerate the token if needed, and send
+        our request (of time 'timestamp', having seen the token 'seen')
+        again to the live peers, in case the first one got lost.
+
+        """
+        self.profiler.count("holder_suspected")
+        others = [pid for pid in self.peer_list.get_peers()
+                  if pid != self.owner.id]
+        alive = self._regenerate(others)
+        targets = [pid for pid in self._request_targets(others)
+                   if pid in alive]
+        self._call_all(targets, "request_token", timestamp, self.owner.id,
+                       seen)
+
+    def _regenerate(self, others):
+        """Have the coordinator regenerate the token if no live peer has
+        it. Return the live peers among 'others'."""
+        alive = self.detector.alive(others)
+        coordinator = min(alive | set([self.owner.id]))
+        if coordinator == self.owner.id:
+            self.regenerate_token()
+        else:
+            try:
+                self._call(coordinator, "regenerate_token")
+            except BaseException:
+                # Remote errors come back as BaseException too.
+                self.detector.suspect(coordinator)
+        return alive
+
+    def _hand_off(self, candidates):
+        """Give the token to the first live peer among candidates.
+
+        Return the peer that got the token, or None. If the first choice
+        turns out to be dead, all the remaining candidates are probed in
+        parallel instead of paying a connect timeout for each of them.
+
+        """
+        if not candidates:
+            return None
+        # Try the peers we suspect to have died last.
+        suspects = set(self.detector.suspects())
+        candidates = ([pid for pid in candidates if pid not in suspects] +
+                      [pid for pid in candidates if pid in suspects])
+        if self._send_token(candidates[0]):
+            return candidates[0]
+        alive = self._call_all(candidates[1:], "check")
+        for pid in candidates[1:]:
+            if pid in alive and self._send_token(pid):
+                return pid
+        return None
+
+    def _granted(self, pid):
+        """Account for a token hand-off to peer pid."""
+        self.profiler.count("token_sent")
+        if self._rtt(pid) is not None:
+            self.profiler.record("hand_off_rtt", self._rtt(pid))
+        if pid in self.request_arrival:
+            wait = time.time() - self.request_arrival.pop(pid)
+            self.profiler.record_peer("request_to_grant", pid, wait)
+            self.profiler.record("request_to_grant", wait)
@@ -7,18 +7,45 @@
 # Copyright 2012-2015 Linkoping University
 # -----------------------------------------------------------------------------
 
-"""Class implementing a distributed version of ReadWriteLock."""
+"""Class implementing a distributed version of ReadWriteLock.
 
+Lease mode: when lease_writes > 1, a peer may keep the distributed lock
+after a write_release as long as
+    --  other local writers (or combined operations) are already
+        waiting for it,
+    --  no other peer is waiting for the token,
+    --  fewer than lease_writes writes have been done, and for less
+        than lease_time seconds, since the token has been acquired.
+This saves a full token round for every write of a local write burst.
+
+Write combining: write_combined(operation, ...) queues the operation;
+the first writer to arrive becomes the leader and runs all the queued
+operations in a single critical section. In lease mode every batch of
+queued operations is a critical section of its own, and the lease keeps
+the token between the batches.
+
+Timeouts: write_acquire(timeout) (or try_write_acquire) gives up after
+'timeout' seconds, withdrawing the request for the token, and returns
+False. write_combined(..., timeout=...) raises LockTimeout instead.
+
+"""
+
+import time
 import threading
 from . import readWriteLock
 
 
+class LockTimeout(Exception):
+    pass
+
+
 class DistributedReadWriteLock(readWriteLock.ReadWriteLock):
 
     """Distributed version of ReadWriteLock."""
 
-    def __init__(self, distributed_lock):
-        readWriteLock.ReadWriteLock.__init__(self)
+    def __init__(self, distributed_lock, policy=readWriteLock.PHASE_FAIR,
+                 lease_writes=1, lease_time=0.1):
+        readWriteLock.ReadWriteLock.__init__(self, policy)
         # Create a distributed lock
         self.distributed_lock = distributed_lock
         #
@@ -26,14 +53,28 @@ class DistributedReadWriteLock(readWriteLock.ReadWriteLock):
         #
         # Need this threading lock to prevent other peers from accessing it
         self.lock = threading.Condition()
+        # Lease bookkeeping, protected by self.lock.
+        self.lease_writes = lease_writes
+        self.lease_time = lease_time
+        self.leased = False
+        self.lease_start = 0
+        self.lease_count = 0
+        # Local writers waiting for self.lock.
+        self.writers_pending = 0
+        self.pending_lock = threading.Lock()
+        # Operations waiting to be combined into one critical section.
+        self.combine_queue = []
+        self.combining = False
+        self.combine_lock = threading.Lock()
 
     # Public methods
 
-    def write_acquire(self):
+    def write_acquire(self, timeout=None):
         """Acquire the rights to write into the database.
 
         Override the write_acquire method to include obtaining access
-        to the rest of the peers.
+        to the rest of the peers. Wait at most 'timeout' seconds
+        (forever if None), return False if the timeout expired.
 
         """
 
@@ -42,9 +83,49 @@ class DistributedReadWriteLock(readWriteLock.ReadWriteLock):
         #
 
         #Do we need some extra precaution to avoid conflicts?
-        self.lock.acquire() #Yep
-        self.distributed_lock.acquire()
-        self.write_acquire_local()
+        deadline = None if timeout is None else time.time() + timeout
+        with self.pending_lock:
+            self.writers_pending += 1
+        if timeout is None:
+            got = self.lock.acquire() #Yep
+        else:
+            got = self.lock.acquire(True, timeout)
+        with self.pending_lock:
+            self.writers_pending -= 1
+        if not got:
+            self.profiler.count("write_timeouts")
+            return False
+        try:
+            if self.leased:
+                # The previous local writer kept the token for us.
+                self.leased = False
+                self.profiler.count("lease_reused")
+            else:
+                if not self.distributed_lock.acquire(
+                        self._remaining(deadline)):
+                    # The request has been withdrawn.
+                    self.profiler.count("write_timeouts")
+                    self.lock.release()
+                    return False
+                self.lease_start = time.time()
+                self.lease_count = 0
+            self.lease_count += 1
+            if not self.write_acquire_local(self._remaining(deadline)):
+                self.distributed_lock.release()
+                self.lock.release()
+                return False
+        except:
+            self.lock.release()
+            raise
+        return True
+
+    def try_write_acquire(self, timeout):
+        """Acquire the rights to write within 'timeout' seconds.
+
+        Return False (without holding anything) otherwise.
+
+        """
+        return self.write_acquire(timeout)
 
         # Ordering of lock acquiring/releasing is important
     def write_release(self):
@@ -58,13 +139,126 @@ class DistributedReadWriteLock(readWriteLock.ReadWriteLock):
         #
         # Your code here.
         #
-        
+
         self.write_release_local()
-        self.distributed_lock.release()
+        if self._keep_lease():
+            self.leased = True
+            # Do not sit on the token if the waiting writer never comes.
+            timer = threading.Timer(self.lease_time, self._end_lease)
+            timer.daemon = True
+            timer.start()
+        else:
+            self.distributed_lock.release()
         self.lock.release()
 
-    def write_acquire_local(self):
-        readWriteLock.ReadWriteLock.write_acquire(self)
+    def write_combined(self, operation, *args, timeout=None):
+        """Run operation(*args) holding the write lock.
+
+        Operations submitted while another one is running are combined:
+        the thread that finds nobody running them becomes the leader and
+        runs all the queued operations in one critical section. Return
+        the result of the operation (or raise its exception). Raise
+        LockTimeout if the operation could not start within 'timeout'
+        seconds.
+
+        """
+
+        entry = {"operation": operation, "args": args,
+                 "timeout": timeout, "done": threading.Event()}
+        with self.combine_lock:
+            self.combine_queue.append(entry)
+            leader = not self.combining
+            self.combining = True
+        if leader:
+            self._run_combined()
+        if not entry["done"].wait(timeout):
+            with self.combine_lock:
+                if entry in self.combine_queue:
+                    # Not picked up by the leader yet, give up.
+                    self.combine_queue.remove(entry)
+                    entry["error"] = LockTimeout("busy, retry")
+                    entry["done"].set()
+            # Otherwise the operation is running, wait for it.
+            entry["done"].wait()
+        if "error" in entry:
+            raise entry["error"]
+        return entry.get("result")
+
+    def write_acquire_local(self, timeout=None):
+        return readWriteLock.ReadWriteLock.write_acquire(self, timeout)
 
     def write_release_local(self):
         readWriteLock.ReadWriteLock.write_release(self)
+
+    # Private methods
+
+    def _remaining(self, deadline):
+        if deadline is None:
+            return None
+        return max(0, deadline - time.time())
+
+    def _keep_lease(self):
+        """Decide whether to keep the token for the next local writer."""
+        if self.lease_writes <= 1:
+            return False
+        with self.pending_lock:
+            waiting = self.writers_pending
+        with self.combine_lock:
+            waiting += len(self.combine_queue)
+        if waiting == 0:
+            return False
+        return (self.lease_count < self.lease_writes and
+                time.time() - self.lease_start < self.lease_time and
+                not self.distributed_lock.has_pending_requests())
+
+    def _end_lease(self):
+        with self.lock:
+            if self.leased:
+                self.leased = False
+                self.profiler.count("lease_expired")
+                self.distributed_lock.release()
+
+    def _run_combined(self):
+        """Run the queued operations, as the leader."""
+        while True:
+            with self.combine_lock:
+                if not self.combine_queue:
+                    self.combining = False
+                    return
+                # Wait as long as the most patient of the writers.
+                timeouts = [entry["timeout"] for entry in self.combine_queue]
+                timeout = None if None in timeouts else max(timeouts)
+            try:
+                if not self.write_acquire(timeout):
+                    raise LockTimeout("busy, retry")
+            except Exception as e:
+                with self.combine_lock:
+                    batch, self.combine_queue = self.combine_queue, []
+                    self.combining = False
+                for entry in batch:
+                    entry["error"] = e
+                    entry["done"].set()
+                return
+            try:
+                # Keep on combining as long as nobody else needs the token.
+                while True:
+                    with self.combine_lock:
+                        batch, self.combine_queue = self.combine_queue, []
+                    if not batch:
+                        break
+                    self.profiler.count("combined_writes", len(batch))
+                    self.profiler.gauge("combined_batch", len(batch))
+                    for entry in batch:
+                        try:
+                            entry["result"] = entry["operation"](
+                                *entry["args"])
+                        except Exception as e:
+                            entry["error"] = e
+                        entry["done"].set()
+                    # In lease mode the lease decides whether to keep
+                    # the token for the next batch.
+                    if (self.lease_writes > 1 or
+                            self.distributed_lock.has_pending_requests()):
+                        break
+            finally:
+                self.write_release()
@@ -0,0 +1,86 @@
+# -----------------------------------------------------------------------------
+# Distributed Systems (TDDD25)
+# -----------------------------------------------------------------------------
+# Author: Sergiu Rafiliu (sergiu.rafiliu@liu.se)
+# Modified: 31 July 2013
+#
+# Copyright 2012 Linkoping University
+# -----------------------------------------------------------------------------
+
+"""Timeout based failure detector for the peers of a distributed lock.
+
+Every message we get from a peer tells us it was alive at that time.
+Peers we have not heard from for more than 'fresh' seconds, and peers
+whose calls failed, are pinged before being reported alive. A peer that
+does not answer a ping within the timeout of the ping function is
+suspected until we hear from it again.
+
+"""
+
+import time
+import threading
+
+
+class FailureDetector(object):
+
+    """Keep track of which peers are (probably) alive.
+
+    Public methods:
+        --  __init__(ping, fresh=1.0)
+        --  heard(pid)
+        --  suspect(pid)
+        --  forget(pid)
+        --  alive(pids)
+        --  suspects()
+
+    """
+
+    def __init__(self, ping, fresh=1.0):
+        # ping(pids) returns the set of pids that answered.
+        self.ping = ping
+        self.fresh = fresh
+        self.last_heard = {}
+        self.suspected = set()
+        self.lock = threading.Lock()
+
+    # Public methods
+
+    def heard(self, pid):
+        """A message from peer pid has just arrived."""
+        with self.lock:
+            self.last_heard[pid] = time.time()
+            self.suspected.discard(pid)
+
+    def suspect(self, pid):
+        """A call to peer pid has just failed."""
+        with self.lock:
+            self.suspected.add(pid)
+
+    def forget(self, pid):
+        """Peer pid has left the system."""
+        with self.lock:
+            self.last_heard.pop(pid, None)
+            self.suspected.discard(pid)
+
+    def alive(self, pids):
+        """Return the set of peers among pids that are alive."""
+        now = time.time()
+        with self.lock:
+            recent = set(pid for pid in pids
+                         if pid not in self.suspected and
+                         now - self.last_heard.get(pid, 0) < self.fresh)
+        others = [pid for pid in pids if pid not in recent]
+        answered = self.ping(others) if others else set()
+        with self.lock:
+            for pid in others:
+                if pid in answered:
+                    self.last_heard[pid] = now
+                    self.suspected.discard(pid)
+                else:
+                    self.suspected.add(pid)
+        return recent | answered
+
+    def suspects(self):
+        """Return the peers currently suspected to have died."""
+        with self.lock:
+            return sorted(self.suspected)
@@ -0,0 +1,262 @@
+# -----------------------------------------------------------------------------
+# Distributed Systems (TDDD25)
+# -----------------------------------------------------------------------------
+# Author: Sergiu Rafiliu (sergiu.rafiliu@liu.se)
+# Modified: 31 July 2013
+#
+# Copyright 2012 Linkoping University
+# -----------------------------------------------------------------------------
+
+"""Many independent named distributed locks over one peer group.
+
+Each name has its own token, request dictionary and state (a NamedLock,
+i.e., a DistributedLock whose messages carry the name of the lock). The
+messages of all the names go through the same two RMI methods of the
+manager, request_named_token and obtain_named_token.
+
+The state of a name is created lazily, the first time the name is used
+locally or mentioned by another peer, and without the token: only the
+other peers know whether the token of that name already exists (the
+peer that created it may have left since). Before the first acquire of
+a name, we ask the coordinator to regenerate its token, see
+DistributedLock: the coordinator probes the live peers with a new epoch
+and creates the token only if none of them has it, so that there is
+never more than one token per name.
+
+The state of a name is dropped once it has been idle for a while and
+we do not hold its token. Only our logical clock and token epoch for
+that name are kept.
+To make this safe, the token carries the requests that are still
+pending, so that its next holder learns about requests it has missed
+while its state was dropped.
+
+"""
+
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .distributedLock import DistributedLock, NO_TOKEN
+
+NAMED_METHODS = {
+    "request_token": "request_named_token",
+    "obtain_token": "obtain_named_token",
+    "withdraw_request": "withdraw_named_request",
+    "probe_token": "probe_named_token",
+    "regenerate_token": "regenerate_named_token"
+}
+
+
+class NamedLock(DistributedLock):
+
+    """State of one named lock."""
+
+    def __init__(self, name, owner, peer_list, **kwargs):
+        DistributedLock.__init__(self, owner, peer_list, **kwargs)
+        self.name = name
+        self.last_used = time.time()
+        # Number of local acquires in progress (or locks held).
+        self.users = 0
+        # True until we have made sure the token of this name exists.
+        self.fresh = False
+
+    def initialize(self):
+        self.peer_list.lock.acquire()
+        try:
+            for pid in self.peer_list.get_peers():
+                self.request[pid] = 0
+            self.request[self.owner.id] = 0
+            self.fresh = True
+        finally:
+            self.peer_list.lock.release()
+
+    def acquire(self, timeout=None):
+        self.peer_list.lock.acquire()
+        try:
+            fresh, self.fresh = self.fresh, False
+            others = [pid for pid in self.peer_list.get_peers()
+                      if pid != self.owner.id]
+        finally:
+            self.peer_list.lock.release()
+        if fresh:
+            self._regenerate(others)
+        return DistributedLock.acquire(self, timeout)
+
+    def resume(self, clock, epoch):
+        """Recreate the state of a lock that has been garbage collected."""
+        self.peer_list.lock.acquire()
+        try:
+            for pid in self.peer_list.get_peers():
+                self.request[pid] = 0
+            # None of our earlier requests is still wanted.
+            self.time = self.abandoned = clock
+            self.request[self.owner.id] = clock
+            self.epoch = epoch
+        finally:
+            self.peer_list.lock.release()
+
+    def idle(self, since):
+        """Return True if the state of this lock can be dropped."""
+        return (self.state == NO_TOKEN and self.users == 0 and
+                self.last_used < since)
+
+    # Private methods
+
+    def _prepare(self, token, base=0):
+        # Send the pending requests along with the token.
+        pending = [(pid, self.request[pid]) for pid in self.pending]
+        return [DistributedLock._prepare(self, token, base), pending]
+
+    def _unprepare(self, token):
+        encoded, pending = token
+        for pid, timestamp in pending:
+            if timestamp > self.request.get(pid, 0):
+                self.request[pid] = timestamp
+                if pid != self.owner.id:
+                    self._add_pending(pid)
+        return DistributedLock._unprepare(self, encoded)
+
+    def _remote(self, stub, method, *args):
+        # Multiplex the messages of all the names, e.g., request_token
+        # goes to request_named_token(name, ...).
+        if method in NAMED_METHODS:
+            return getattr(stub, NAMED_METHODS[method])(self.name, *args)
+        return DistributedLock._remote(self, stub, method, *args)
+
+
+class LockManager(object):
+
+    """Named distributed locks for a list of peers.
+
+    Public methods:
+        --  __init__(owner, peer_list)
+        --  destroy()
+        --  register_peer(pid)
+        --  unregister_peer(pid)
+        --  acquire(name, timeout=None)
+        --  release(name)
+        --  request_named_token(name, timestamp, pid, seen=None)
+        --  withdraw_named_request(name, timestamp, pid)
+        --  obtain_named_token(name, token, epoch=0)
+        --  probe_named_token(name, epoch)
+        --  regenerate_named_token(name)
+        --  display_status()
+        --  lock_stats()
+
+    """
+
+    def __init__(self, owner, peer_list, gc_idle=60.0, max_parallel=16):
+        self.owner = owner
+        self.peer_list = peer_list
+        self.gc_idle = gc_idle
+        # All the names share one pool for their remote calls.
+        self.pool = ThreadPoolExecutor(max_workers=max_parallel)
+        self.locks = {}
+        # Logical clocks and epochs of the names whose state has been
+        # dropped.
+        self.retired = {}
+        self.collector = threading.Thread(target=self._collect)
+        self.collector.daemon = True
+        self.collector.start()
+
+    # Public methods
+
+    def destroy(self):
+        """Hand over all the tokens we have."""
+        for lock in self._all():
+            lock.destroy()
+
+    def register_peer(self, pid):
+        for lock in self._all():
+            lock.register_peer(pid)
+
+    def unregister_peer(self, pid):
+        for lock in self._all():
+            lock.unregister_peer(pid)
+
+    def acquire(self, name, timeout=None):
+        lock = self._lock(name, use=True)
+        if lock.acquire(timeout):
+            return True
+        self._done(lock)
+        return False
+
+    def release(self, name):
+        lock = self._lock(name)
+        if lock.release():
+            self._done(lock)
+
+    def request_named_token(self, name, timestamp, pid, seen=None):
+        self._lock(name).request_token(timestamp, pid, seen)
+
+    def withdraw_named_request(self, name, timestamp, pid):
+        self._lock(name).withdraw_request(timestamp, pid)
+
+    def obtain_named_token(self, name, token, epoch=0):
+        self._lock(name).obtain_token(token, epoch)
+
+    def probe_named_token(self, name, epoch):
+        return self._lock(name).probe_token(epoch)
+
+    def regenerate_named_token(self, name):
+        self._lock(name).regenerate_token()
+
+    def display_status(self):
+        for lock in self._all():
+            print("Lock '{}':".format(lock.name))
+            lock.display_status()
+        print("Collected :: {}".format(sorted(self.retired.keys())))
+
+    def lock_stats(self):
+        return dict((lock.name, lock.lock_stats()) for lock in self._all())
+
+    # Private methods
+
+    def _all(self):
+        self.peer_list.lock.acquire()
+        try:
+            return list(self.locks.values())
+        finally:
+            self.peer_list.lock.release()
+
+    def _lock(self, name, use=False):
+        """Return the state of lock 'name', creating it if needed."""
+        self.peer_list.lock.acquire()
+        try:
+            lock = self.locks.get(name)
+            if lock is None:
+                lock = NamedLock(name, self.owner, self.peer_list,
+                                 pool=self.pool)
+                if name in self.retired:
+                    lock.resume(*self.retired.pop(name))
+                else:
+                    lock.initialize()
+                self.locks[name] = lock
+            lock.last_used = time.time()
+            if use:
+                lock.users += 1
+            return lock
+        finally:
+            self.peer_list.lock.release()
+
+    def _done(self, lock):
+        self.peer_list.lock.acquire()
+        try:
+            lock.users -= 1
+            lock.last_used = time.time()
+        finally:
+            self.peer_list.lock.release()
+
+    def _collect(self):
+        """Periodically drop the state of the idle locks."""
+        while True:
+            time.sleep(self.gc_idle / 2)
+            since = time.time() - self.gc_idle
+            self.peer_list.lock.acquire()
+            try:
+                for name, lock in list(self.locks.items()):
+                    if lock.idle(since):
+                        self.retired[name] = (lock.time, lock.epoch)
+                        del self.locks[name]
+            finally:
+                self.peer_list.lock.release()
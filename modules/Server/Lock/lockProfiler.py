@@ -0,0 +1,153 @@
+# -----------------------------------------------------------------------------
+# Distributed Systems (TDDD25)
+# -----------------------------------------------------------------------------
+# Author: Sergiu Rafiliu (sergiu.rafiliu@liu.se)
+# Modified: 31 July 2013
+#
+# Copyright 2012 Linkoping University
+# -----------------------------------------------------------------------------
+
+"""Contention instrumentation shared by the lock implementations.
+
+A LockProfiler collects:
+    --  histograms of durations (e.g., acquire wait and hold times),
+    --  per-peer histograms (e.g., request-to-grant latency of each
+        requesting peer),
+    --  counters (e.g., token hand-offs),
+    --  gauges with their maximum (e.g., queue depths).
+
+Everything is kept in plain dictionaries so that to_dict() can be sent
+as is over the network (JSON) and display() can print it.
+
+"""
+
+import threading
+
+# Upper bounds (in seconds) of the histogram buckets: 10us, 20us, 40us,
+# ... up to about 84s. Anything above goes into an overflow bucket.
+BUCKETS = [0.00001 * 2 ** i for i in range(24)]
+
+
+class Histogram(object):
+
+    """Logarithmic histogram of durations."""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        index = 0
+        while index < len(BUCKETS) and value > BUCKETS[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        """Return an upper bound of the p-th percentile (0 < p <= 100)."""
+
+        if self.count == 0:
+            return 0.0
+        rank = self.count * p / 100.0
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                if index < len(BUCKETS):
+                    return min(BUCKETS[index], self.max)
+                return self.max
+        return self.max
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0.0,
+            "max": self.max,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+            # Only the non-empty buckets, keyed by their upper bound.
+            "buckets": dict(
+                ("{:g}".format(BUCKETS[i]) if i < len(BUCKETS) else "inf", c)
+                for i, c in enumerate(self.counts) if c)
+        }
+
+
+class LockProfiler(object):
+
+    """Thread-safe collection of lock contention metrics."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.per_peer = {}
+        self.counters = {}
+        self.gauges = {}
+
+    # Public methods
+
+    def record(self, name, value):
+        """Add a duration to the histogram 'name'."""
+
+        with self.lock:
+            self.histograms.setdefault(name, Histogram()).add(value)
+
+    def record_peer(self, name, pid, value):
+        """Add a duration to the histogram 'name' of peer 'pid'."""
+
+        with self.lock:
+            peers = self.per_peer.setdefault(name, {})
+            peers.setdefault(pid, Histogram()).add(value)
+
+    def count(self, name, n=1):
+        """Increment the counter 'name'."""
+
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def gauge(self, name, value):
+        """Set the current value of the gauge 'name'."""
+
+        with self.lock:
+            current, maximum = self.gauges.get(name, (0, 0))
+            self.gauges[name] = (value, max(value, maximum))
+
+    def to_dict(self):
+        """Return all the metrics in a JSON friendly form."""
+
+        with self.lock:
+            return {
+                "histograms": dict((name, h.to_dict())
+                                   for name, h in self.histograms.items()),
+                "per_peer": dict(
+                    (name, dict((pid, h.to_dict())
+                                for pid, h in peers.items()))
+                    for name, peers in self.per_peer.items()),
+                "counters": dict(self.counters),
+                "gauges": dict((name, {"current": c, "max": m})
+                               for name, (c, m) in self.gauges.items())
+            }
+
+    def display(self):
+        """Print a summary of the metrics."""
+
+        stats = self.to_dict()
+        for name, h in sorted(stats["histograms"].items()):
+            print("{:<24}:: count {}, mean {:.6f}s, p95 {:.6f}s, "
+                  "max {:.6f}s".format(name, h["count"], h["mean"],
+                                       h["p95"], h["max"]))
+        for name, peers in sorted(stats["per_peer"].items()):
+            for pid, h in sorted(peers.items()):
+                print("{:<24}:: peer {}, count {}, mean {:.6f}s, "
+                      "max {:.6f}s".format(name, pid, h["count"],
+                                           h["mean"], h["max"]))
+        for name, value in sorted(stats["counters"].items()):
+            print("{:<24}:: {}".format(name, value))
+        for name, g in sorted(stats["gauges"].items()):
+            print("{:<24}:: current {}, max {}".format(
+                name, g["current"], g["max"]))
@@ -0,0 +1,433 @@
+# -----------------------------------------------------------------------------
+# Distributed Systems (TDDD25)
+# -----------------------------------------------------------------------------
+# Author: Sergiu Rafiliu (sergiu.rafiliu@liu.se)
+# Modified: 31 July 2013
+#
+# Copyright 2012 Linkoping University
+# -----------------------------------------------------------------------------
+
+"""Alternative distributed mutual exclusion algorithms.
+
+All the algorithms expose the same surface as DistributedLock
+(acquire, release, request_token, obtain_token, ...), so that
+mutexPeer.py and DistributedReadWriteLock can use any of them:
+    --  ricart-agrawala :: DistributedLock itself. Every acquire
+        broadcasts N-1 requests, the token goes around the ring of
+        peer ids.
+    --  suzuki-kasami :: same broadcast, but the token carries a FIFO
+        queue of the requesters, which are served in the order in
+        which the holders learn about them.
+    --  raymond :: the peers form a tree, requests and the token travel
+        along its edges only, i.e., O(log N) messages per acquire.
+    --  central :: the peer with the smallest id is the lock manager.
+        An acquire costs a request, a grant and a release message.
+
+The number of messages sent by each peer can be compared through the
+'request_sent' and 'token_sent' counters of lock_stats().
+
+"""
+
+import time
+import collections
+
+from .distributedLock import (DistributedLock,
+                              NO_TOKEN, TOKEN_PRESENT, TOKEN_HELD)
+
+
+class SuzukiKasamiLock(DistributedLock):
+
+    """Suzuki-Kasami: the token carries a queue of waiting requesters.
+
+    The request dictionary plays the role of RN and the token dictionary
+    the role of LN. On release, the holder appends every peer with an
+    outstanding request that is not already queued to the queue of the
+    token, and hands the token to the head of the queue.
+
+    """
+
+    def __init__(self, owner, peer_list, **kwargs):
+        DistributedLock.__init__(self, owner, peer_list, **kwargs)
+        self.queue = []
+
+    def unregister_peer(self, pid):
+        DistributedLock.unregister_peer(self, pid)
+        self.peer_list.lock.acquire()
+        try:
+            if pid in self.queue:
+                self.queue.remove(pid)
+        finally:
+            self.peer_list.lock.release()
+
+    def withdraw_request(self, timestamp, pid):
+        DistributedLock.withdraw_request(self, timestamp, pid)
+        self.peer_list.lock.acquire()
+        try:
+            if pid in self.queue and pid not in self.pending:
+                self.queue.remove(pid)
+        finally:
+            self.peer_list.lock.release()
+
+    def display_status(self):
+        DistributedLock.display_status(self)
+        print("Queue   :: {0}".format(self.queue))
+
+    # Private methods
+
+    def _prepare(self, token, base=0):
+        return [DistributedLock._prepare(self, token, base), self.queue]
+
+    def _unprepare(self, token):
+        ln, queue = token
+        ln = DistributedLock._unprepare(self, ln)
+        self.queue = queue
+        return ln
+
+    def _candidates(self):
+        for pid in self.pending:
+            if pid not in self.queue:
+                self.queue.append(pid)
+        return list(self.queue)
+
+    def _send_token(self, pid):
+        # The token must leave without its new holder in the queue. If
+        # the peer is dead it does not get back in the queue either.
+        if pid in self.queue:
+            self.queue.remove(pid)
+        return DistributedLock._send_token(self, pid)
+
+
+class CentralLock(DistributedLock):
+
+    """Centralized algorithm: a lock manager owns the token.
+
+    The manager is the peer with the smallest id. Requests are sent only
+    to it, it grants the token to the requesters in the order in which
+    their requests arrived, and every holder gives the token back to the
+    manager when it releases the lock. When the manager leaves, it hands
+    the token to the peer with the smallest id, the next manager. Peers
+    suspected to have died cannot be the manager.
+
+    """
+
+    # Private methods
+
+    def _manager(self):
+        suspects = set(self.detector.suspects())
+        return min([pid for pid in self.peer_list.peers.keys()
+                    if pid not in suspects] + [self.owner.id])
+
+    def _request_targets(self, peers):
+        manager = self._manager()
+        return [] if manager == self.owner.id else [manager]
+
+    def _candidates(self):
+        manager = self._manager()
+        if manager != self.owner.id:
+            # Always give the token back to the manager.
+            return [manager]
+        return sorted(self.pending,
+                      key=lambda pid: self.request_arrival.get(pid, 0))
+
+
+class RaymondLock(DistributedLock):
+
+    """Raymond's tree-based algorithm.
+
+    The peers form a binary tree (heap order over the sorted peer ids)
+    and each of them only knows 'holder', its neighbour in the direction
+    of the token, and 'queue', the neighbours (or itself) waiting for
+    the token. Requests travel along the tree towards the token, which
+    travels back along the same path.
+
+    Messages are sent asynchronously but in order for each neighbour,
+    so that no remote call is made while holding peer_list.lock (two
+    neighbours sending to each other would otherwise deadlock).
+
+    Peers that join attach themselves to their parent in the tree. The
+    algorithm is best suited to a stable group. A peer that leaves tells
+    the others its own holder (redirect), and the peers that pointed to
+    it point there instead, which keeps the tree free of cycles. A token
+    that still reaches it is passed on there too. The token is not
+    regenerated if its holder dies, and a peer that dies cuts the peers
+    pointing to it off the token.
+
+    """
+
+    def __init__(self, owner, peer_list, **kwargs):
+        DistributedLock.__init__(self, owner, peer_list, **kwargs)
+        self.holder = None
+        self.queue = []
+        self.asked = False
+        # Messages not yet delivered, for each neighbour.
+        self.outbox = {}
+        # Once we leave, the holder we have told the others about.
+        self.leaving = None
+
+    def initialize(self):
+        self.peer_list.lock.acquire()
+        try:
+            peers = sorted(list(self.peer_list.peers.keys()) +
+                           [self.owner.id])
+            position = peers.index(self.owner.id)
+            self.token = {}
+            if position == 0:
+                self.holder = self.owner.id
+                self.state = TOKEN_PRESENT
+            else:
+                self.holder = peers[(position - 1) // 2]
+        finally:
+            self.peer_list.lock.release()
+
+    def destroy(self):
+        self.peer_list.lock.acquire()
+        try:
+            if self.holder == self.owner.id:
+                self._leave()
+            self.leaving = self.holder
+            others = [pid for pid in self.peer_list.peers.keys()
+                      if pid != self.owner.id]
+        finally:
+            self.peer_list.lock.release()
+        # Not holding peer_list.lock: the others may be calling us.
+        self._call_all(others, "redirect", self.owner.id, self.leaving)
+
+    def register_peer(self, pid):
+        # A new peer attaches itself to the tree when it sends its
+        # first request, there is nothing to do here.
+        pass
+
+    def unregister_peer(self, pid):
+        self.peer_list.lock.acquire()
+        try:
+            if pid in self.queue:
+                self.queue.remove(pid)
+            # The messages still queued for pid (maybe the token) are
+            # taken back by _deliver, which cannot find pid any more.
+            self.request_arrival.pop(pid, None)
+            # If we still point to pid, it has not told us where to go
+            # instead (redirect): we cannot reach the token any more.
+        finally:
+            self.peer_list.lock.release()
+
+    def redirect(self, pid, holder):
+        self.peer_list.lock.acquire()
+        try:
+            if self.holder != pid or holder == self.owner.id:
+                # Not our way to the token, or the token is on its way
+                # back to us.
+                return
+            # Our request, if any, has left with pid: ask again.
+            self.holder = holder
+            self.asked = False
+            self._make_request()
+        finally:
+            self.peer_list.lock.release()
+
+    def acquire(self, timeout=None):
+        print("Trying to acquire the lock...")
+        start = time.time()
+        self.peer_list.lock.acquire()
+        try:
+            self.cancelled = False
+            self.time = self.time + 1
+            self.queue.append(self.owner.id)
+            self._assign_privilege()
+            self._make_request()
+            self.token_arrived.wait_for(
+                lambda: self.state == TOKEN_HELD or self.cancelled, timeout)
+            if self.state != TOKEN_HELD:
+                # Give up. If the token still comes our way, it stays
+                # here or goes on to the next neighbour in the queue.
+                if self.owner.id in self.queue:
+                    self.queue.remove(self.owner.id)
+                self.profiler.count("acquire_abandoned")
+                return False
+            self.acquired_at = time.time()
+            self.profiler.record("acquire_wait", self.acquired_at - start)
+            return True
+        finally:
+            self.peer_list.lock.release()
+
+    def release(self):
+        print("Releasing the lock...")
+        self.peer_list.lock.acquire()
+        try:
+            if self.state != TOKEN_HELD:
+                print("The lock is not held, nothing to release.")
+                return False
+            if self.acquired_at is not None:
+                self.profiler.record("hold", time.time() - self.acquired_at)
+                self.acquired_at = None
+            if self.holder == self.owner.id:
+                self.state = TOKEN_PRESENT
+            self._assign_privilege()
+            self._make_request()
+            return True
+        finally:
+            self.peer_list.lock.release()
+
+    def request_token(self, timestamp, pid, seen=None):
+        print("Received a request from peer {}".format(pid))
+        self.peer_list.lock.acquire()
+        try:
+            self.profiler.count("request_received")
+            if self.leaving is not None:
+                # It asks again once we have redirected it.
+                return
+            if pid not in self.queue:
+                self.request_arrival[pid] = time.time()
+                self.queue.append(pid)
+            self._assign_privilege()
+            self._make_request()
+        finally:
+            self.peer_list.lock.release()
+
+    def obtain_token(self, token, epoch=0):
+        print("Receiving the token...")
+        self.peer_list.lock.acquire()
+        try:
+            self.profiler.count("token_received")
+            self.holder = self.owner.id
+            self.state = TOKEN_PRESENT
+            if self.leaving is not None:
+                # Sent before the others knew we leave: pass it on to
+                # the holder we have told them about.
+                self._leave(self.leaving)
+                return
+            self._assign_privilege()
+            self._make_request()
+        finally:
+            self.peer_list.lock.release()
+
+    def has_pending_requests(self):
+        self.peer_list.lock.acquire()
+        try:
+            return any(pid != self.owner.id for pid in self.queue)
+        finally:
+            self.peer_list.lock.release()
+
+    def display_status(self):
+        DistributedLock.display_status(self)
+        print("Holder  :: {0}".format(self.holder))
+        print("Queue   :: {0}".format(self.queue))
+
+    # Private methods
+
+    def _leave(self, first=None):
+        """Hand the token over to the others, we are leaving."""
+        others = sorted(pid for pid in self.peer_list.peers.keys()
+                        if pid != self.owner.id)
+        waiting = [pid for pid in [first] + self.queue
+                   if pid not in (None, self.owner.id)]
+        pid = self._hand_off(waiting + [pid for pid in others
+                                        if pid not in waiting])
+        if pid is not None:
+            self.profiler.count("token_sent")
+            self.holder = pid
+        self.state = NO_TOKEN
+
+    def _assign_privilege(self):
+        """Pass the token on (or use it) if it is here and wanted."""
+        if (self.holder == self.owner.id and self.state != TOKEN_HELD and
+                self.queue):
+            head = self.queue.pop(0)
+            self.asked = False
+            if head == self.owner.id:
+                self.state = TOKEN_HELD
+                self.token_arrived.notify_all()
+            else:
+                self.holder = head
+                self.state = NO_TOKEN
+                self._granted(head)
+                self._post(head, "obtain_token", self._prepare(self.token))
+
+    def _make_request(self):
+        """Ask for the token on behalf of the queue, once."""
+        if self.holder != self.owner.id and self.queue and not self.asked:
+            self.asked = True
+            self.profiler.count("request_sent")
+            self._post(self.holder, "request_token", self.time,
+                       self.owner.id)
+
+    def _post(self, pid, method, *args):
+        """Queue a message to neighbour pid."""
+        outbox = self.outbox.setdefault(pid, collections.deque())
+        outbox.append((method, args))
+        if len(outbox) == 1:
+            self.pool.submit(self._deliver, pid)
+
+    def _undelivered(self, pid, outbox):
+        """Take back the messages to pid that could not be sent."""
+        if self.outbox.get(pid) is outbox:
+            del self.outbox[pid]
+        for method, args in outbox:
+            if method == "obtain_token":
+                # The token never left, take it back.
+                self.holder = self.owner.id
+                self.state = TOKEN_PRESENT
+            else:
+                self.asked = False
+        if self.leaving is not None and self.holder == self.owner.id:
+            self._leave(self.leaving)
+            return
+        self._assign_privilege()
+        if self.holder != pid:
+            self._make_request()
+
+    def _deliver(self, pid):
+        """Send the queued messages to neighbour pid, in order."""
+        while True:
+            self.peer_list.lock.acquire()
+            try:
+                outbox = self.outbox.get(pid)
+                if not outbox:
+                    return
+                method, args = outbox[0]
+                try:
+                    stub = self._stub(pid)
+                except Exception:
+                    # The peer has left the group meanwhile.
+                    stub = None
+            finally:
+                self.peer_list.lock.release()
+            try:
+                if stub is None:
+                    raise KeyError(pid)
+                self._invoke(pid, stub, method, *args)
+            except BaseException:
+                # Remote errors come back as BaseException too.
+                print("Peer id {} unavailable".format(pid))
+                self.peer_list.lock.acquire()
+                try:
+                    self._undelivered(pid, outbox)
+                finally:
+                    self.peer_list.lock.release()
+                return
+            self.peer_list.lock.acquire()
+            try:
+                outbox.popleft()
+                if not outbox:
+                    # From now on _post starts a new delivery.
+                    if self.outbox.get(pid) is outbox:
+                        del self.outbox[pid]
+                    return
+            finally:
+                self.peer_list.lock.release()
+
+
+ALGORITHMS = {
+    "ricart-agrawala": DistributedLock,
+    "suzuki-kasami": SuzukiKasamiLock,
+    "raymond": RaymondLock,
+    "central": CentralLock
+}
+
+
+def create_lock(algorithm, owner, peer_list, **kwargs):
+    """Create a distributed lock using the given algorithm."""
+
+    if algorithm not in ALGORITHMS:
+        raise ValueError("Unknown mutual exclusion algorithm '{}'".format(
+            algorithm))
+    return ALGORITHMS[algorithm](owner, peer_list, **kwargs)
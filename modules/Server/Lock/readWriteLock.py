@@ -9,7 +9,16 @@
 
 """Class implementing a readers-writers lock."""
 
+import time
 import threading
+import collections
+
+from .lockProfiler import LockProfiler
+
+# Policies deciding who goes first when both readers and writers wait.
+READER_PREFERRING = "reader-preferring"
+WRITER_PREFERRING = "writer-preferring"
+PHASE_FAIR = "phase-fair"
 
 
 class ReadWriteLock(object):
@@ -25,31 +34,165 @@ class ReadWriteLock(object):
             reading the resource,
         --  only one writer is allowed to modify the resource and all
             other existing readers and writers are blocked.
+
+    Writers are always served in FIFO order. What happens when both
+    readers and writers are waiting depends on the policy:
+        --  READER_PREFERRING :: readers enter as long as no writer is
+            writing, writers may starve,
+        --  WRITER_PREFERRING :: a waiting writer blocks all new
+            readers, readers may starve,
+        --  PHASE_FAIR :: read and write phases alternate. A reader
+            that arrives while a writer is present waits for that
+            writer only, after which all such readers enter together
+            before the next writer.
+
+    All the acquire methods accept an optional timeout (in seconds) and
+    return False if the lock could not be acquired in time.
+
     """
 
-    def __init__(self):
+    def __init__(self, policy=PHASE_FAIR):
+        if policy not in (READER_PREFERRING, WRITER_PREFERRING, PHASE_FAIR):
+            raise ValueError("Unknown policy '{}'".format(policy))
+        self.policy = policy
+        self.cond = threading.Condition()
         self.reader_count = 0
-        self.reader_lock = threading.Lock()
-        self.writer_lock = threading.Lock()
+        self.readers_waiting = 0
+        self.writer_active = False
+        # Waiting writers, in arrival order.
+        self.writer_queue = collections.deque()
+        # Phase-fair bookkeeping: number of completed write phases, the
+        # number of waiting readers per write phase they wait for, and
+        # the number of waiting readers already entitled to enter.
+        self.writes_done = 0
+        self.readers_by_phase = {}
+        self.readers_entitled = 0
+        self.profiler = LockProfiler()
+        # Acquire times of the current holders, to measure hold times.
+        # They are kept on the lock, not per thread: a lock may be
+        # released by another thread than the one that acquired it.
+        # Reads are paired with their releases in FIFO order.
+        self.read_starts = collections.deque()
+        self.write_start = None
 
     # Public methods
 
-    def read_acquire(self):
-        self.reader_lock.acquire()
-        if self.reader_count == 0:
-            self.writer_lock.acquire()
-        self.reader_count = self.reader_count + 1
-        self.reader_lock.release()
+    def read_acquire(self, timeout=None):
+        start = time.time()
+        with self.cond:
+            if self._reader_may_enter():
+                self._read_granted(start)
+                return True
+            self.readers_waiting += 1
+            self._note_queues()
+            phase = None
+            if self.policy == PHASE_FAIR:
+                # Wait for the writer currently present to be done.
+                phase = self.writes_done + 1
+                self.readers_by_phase[phase] = (
+                    self.readers_by_phase.get(phase, 0) + 1)
+            try:
+                if phase is None:
+                    ok = self.cond.wait_for(self._reader_may_enter, timeout)
+                else:
+                    ok = self.cond.wait_for(
+                        lambda: not self.writer_active and
+                        (self.writes_done >= phase or
+                         not self.writer_queue), timeout)
+            finally:
+                self.readers_waiting -= 1
+                if phase is not None:
+                    if self.writes_done >= phase:
+                        self.readers_entitled -= 1
+                    else:
+                        self.readers_by_phase[phase] -= 1
+                self._note_queues()
+            if not ok:
+                self.profiler.count("read_timeouts")
+                # Writers may have been waiting for us to enter.
+                self.cond.notify_all()
+                return False
+            self._read_granted(start)
+            return True
 
     def read_release(self):
-        self.reader_lock.acquire()
-        self.reader_count = self.reader_count - 1
-        if self.reader_count == 0:
-            self.writer_lock.release()
-        self.reader_lock.release()
+        with self.cond:
+            self.reader_count = self.reader_count - 1
+            if self.reader_count == 0:
+                self.cond.notify_all()
+            start = self.read_starts.popleft() if self.read_starts else None
+        # Released first, so that profiling can never keep the lock.
+        if start is not None:
+            self.profiler.record("read_hold", time.time() - start)
 
-    def write_acquire(self):
-        self.writer_lock.acquire()
+    def write_acquire(self, timeout=None):
+        start = time.time()
+        with self.cond:
+            ticket = object()
+            self.writer_queue.append(ticket)
+            self._note_queues()
+            if self.reader_count > 0:
+                self.profiler.count("writes_blocked_by_readers")
+            ok = self.cond.wait_for(
+                lambda: self._writer_may_enter(ticket), timeout)
+            self.writer_queue.remove(ticket)
+            self._note_queues()
+            if not ok:
+                self.profiler.count("write_timeouts")
+                # The writers (or readers) behind us may go on now.
+                self.cond.notify_all()
+                return False
+            self.writer_active = True
+            self.write_start = time.time()
+            self.profiler.record("write_wait", self.write_start - start)
+            return True
 
     def write_release(self):
-        self.writer_lock.release()
+        with self.cond:
+            self.writer_active = False
+            self.writes_done += 1
+            # Readers that waited for this write phase may enter now.
+            self.readers_entitled += self.readers_by_phase.pop(
+                self.writes_done, 0)
+            self.cond.notify_all()
+            start, self.write_start = self.write_start, None
+        # Released first, so that profiling can never keep the lock.
+        if start is not None:
+            self.profiler.record("write_hold", time.time() - start)
+
+    def stats(self):
+        """Return the wait time, hold time and queue length statistics."""
+
+        with self.cond:
+            stats = self.profiler.to_dict()
+            stats["policy"] = self.policy
+            stats["readers"] = self.reader_count
+            stats["readers_waiting"] = self.readers_waiting
+            stats["writers_waiting"] = len(self.writer_queue)
+            return stats
+
+    # Private methods
+
+    def _reader_may_enter(self):
+        if self.writer_active:
+            return False
+        if self.policy == READER_PREFERRING:
+            return True
+        return len(self.writer_queue) == 0
+
+    def _writer_may_enter(self, ticket):
+        return (not self.writer_active and self.reader_count == 0 and
+                self.writer_queue[0] is ticket and
+                (self.policy != READER_PREFERRING or
+                 self.readers_waiting == 0) and
+                (self.policy != PHASE_FAIR or self.readers_entitled == 0))
+
+    def _read_granted(self, start):
+        self.reader_count = self.reader_count + 1
+        now = time.time()
+        self.read_starts.append(now)
+        self.profiler.record("read_wait", now - start)
+
+    def _note_queues(self):
+        self.profiler.gauge("readers_waiting", self.readers_waiting)
+        self.profiler.gauge("writers_waiting", len(self.writer_queue))
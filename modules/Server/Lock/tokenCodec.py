@@ -0,0 +1,87 @@
+# -----------------------------------------------------------------------------
+# Distributed Systems (TDDD25)
+# -----------------------------------------------------------------------------
+# Author: Sergiu Rafiliu (sergiu.rafiliu@liu.se)
+# Modified: 31 July 2013
+#
+# Copyright 2012 Linkoping University
+# -----------------------------------------------------------------------------
+
+"""Compact encoding of the token of the distributed lock.
+
+The token (a dictionary from peer id to timestamp) is encoded as a list
+of numbers:
+    version, base, n, (id, timestamp, changed) * n
+where the ids are sorted and each one is given as the difference with
+the previous one, and 'changed' is the token version at which the entry
+last changed. The numbers are packed as varints (7 bits per byte, the
+high bit set on every byte of a number but the last) and sent as base64
+text, since the messages are JSON.
+
+When 'base' is not 0, only the entries that changed after version 'base'
+are included, i.e., the token is a delta to be applied to the token of
+version 'base'.
+
+"""
+
+import base64
+
+
+def pack(numbers):
+    """Pack a list of non-negative integers into bytes."""
+
+    data = bytearray()
+    for number in numbers:
+        if number < 0:
+            raise ValueError("Cannot pack negative number {}".format(number))
+        while number >= 0x80:
+            data.append((number & 0x7f) | 0x80)
+            number >>= 7
+        data.append(number)
+    return bytes(data)
+
+
+def unpack(data):
+    """The reverse operation to the one above."""
+
+    numbers = []
+    number = shift = 0
+    for byte in bytearray(data):
+        number |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            numbers.append(number)
+            number = shift = 0
+    if shift:
+        raise ValueError("Truncated token")
+    return numbers
+
+
+def encode(token, changed_at, version, base=0):
+    """Encode the entries of 'token' that changed after version 'base'."""
+
+    pids = sorted(pid for pid in token
+                  if not base or changed_at.get(pid, 0) > base)
+    numbers = [version, base, len(pids)]
+    previous = 0
+    for pid in pids:
+        numbers.extend([pid - previous, token[pid], changed_at.get(pid, 0)])
+        previous = pid
+    return base64.b64encode(pack(numbers)).decode("ascii")
+
+
+def decode(text):
+    """Return the version, the base and the (id, timestamp, changed)
+    entries of an encoded token."""
+
+    numbers = unpack(base64.b64decode(text))
+    version, base, n = numbers[:3]
+    if len(numbers) != 3 + 3 * n:
+        raise ValueError("Malformed token")
+    entries = []
+    pid = 0
+    for i in range(3, len(numbers), 3):
+        pid += numbers[i]
+        entries.append((pid, numbers[i + 1], numbers[i + 2]))
+    return version, base, entries
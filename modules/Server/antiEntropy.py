@@ -0,0 +1,259 @@
+# -----------------------------------------------------------------------------
+# Distributed Systems (TDDD25)
+# -----------------------------------------------------------------------------
+# Author: Sergiu Rafiliu (sergiu.rafiliu@liu.se)
+# Modified: 31 July 2013
+#
+# Copyright 2012 Linkoping University
+# -----------------------------------------------------------------------------
+
+"""Merkle tree anti-entropy between the replicas of the database.
+
+Every fortune is identified by a 64 bit digest of its text. The first
+'depth' bits of the digest choose one of the 2**depth leaves of a
+complete binary tree, kept in an array: node i has children 2i and
+2i + 1, the root is node 1 and the leaves are the nodes 2**depth to
+2**(depth + 1) - 1. The hash of a node is the sum (modulo 2**64) of the
+digests below it, so adding a fortune only updates the nodes on its
+path to the root.
+
+To synchronize with a peer, a replica compares the root with the one of
+the peer and walks down only into the nodes that differ. For the
+differing leaves it compares the digests, fetches the fortunes it lacks
+and sends the peer the ones the peer lacks. The number of calls grows
+with the depth of the tree and the amount of data with the number of
+differing fortunes, not with the size of the database.
+
+"""
+
+import time
+import random
+import hashlib
+import threading
+
+from Common import orb
+
+MASK = (1 << 64) - 1
+
+
+def digest(fortune):
+    """Return the 64 bit digest of a fortune."""
+    data = hashlib.blake2b(fortune.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(data, "big")
+
+
+class MerkleTree(object):
+
+    """Merkle tree over the fortunes of a database.
+
+    The tree follows the database: update() indexes the fortunes that
+    have been appended since the last call (by this server or by
+    someone else, through the database file).
+
+    """
+
+    def __init__(self, db, depth=10):
+        self.db = db
+        self.depth = depth
+        self.leaves = 1 << depth
+        self.lock = threading.Lock()
+        self._clear()
+
+    def update(self):
+        """Index the fortunes the database has got since last time."""
+        with self.lock:
+            sources = self._sources()
+            versions = [db.snapshot.version for db in sources]
+            if len(versions) != len(self.indexed) or any(
+                    v < i for v, i in zip(versions, self.indexed)):
+                # Reloaded from scratch, start over as well.
+                self._clear()
+                self.indexed = [0] * len(sources)
+            for n, db in enumerate(sources):
+                snapshot = db.snapshot
+                for fortune in snapshot.records[self.indexed[n]:
+                                                snapshot.version]:
+                    self._add(fortune)
+                self.indexed[n] = snapshot.version
+
+    def nodes(self, indices):
+        """Return the hashes of the given nodes."""
+        self.update()
+        with self.lock:
+            return [self.hashes[i] for i in indices]
+
+    def leaf_digests(self, indices):
+        """Return the digests below each of the given leaves."""
+        self.update()
+        with self.lock:
+            return [sorted(self.buckets.get(i - self.leaves, ()))
+                    for i in indices]
+
+    def fortunes(self, digests):
+        """Return the fortunes of the given digests (the known ones)."""
+        self.update()
+        with self.lock:
+            return [self.fortune_of[d] for d in digests
+                    if d in self.fortune_of]
+
+    def unknown(self, fortunes):
+        """Return the fortunes not in the database yet, once each.
+
+        The caller holds the database write lock, so that nobody adds
+        them between this check and its own write.
+
+        """
+        self.update()
+        with self.lock:
+            seen = set()
+            result = []
+            for fortune in fortunes:
+                d = digest(fortune)
+                if d not in self.fortune_of and d not in seen:
+                    seen.add(d)
+                    result.append(fortune)
+            return result
+
+    def size(self):
+        with self.lock:
+            return len(self.fortune_of)
+
+    # Private methods
+
+    def _sources(self):
+        # A ShardedDatabase is a number of plain databases.
+        return getattr(self.db, "shards", [self.db])
+
+    def _clear(self):
+        self.hashes = [0] * (2 * self.leaves)
+        self.buckets = {}
+        self.fortune_of = {}
+        self.indexed = []
+
+    def _add(self, fortune):
+        d = digest(fortune)
+        if d in self.fortune_of:
+            # The same fortune twice, it is only one record to sync.
+            return
+        self.fortune_of[d] = fortune
+        leaf = d >> (64 - self.depth)
+        self.buckets.setdefault(leaf, set()).add(d)
+        i = self.leaves + leaf
+        while i:
+            self.hashes[i] = (self.hashes[i] + d) & MASK
+            i //= 2
+
+
+class AntiEntropy(object):
+
+    """Background synchronization of a replica with its peers.
+
+    Public methods:
+        --  __init__(tree, store, peers, interval=10.0, timeout=5.0)
+        --  start()
+        --  sync(address)
+        --  stats()
+        --  destroy()
+
+    'store(fortunes)' writes fortunes to the local database, 'peers()'
+    returns the addresses of the other replicas.
+
+    """
+
+    def __init__(self, tree, store, peers, interval=10.0, timeout=5.0):
+        self.tree = tree
+        self.store = store
+        self.peers = peers
+        self.interval = interval
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.running = threading.Event()
+        self.counters = {"rounds": 0, "in_sync": 0, "calls": 0,
+                         "nodes_compared": 0, "leaves_differing": 0,
+                         "pulled": 0, "pushed": 0, "failures": 0,
+                         "time": 0.0}
+
+    def start(self):
+        self.running.set()
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def sync(self, address):
+        """Exchange the differing fortunes with the replica at 'address'.
+
+        Return the number of fortunes pulled and pushed.
+
+        """
+        start = time.time()
+        peer = orb.Stub(address, self.timeout)
+        tree = self.tree
+        calls = compared = 0
+        # Walk down the tree, level by level, into the differing nodes.
+        level = [1]
+        while level:
+            theirs = peer.ae_nodes(level)
+            calls += 1
+            compared += len(level)
+            differing = [i for i, mine, other in
+                         zip(level, tree.nodes(level), theirs)
+                         if mine != other]
+            if not differing or differing[0] >= tree.leaves:
+                break
+            level = [c for i in differing for c in (2 * i, 2 * i + 1)]
+        pulled = pushed = 0
+        if differing:
+            theirs = peer.ae_leaf_digests(differing)
+            mine = tree.leaf_digests(differing)
+            missing, extra = [], []
+            for ours, other in zip(mine, theirs):
+                ours, other = set(ours), set(other)
+                missing.extend(other - ours)
+                extra.extend(ours - other)
+            calls += 1
+            if missing:
+                fortunes = peer.ae_fortunes(missing)
+                self.store(fortunes)
+                pulled = len(fortunes)
+                calls += 1
+            if extra:
+                peer.ae_store(tree.fortunes(extra))
+                pushed = len(extra)
+                calls += 1
+        with self.lock:
+            self.counters["rounds"] += 1
+            if not differing:
+                self.counters["in_sync"] += 1
+            self.counters["calls"] += calls
+            self.counters["nodes_compared"] += compared
+            self.counters["leaves_differing"] += len(differing)
+            self.counters["pulled"] += pulled
+            self.counters["pushed"] += pushed
+            self.counters["time"] += time.time() - start
+        return pulled, pushed
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+        stats["fortunes"] = self.tree.size()
+        return stats
+
+    def destroy(self):
+        self.running.clear()
+
+    # Private methods
+
+    def _run(self):
+        while self.running.is_set():
+            time.sleep(self.interval * random.uniform(0.5, 1.5))
+            peers = self.peers()
+            if not peers or not self.running.is_set():
+                continue
+            address = random.choice(peers)
+            try:
+                self.sync(address)
+            except BaseException as e:
+                # Errors raised by the peer come back as BaseException.
+                with self.lock:
+                    self.counters["failures"] += 1
+                print("Anti-entropy with {} failed: {}".format(address, e))
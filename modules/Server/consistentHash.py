@@ -0,0 +1,325 @@
+# -----------------------------------------------------------------------------
+# Distributed Systems (TDDD25)
+# -----------------------------------------------------------------------------
+# Author: Sergiu Rafiliu (sergiu.rafiliu@liu.se)
+# Modified: 31 July 2013
+#
+# Copyright 2012 Linkoping University
+# -----------------------------------------------------------------------------
+
+"""Partitioning of the fortunes over the servers by consistent hashing.
+
+Every server is placed at 'vnodes' points of a ring of 64 bit hashes.
+A fortune is stored by the first 'replication_factor' distinct servers
+found clockwise from the hash of its text (its replica set), the first
+of them being its primary. When a server joins or leaves, only the
+fortunes whose replica set changes move, about 1/N of them.
+
+A random read first picks a server with a probability proportional to
+the number of fortunes it is the primary of, then a random one of these
+fortunes, so that every fortune is equally likely to be read. A server
+that turns out to be the primary of no fortune (the sizes are only
+refreshed every 'interval' seconds) is skipped.
+
+A fortune is stored once: writing a fortune that its replica set
+already holds raises DuplicateFortune.
+
+The ring follows the group of servers. When it changes, a background
+rebalance sends every fortune to the servers that have just become
+responsible for it (only one of the previous holders sends it), then
+drops from the local database the fortunes this server is no longer
+responsible for.
+
+"""
+
+import time
+import bisect
+import random
+import threading
+import collections
+
+from Common import orb
+from .antiEntropy import digest
+
+
+class DuplicateFortune(Exception):
+    pass
+
+
+class HashRing(object):
+
+    """A consistent-hash ring of servers, with virtual nodes."""
+
+    def __init__(self, nodes=(), vnodes=64):
+        self.vnodes = vnodes
+        self.points = []
+        self.owners = []
+        self.members = set()
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node):
+        if node in self.members:
+            return
+        self.members.add(node)
+        for i in range(self.vnodes):
+            point = digest("{}#{}".format(node, i))
+            index = bisect.bisect(self.points, point)
+            self.points.insert(index, point)
+            self.owners.insert(index, node)
+
+    def remove(self, node):
+        if node not in self.members:
+            return
+        self.members.discard(node)
+        kept = [(p, o) for p, o in zip(self.points, self.owners) if o != node]
+        self.points = [p for p, o in kept]
+        self.owners = [o for p, o in kept]
+
+    def preference(self, key, n):
+        """Return the first n distinct servers clockwise from 'key'."""
+        nodes = []
+        if not self.points:
+            return nodes
+        start = bisect.bisect(self.points, digest(key))
+        for i in range(len(self.points)):
+            node = self.owners[(start + i) % len(self.points)]
+            if node not in nodes:
+                nodes.append(node)
+                if len(nodes) == n:
+                    break
+        return nodes
+
+
+class Partitioning(object):
+
+    """The partition of the fortunes one server is responsible for.
+
+    Public methods, partition side:
+        --  __init__(owner, db, fan_out, peers, replication_factor=2,
+                     vnodes=64, interval=1.0, batch=256)
+        --  store(fortunes)
+        --  size()
+        --  read_local()
+    Public methods, client side:
+        --  start()
+        --  write(fortune)
+        --  read()
+        --  stats()
+        --  destroy()
+
+    'peers()' returns the addresses of the other servers, by id.
+
+    """
+
+    def __init__(self, owner, db, fan_out, peers, replication_factor=2,
+                 vnodes=64, interval=1.0, batch=256):
+        self.owner = owner
+        self.db = db
+        self.fan_out = fan_out
+        self.peers = peers
+        self.replication_factor = replication_factor
+        self.vnodes = vnodes
+        self.interval = interval
+        self.batch = batch
+        self.lock = threading.Lock()
+        self.ring = None
+        # Ring the local database has been rebalanced for.
+        self.balanced = None
+        self.held = set()
+        self.primary = []
+        self.indexed = []
+        self.sizes = {}
+        self.sizes_at = 0
+        self.running = threading.Event()
+        self.counters = {"writes": 0, "rebalances": 0, "moved_out": 0,
+                         "moved_in": 0, "dropped": 0, "last_moved": 0,
+                         "last_held": 0}
+
+    # Public methods, partition side
+
+    def store(self, fortunes):
+        """Store the fortunes this server does not hold yet."""
+        self._update()
+        with self.lock:
+            new = [f for f in collections.OrderedDict.fromkeys(fortunes)
+                   if f not in self.held]
+            self.counters["moved_in"] += len(new)
+        if new:
+            self.db.write_batch(new)
+        return len(new)
+
+    def size(self):
+        """Return the number of fortunes this server is the primary of."""
+        self._update()
+        with self.lock:
+            return len(self.primary)
+
+    def read_local(self):
+        """Read one of the fortunes this server is the primary of, None
+        if there is none."""
+        self._update()
+        with self.lock:
+            if not self.primary:
+                return None
+            return random.choice(self.primary)
+
+    # Public methods, client side
+
+    def start(self):
+        self._join(self.peers())
+        self._update()
+        with self.lock:
+            if not self.held:
+                # Joining empty: the others hand over our share.
+                self.balanced = self.ring
+        self.running.set()
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def write(self, fortune):
+        """Write a fortune to its replica set."""
+        replicas = self.peers()
+        self._join(replicas)
+        with self.lock:
+            owners = self.ring.preference(fortune, self.replication_factor)
+            self.counters["writes"] += 1
+        stored = 0
+        if self.owner.id in owners:
+            stored += self.store([fortune])
+        result = self.fan_out.call(
+            dict((pid, replicas[pid]) for pid in owners
+                 if pid != self.owner.id and pid in replicas),
+            "partition_store", [fortune])
+        for pid, error in sorted(result.errors().items()):
+            print("Partition {} has not stored the fortune: {}".format(
+                pid, error))
+        answered = len(result.results) + (self.owner.id in owners)
+        stored += sum(result.results.values())
+        if answered and not stored:
+            raise DuplicateFortune("The fortune is already in the database")
+
+    def read(self):
+        """Read a random fortune, uniformly over all the partitions."""
+        replicas = self.peers()
+        if time.time() - self.sizes_at > self.interval:
+            result = self.fan_out.call(replicas, "partition_size")
+            sizes = dict(result.results)
+            sizes[self.owner.id] = self.size()
+            self.sizes, self.sizes_at = sizes, time.time()
+        sizes = dict(self.sizes)
+        while True:
+            pids = [pid for pid in sizes if sizes[pid]]
+            if not pids:
+                raise ValueError("The database is empty")
+            pid = random.choices(pids, [sizes[p] for p in pids])[0]
+            if pid == self.owner.id or pid not in replicas:
+                fortune = self.read_local()
+            else:
+                fortune = orb.Stub(replicas[pid],
+                                   self.fan_out.timeout).partition_read()
+            if fortune is not None:
+                return fortune
+            # Its fortunes have moved since we got its size.
+            sizes[pid] = 0
+            self.sizes_at = 0
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats["held"] = len(self.held)
+            stats["primary"] = len(self.primary)
+            stats["servers"] = sorted(self.ring.members) if self.ring else []
+            return stats
+
+    def destroy(self):
+        self.running.clear()
+
+    # Private methods
+
+    def _join(self, replicas):
+        """Follow the group of servers in the ring."""
+        members = set(replicas) | {self.owner.id}
+        with self.lock:
+            if self.ring is not None and self.ring.members == members:
+                return
+            self.ring = HashRing(members, self.vnodes)
+            if self.balanced is None:
+                self.balanced = HashRing([self.owner.id], self.vnodes)
+            # The primaries have changed.
+            self.indexed = []
+
+    def _update(self):
+        """Index the fortunes the database has got since last time."""
+        with self.lock:
+            sources = getattr(self.db, "shards", [self.db])
+            versions = [db.snapshot.version for db in sources]
+            if len(versions) != len(self.indexed) or any(
+                    v < i for v, i in zip(versions, self.indexed)):
+                # Rewritten, or the ring has changed: start over.
+                self.held = set()
+                self.primary = []
+                self.indexed = [0] * len(sources)
+            for n, db in enumerate(sources):
+                snapshot = db.snapshot
+                for fortune in snapshot.records[self.indexed[n]:
+                                                snapshot.version]:
+                    if fortune in self.held:
+                        continue
+                    self.held.add(fortune)
+                    if (self.ring is None or
+                            self.ring.preference(fortune, 1) ==
+                            [self.owner.id]):
+                        self.primary.append(fortune)
+                self.indexed[n] = snapshot.version
+
+    def _run(self):
+        while self.running.is_set():
+            time.sleep(self.interval)
+            try:
+                self._join(self.peers())
+                if self.ring.members != self.balanced.members:
+                    self._rebalance()
+            except BaseException as e:
+                # Remote errors come back as BaseException: retry later.
+                print("Rebalance failed: {}".format(e))
+
+    def _rebalance(self):
+        """Hand the fortunes over to the servers now responsible."""
+        self._update()
+        me = self.owner.id
+        replicas = self.peers()
+        with self.lock:
+            old, new = self.balanced, self.ring
+            held = list(self.held)
+        outgoing = collections.defaultdict(list)
+        drop = set()
+        for fortune in held:
+            before = old.preference(fortune, self.replication_factor)
+            after = new.preference(fortune, self.replication_factor)
+            if me not in after:
+                drop.add(fortune)
+            if before == after:
+                continue
+            # Only the first previous holder still around sends it.
+            senders = [pid for pid in before if pid in new.members]
+            if not senders or senders[0] == me:
+                for pid in after:
+                    if pid not in before and pid != me:
+                        outgoing[pid].append(fortune)
+        moved = 0
+        for pid, fortunes in outgoing.items():
+            stub = orb.Stub(replicas[pid], self.fan_out.timeout)
+            for i in range(0, len(fortunes), self.batch):
+                stub.partition_store(fortunes[i:i + self.batch])
+            moved += len(fortunes)
+        if drop:
+            self.db.retain(lambda fortune: fortune not in drop)
+        with self.lock:
+            self.balanced = new
+            self.counters["rebalances"] += 1
+            self.counters["moved_out"] += moved
+            self.counters["dropped"] += len(drop)
+            self.counters["last_moved"] = moved
+            self.counters["last_held"] = len(held)
@@ -7,9 +7,36 @@
 # Copyright 2012 Linkoping University
 # -----------------------------------------------------------------------------
 
-"""Implementation of a simple database class."""
+"""Implementation of a simple database class.
 
+The in-memory list of fortunes is append-only. Every write publishes a
+new immutable snapshot (version, records) where the version is the
+number of records visible in that snapshot. Since the records list is
+only ever appended to, a snapshot never needs to be copied: it is simply
+a view on the first 'version' entries of the shared list.
+
+Readers grab the current snapshot with a single attribute read and never
+take a lock, while writers serialize among themselves on 'write_lock'
+and atomically swap in the next snapshot once the record is appended.
+
+The database file may also be appended to by other processes. refresh()
+(or the polling thread started by watch()) notices that the file has
+grown and parses only the newly appended bytes. If the file has been
+truncated or rewritten, it is reloaded from scratch.
+
+"""
+
+import os
+import time
 import random
+import threading
+import collections
+
+SEPARATOR = b"\n%\n"
+
+# An immutable view on the database: the first 'version' entries of the
+# (append-only) 'records' list.
+Snapshot = collections.namedtuple("Snapshot", ["version", "records"])
 
 
 class Database(object):
@@ -20,43 +47,188 @@ class Database(object):
         self.db_file = db_file
         self.rand = random.Random()
         self.rand.seed()
-        #
-        # Your code here.
-        #
-        # Open the database file in a readable form
-        # Split it with newline character before and after the % separator
-        # Store in a list
-        self.readFromFile = open(db_file, "r")
-        self.myList = self.readFromFile.read().split("\n%\n")
-        # Delete the last entry as it won't be a fortune
-        self.myList.pop()
-        # Close it
-        self.readFromFile.close()
+        # Writers serialize on this lock, readers never touch it.
+        self.write_lock = threading.Lock()
+        self.watcher = None
+        with self.write_lock:
+            self._load()
+
+    def version(self):
+        """Return the version of the currently published snapshot."""
+
+        return self.snapshot.version
 
     def read(self):
         """Read a random location in the database."""
-        #
-        # Your code here.
-        #
-        # print(self.myList)
-        # Return a random fortune from the list
-        return random.choice(self.myList)
-        
+
+        # A single attribute read gives us a consistent view, no lock.
+        snapshot = self.snapshot
+        return self._read_snapshot(snapshot, snapshot.version)
+
+    def read_at(self, version):
+        """Read a random location in the database as of 'version'.
+
+        Any version that has been published so far can be read, which
+        allows replicas to serve reads that are consistent with a given
+        point in the history of the database.
+
+        """
+
+        snapshot = self.snapshot
+        if version < 1 or version > snapshot.version:
+            raise ValueError(
+                "Version {} is not available (current: {})".format(
+                    version, snapshot.version))
+        return self._read_snapshot(snapshot, version)
 
     def write(self, fortune):
         """Write a new fortune to the database."""
-        #
-        # Your code here.
-        #
-        # Open the database file in a writeable form
-        # Simply append the list with the fortune
-        self.writeInFile = open(self.db_file,"a")
-        self.myList.append(fortune)
-        # Write to the file in the same way as the split
-        # i.e newline before and after the % separator
-        self.writeInFile.write(fortune + "\n" + "%" + "\n")
-        # Closing the writable file is very important
-        # Otherwise the changes won't take place until you exit the program
-        self.writeInFile.close()
-
-    
+
+        self.write_batch([fortune])
+
+    def write_batch(self, fortunes):
+        """Write a list of new fortunes, with a single file append."""
+
+        with self.write_lock:
+            # Pick up whatever somebody else appended first, so that the
+            # offset we keep still matches the end of the file.
+            self._refresh()
+            # Write to the file in the same way as the split
+            # i.e newline before and after the % separator
+            data = b"".join(fortune.encode("utf-8") + SEPARATOR
+                            for fortune in fortunes)
+            with open(self.db_file, "ab") as f:
+                f.write(data)
+                # Flush first, so that the size and time we remember are
+                # the ones the next refresh will see.
+                f.flush()
+                st = os.fstat(f.fileno())
+            if self.size == self.offset:
+                self.offset = self.size = self.offset + len(data)
+                self.mtime = st.st_mtime_ns
+            # Append first, then publish: readers holding an older
+            # snapshot never look past their own version.
+            self.records.extend(fortunes)
+            self.snapshot = Snapshot(len(self.records), self.records)
+
+    def checkpoint(self):
+        """Return (size, version): the first 'size' bytes of the file
+        hold exactly the records of snapshot 'version'.
+
+        The file is only ever appended to, so it can be copied up to
+        'size' while the writes go on.
+
+        """
+
+        with self.write_lock:
+            self._refresh()
+            if self.size != self.offset:
+                raise ValueError("{} ends with an incomplete record".format(
+                    self.db_file))
+            return self.offset, self.snapshot.version
+
+    def retain(self, keep):
+        """Rewrite the database with only the records keep(record) holds
+        for."""
+
+        with self.write_lock:
+            self._refresh()
+            # Write to a temporary file first so that an interrupted
+            # rewrite does not leave a half written database behind.
+            tmp_file = self.db_file + ".tmp"
+            with open(tmp_file, "wb") as f:
+                f.write(b"".join(fortune.encode("utf-8") + SEPARATOR
+                                 for fortune in self.records
+                                 if keep(fortune)))
+            os.replace(tmp_file, self.db_file)
+            self._load()
+
+    def refresh(self):
+        """Merge the records appended to the file by somebody else."""
+
+        with self.write_lock:
+            self._refresh()
+
+    def watch(self, interval=1.0):
+        """Poll the database file for changes every 'interval' seconds."""
+
+        if self.watcher is None:
+            self.watcher = threading.Thread(target=self._watch,
+                                            args=(interval,))
+            self.watcher.daemon = True
+            self.watcher.start()
+
+    # Private methods
+
+    def _read_snapshot(self, snapshot, version):
+        return snapshot.records[self.rand.randrange(version)]
+
+    def _parse(self, data):
+        """Split 'data' into records.
+
+        Only complete records (i.e., terminated by a separator) are
+        returned, together with the number of bytes they span.
+
+        """
+
+        end = data.rfind(SEPARATOR)
+        if end < 0:
+            return [], 0
+        records = [r.decode("utf-8") for r in data[:end].split(SEPARATOR)]
+        return records, end + len(SEPARATOR)
+
+    def _load(self):
+        """(Re)load the whole file and publish it as a new snapshot."""
+
+        with open(self.db_file, "rb") as f:
+            st = os.fstat(f.fileno())
+            data = f.read()
+        records, self.offset = self._parse(data)
+        self.size = len(data)
+        self.mtime = st.st_mtime_ns
+        self.file_id = (st.st_dev, st.st_ino)
+        self.records = records
+        self.snapshot = Snapshot(len(records), records)
+
+    def _refresh(self):
+        """Bring the in-memory records up to date with the file.
+
+        Must be called with 'write_lock' held.
+
+        """
+
+        st = os.stat(self.db_file)
+        if st.st_size == self.size and st.st_mtime_ns == self.mtime:
+            # Nothing happened since last time.
+            return
+        if ((st.st_dev, st.st_ino) != self.file_id or
+                st.st_size <= self.offset):
+            # Replaced, truncated or rewritten in place.
+            self._load()
+            return
+        with open(self.db_file, "rb") as f:
+            if self.offset > 0:
+                # The bytes we already parsed must still end in a
+                # separator, otherwise the file has been rewritten.
+                f.seek(self.offset - len(SEPARATOR))
+                if f.read(len(SEPARATOR)) != SEPARATOR:
+                    self._load()
+                    return
+            data = f.read()
+        records, consumed = self._parse(data)
+        self.offset += consumed
+        self.size = self.offset + len(data) - consumed
+        self.mtime = st.st_mtime_ns
+        if records:
+            self.records.extend(records)
+            self.snapshot = Snapshot(len(self.records), self.records)
+
+    def _watch(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.refresh()
+            except Exception as e:
+                # Keep on watching, the file may be in the middle of
+                # being replaced.
+                print("Cannot refresh the database: {}".format(e))
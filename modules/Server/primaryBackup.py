@@ -0,0 +1,400 @@
+# -----------------------------------------------------------------------------
+# Distributed Systems (TDDD25)
+# -----------------------------------------------------------------------------
+# Author: Sergiu Rafiliu (sergiu.rafiliu@liu.se)
+# Modified: 31 July 2013
+#
+# Copyright 2012 Linkoping University
+# -----------------------------------------------------------------------------
+
+"""Primary-backup replication of the fortune database.
+
+The replica with the smallest id is the primary. It gives every fortune
+written the next sequence number, appends it to its replication log and
+writes it to its own database. One shipper thread per backup streams
+the log to that backup, in order and in batches: apply(first, fortunes)
+carries the fortunes numbered first, first + 1, ...
+
+Every entry of the log is tagged with the epoch of the primary that
+sequenced it: [n, id], n being one more than the largest n the primary
+has seen when it took over. A backup applies the fortunes it does not
+have yet, in order, and ignores the ones it already has, so a batch
+sent twice does no harm. An entry it has with another epoch is a left
+over of an older primary (e.g. written by a primary that crashed before
+shipping it): the log is truncated there, and the fortunes removed from
+the database. When a batch starts after the end of its log (a gap) it
+applies nothing. Either way it answers with the length of its log, and
+the shipper goes on from there.
+
+Before shipping anything, the primary sends to the backup the epochs of
+its log, join(epochs, length): the backup truncates its log to the part
+it has in common with the primary's. This drops the left overs that a
+restarted replica has read back from its own log.
+
+A write sent to a backup is forwarded to the primary. The primary
+answers once every backup has the fortune, or after 'ack_timeout'
+seconds: a backup that lags behind catches up later from the log.
+
+When the primary goes away, the next smallest id takes over. It first
+fetches from the most advanced backup (the one with the latest last
+epoch, then the longest log) the part of the log it lacks.
+
+The log is kept in 'log_file' too, written before the database, so that
+a replica that restarts goes on from where it was instead of applying
+the whole log again. A fortune of the log that did not make it to the
+database before a crash is written at start-up.
+
+"""
+
+import os
+import json
+import time
+import threading
+import collections
+
+from Common import orb
+
+
+class PrimaryBackup(object):
+
+    """Replication log of one replica, and the primary-backup protocol.
+
+    Public methods, backup side:
+        --  __init__(owner, db, ack_timeout=5.0, max_batch=256,
+                     log_file=None)
+        --  apply(first, entries)
+        --  join(epochs, length)
+        --  epochs()
+        --  fetch(first)
+    Public methods, both sides:
+        --  write(replicas, fortune)
+        --  submit(replicas, fortune)
+        --  stats()
+        --  destroy()
+
+    """
+
+    def __init__(self, owner, db, ack_timeout=5.0, max_batch=256,
+                 log_file=None):
+        self.owner = owner
+        self.db = db
+        self.ack_timeout = ack_timeout
+        self.max_batch = max_batch
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        # The log holds [epoch, fortune] entries. 'boundaries' holds
+        # [epoch, start] for every run of entries with the same epoch.
+        self.log = []
+        self.boundaries = []
+        self.log_path = log_file
+        self.log_file = None
+        if log_file is not None:
+            self._recover(log_file)
+            self.log_file = open(log_file, "a", encoding="utf-8")
+        self.epoch = None
+        self.primary = None
+        self.backups = {}
+        self.acked = {}
+        self.shippers = {}
+        self.running = True
+        self.counters = {"writes": 0, "forwarded": 0, "lagging_writes": 0,
+                         "batches": 0, "shipped": 0, "duplicates": 0,
+                         "gaps": 0, "conflicts": 0, "truncated": 0,
+                         "take_overs": 0}
+
+    # Public methods, backup side
+
+    def apply(self, first, entries):
+        """Append the entries numbered from 'first' to the log.
+
+        Return the length of the log, i.e., the sequence number of the
+        last fortune applied.
+
+        """
+        with self.lock:
+            if first > len(self.log) + 1:
+                self.counters["gaps"] += 1
+                return len(self.log)
+            start = first - 1
+            k = 0
+            while k < len(entries) and start + k < len(self.log):
+                if self.log[start + k][0] != entries[k][0]:
+                    # Sequenced by an older primary, ours wins.
+                    self.counters["conflicts"] += 1
+                    self._truncate(start + k)
+                    break
+                k += 1
+            self.counters["duplicates"] += k
+            self._append(entries[k:])
+            return len(self.log)
+
+    def join(self, epochs, length):
+        """Keep only the part of the log in common with the primary's.
+
+        'epochs' and 'length' describe the primary's log, as returned by
+        epochs(). Return the length of the log.
+
+        """
+        with self.lock:
+            common = self._common(epochs, length)
+            if common < len(self.log):
+                self.counters["conflicts"] += 1
+                self._truncate(common)
+            return len(self.log)
+
+    def epochs(self):
+        """Return the [epoch, start] runs of the log, and its length."""
+        with self.lock:
+            return [list(self.boundaries), len(self.log)]
+
+    def fetch(self, first):
+        """Return the entries of the log from number 'first' on."""
+        with self.lock:
+            return self.log[first - 1:]
+
+    # Public methods, both sides
+
+    def write(self, replicas, fortune):
+        """Write a fortune, forwarding it to the primary if needed.
+
+        'replicas' maps the id of each other replica to its address.
+
+        """
+        primary = min(list(replicas) + [self.owner.id])
+        if primary != self.owner.id:
+            with self.lock:
+                # Stop shipping if we have been the primary until now.
+                self.primary = primary
+                self.backups = {}
+                self.counters["forwarded"] += 1
+            stub = orb.Stub(replicas[primary], self.ack_timeout)
+            return stub.pb_submit(fortune)
+        return self.submit(replicas, fortune)
+
+    def submit(self, replicas, fortune):
+        """Sequence a fortune and wait for the backups (primary only)."""
+        if self.primary != self.owner.id:
+            self._take_over(replicas)
+        with self.lock:
+            self._follow(replicas)
+            self._append([[self.epoch, fortune]])
+            seq = len(self.log)
+            self.counters["writes"] += 1
+            self.changed.notify_all()
+            deadline = time.time() + self.ack_timeout
+            while self._lagging(seq):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.counters["lagging_writes"] += 1
+                    print("Backups {} lag behind fortune {}".format(
+                        self._lagging(seq), seq))
+                    break
+                self.changed.wait(remaining)
+        return seq
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats["primary"] = self.primary
+            stats["epoch"] = self.epoch
+            stats["sequence"] = len(self.log)
+            stats["acked"] = dict(self.acked)
+            return stats
+
+    def destroy(self):
+        with self.lock:
+            self.running = False
+            self.changed.notify_all()
+
+    # Private methods
+
+    def _append(self, entries):
+        """Add entries to the log, then their fortunes to the database.
+
+        Must be called with 'lock' held.
+
+        """
+        if not entries:
+            return
+        self._extend(entries)
+        if self.log_file is not None:
+            self.log_file.write("".join(json.dumps(entry) + "\n"
+                                        for entry in entries))
+            self.log_file.flush()
+        self.db.write_batch([fortune for epoch, fortune in entries])
+
+    def _extend(self, entries):
+        for epoch, fortune in entries:
+            if not self.boundaries or self.boundaries[-1][0] != epoch:
+                self.boundaries.append([epoch, len(self.log)])
+            self.log.append([epoch, fortune])
+
+    def _truncate(self, length):
+        """Drop the entries of the log from index 'length' on.
+
+        Their fortunes are removed from the database first: if we crash
+        before the log is rewritten, they are written again at start-up
+        and dropped by the next join. Must be called with 'lock' held.
+
+        """
+        removed = collections.Counter(
+            fortune for epoch, fortune in self.log[length:])
+        self.counters["truncated"] += len(self.log) - length
+        del self.log[length:]
+        while self.boundaries and self.boundaries[-1][1] >= length:
+            self.boundaries.pop()
+        # Keep the first occurrences of the fortunes, drop the last ones.
+        keep = self._present() - removed
+        seen = collections.Counter()
+
+        def kept(fortune):
+            seen[fortune] += 1
+            return fortune not in removed or seen[fortune] <= keep[fortune]
+
+        self.db.retain(kept)
+        if self.log_file is not None:
+            self.log_file.close()
+            tmp_file = self.log_path + ".tmp"
+            with open(tmp_file, "w", encoding="utf-8") as f:
+                f.write("".join(json.dumps(entry) + "\n"
+                                for entry in self.log))
+            os.replace(tmp_file, self.log_path)
+            self.log_file = open(self.log_path, "a", encoding="utf-8")
+
+    def _common(self, epochs, length):
+        """Return the length of the part of the log in common with the
+        one that 'epochs' and 'length' describe.
+
+        Must be called with 'lock' held.
+
+        """
+        limit = min(length, len(self.log))
+        for n, (epoch, start) in enumerate(epochs):
+            end = epochs[n + 1][1] if n + 1 < len(epochs) else length
+            for i in range(start, min(end, limit)):
+                if self.log[i][0] != epoch:
+                    return i
+        return limit
+
+    def _present(self):
+        present = collections.Counter()
+        for db in getattr(self.db, "shards", [self.db]):
+            snapshot = db.snapshot
+            present.update(snapshot.records[:snapshot.version])
+        return present
+
+    def _recover(self, log_file):
+        """Read back the log written before a restart."""
+        if not os.path.exists(log_file):
+            return
+        end = 0
+        with open(log_file, "rb") as f:
+            for line in f:
+                try:
+                    if not line.endswith(b"\n"):
+                        raise ValueError("Incomplete line")
+                    self._extend([json.loads(line.decode("utf-8"))])
+                except ValueError:
+                    # Cut short by a crash, never applied.
+                    break
+                end += len(line)
+        # The next entries must not be glued to a partial line.
+        os.truncate(log_file, end)
+        present = self._present()
+        missing = [fortune for epoch, fortune in self.log
+                   if fortune not in present]
+        if missing:
+            self.db.write_batch(missing)
+
+    def _lagging(self, seq):
+        return sorted(pid for pid in self.backups
+                      if self.acked.get(pid, 0) < seq)
+
+    def _take_over(self, replicas):
+        """Become the primary, with the most advanced log among the
+        replicas."""
+        def advance(epochs, length):
+            return (epochs[-1][0] if epochs else [0, 0], length)
+
+        with self.lock:
+            mine = [list(self.boundaries), len(self.log)]
+        best, most = None, mine
+        highest = max([epoch[0] for epoch, start in self.boundaries] + [0])
+        for pid, address in replicas.items():
+            try:
+                theirs = orb.Stub(address, self.ack_timeout).pb_epochs()
+            except BaseException as e:
+                # Remote errors come back as BaseException too.
+                print("Replica {} has not answered: {}".format(pid, e))
+                continue
+            highest = max([epoch[0] for epoch, start in theirs[0]] +
+                          [highest])
+            if advance(*theirs) > advance(*most):
+                best, most = pid, theirs
+        if best is not None:
+            with self.lock:
+                common = self._common(*most)
+                if common < len(self.log):
+                    self.counters["conflicts"] += 1
+                    self._truncate(common)
+            first = common + 1
+            stub = orb.Stub(replicas[best], self.ack_timeout)
+            self.apply(first, stub.pb_fetch(first))
+        with self.lock:
+            self.epoch = [highest + 1, self.owner.id]
+            self.primary = self.owner.id
+            self.counters["take_overs"] += 1
+
+    def _follow(self, replicas):
+        """Ship the log to exactly the given backups.
+
+        Must be called with 'lock' held.
+
+        """
+        self.backups = dict(replicas)
+        for pid in list(self.acked):
+            if pid not in self.backups:
+                del self.acked[pid]
+        for pid in self.backups:
+            if pid not in self.shippers or not self.shippers[pid].is_alive():
+                shipper = threading.Thread(target=self._ship, args=(pid,))
+                shipper.daemon = True
+                self.shippers[pid] = shipper
+                shipper.start()
+
+    def _ship(self, pid):
+        """Stream the log to backup pid, for as long as it is one."""
+        acked = None
+        while True:
+            with self.lock:
+                while (self.running and pid in self.backups and
+                       acked is not None and acked >= len(self.log)):
+                    self.changed.wait(1.0)
+                if not self.running or pid not in self.backups:
+                    return
+                address = self.backups[pid]
+                if acked is None:
+                    # Have the backup drop what it does not share with
+                    # us, and tell how far it is, first.
+                    epochs = [list(self.boundaries), len(self.log)]
+                    fortunes = []
+                else:
+                    first = acked + 1
+                    fortunes = self.log[acked:acked + self.max_batch]
+            try:
+                stub = orb.Stub(address, self.ack_timeout)
+                if acked is None:
+                    acked = stub.pb_join(*epochs)
+                else:
+                    acked = stub.pb_apply(first, fortunes)
+            except BaseException as e:
+                # Remote errors come back as BaseException too.
+                print("Backup {} has not applied the log: {}".format(pid, e))
+                acked = None
+                time.sleep(1.0)
+                continue
+            with self.lock:
+                self.counters["batches"] += 1
+                self.counters["shipped"] += len(fortunes)
+                self.acked[pid] = acked
+                self.changed.notify_all()
@@ -0,0 +1,266 @@
+# -----------------------------------------------------------------------------
+# Distributed Systems (TDDD25)
+# -----------------------------------------------------------------------------
+# Author: Sergiu Rafiliu (sergiu.rafiliu@liu.se)
+# Modified: 31 July 2013
+#
+# Copyright 2012 Linkoping University
+# -----------------------------------------------------------------------------
+
+"""Quorum replication of the fortune database.
+
+Every fortune written gets a version [counter, writer id], where the
+counter is a Lamport clock shared by the replicas. A write is sent to
+all the replicas and succeeds once W of them have stored it. A read
+asks R replicas for their state (the highest version they have stored,
+their number of versioned fortunes and a digest of the set of their
+versions). If the digests differ, the read gets the version sets
+themselves and reads from a replica that has all the versions any of
+them has. The others are repaired in the background with the fortunes
+they lack. If no replica has them all, they are repaired first.
+
+With W + R > N (the number of replicas), every read consults at least
+one replica that has the last successful write. With a Hedger, the read
+is hedged over the replicas that have all the versions.
+
+A replica stores a fortune once per version, also across restarts: the
+stored versions are logged to 'versions_file' before the fortune is
+written to the database, and read back at start-up. The fortunes a
+replica starts with (its database file) are assumed to be the same
+everywhere.
+
+"""
+
+import os
+import json
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from Common import orb
+from .antiEntropy import digest
+
+
+class QuorumError(Exception):
+    pass
+
+
+class QuorumReplica(object):
+
+    """Versioned fortunes of one replica, and the quorum protocol.
+
+    Public methods, replica side:
+        --  __init__(owner, db, fan_out, write_quorum=2, read_quorum=2,
+                     hedger=None, versions_file=None)
+        --  store(version, fortune)
+        --  store_batch(records)
+        --  state()
+        --  versions()
+        --  fetch(versions)
+    Public methods, coordinator side:
+        --  write(replicas, fortune)
+        --  read(replicas)
+        --  stats()
+
+    """
+
+    def __init__(self, owner, db, fan_out, write_quorum=2,
+                 read_quorum=2, hedger=None, versions_file=None):
+        self.owner = owner
+        self.db = db
+        self.fan_out = fan_out
+        self.write_quorum = write_quorum
+        self.read_quorum = read_quorum
+        self.hedger = hedger
+        self.lock = threading.Lock()
+        self.clock = 0
+        self.records = {}
+        self.latest = [0, 0]
+        # Sum of the digests of the versions, modulo 2**64.
+        self.digest = 0
+        self.versions_file = versions_file
+        self.log = None
+        if versions_file is not None:
+            self._recover()
+            self.log = open(versions_file, "a", encoding="utf-8")
+        self.repairs = ThreadPoolExecutor(max_workers=2)
+        self.counters = {"writes": 0, "reads": 0, "stale_reads": 0,
+                         "repaired_replicas": 0, "repaired_fortunes": 0}
+
+    # Public methods, replica side
+
+    def store(self, version, fortune):
+        """Store a fortune of the given version (once)."""
+        key = tuple(version)
+        with self.lock:
+            self.clock = max(self.clock, version[0])
+            if key in self.records:
+                return False
+            self._add(key, fortune)
+            if self.log is not None:
+                # Logged first: after a crash, the fortune is written
+                # again if it is not in the database.
+                self.log.write(json.dumps([version, fortune]) + "\n")
+                self.log.flush()
+        self.db.write(fortune)
+        return True
+
+    def store_batch(self, records):
+        """Store a list of [version, fortune] records."""
+        return sum(1 for version, fortune in records
+                   if self.store(version, fortune))
+
+    def state(self):
+        """Return the highest version stored, the number of versioned
+        fortunes and the digest of the set of versions."""
+        with self.lock:
+            return [self.latest, len(self.records), self.digest]
+
+    def versions(self):
+        with self.lock:
+            return [list(key) for key in self.records]
+
+    def fetch(self, versions):
+        """Return the [version, fortune] records of the given versions."""
+        with self.lock:
+            return [[version, self.records[tuple(version)]]
+                    for version in versions
+                    if tuple(version) in self.records]
+
+    # Public methods, coordinator side
+
+    def write(self, replicas, fortune):
+        """Write a fortune to the replicas (a map from id to address,
+        this one included)."""
+        with self.lock:
+            self.clock = self.clock + 1
+            version = [self.clock, self.owner.id]
+        result = self.fan_out.call(replicas, "quorum_store", version, fortune,
+                                   quorum=self.write_quorum)
+        self._count("writes")
+        if len(result.results) < self.write_quorum:
+            raise QuorumError(
+                "Only {} of the {} replicas needed have stored the "
+                "fortune".format(len(result.results), self.write_quorum))
+
+    def read(self, replicas):
+        """Read a fortune from the freshest of read_quorum replicas."""
+        result = self.fan_out.call(replicas, "quorum_state",
+                                   quorum=self.read_quorum)
+        states = result.results
+        if len(states) < self.read_quorum:
+            raise QuorumError(
+                "Only {} of the {} replicas needed have answered".format(
+                    len(states), self.read_quorum))
+        self._count("reads")
+        fresh = list(states)
+        if len(set(state[2] for state in states.values())) > 1:
+            # Not the same versions: compare the sets themselves.
+            self._count("stale_reads")
+            result = self.fan_out.call(
+                dict((pid, replicas[pid]) for pid in states),
+                "quorum_versions")
+            sets = dict((pid, set(tuple(v) for v in versions))
+                        for pid, versions in result.results.items())
+            if not sets:
+                raise QuorumError("No replica has sent its versions")
+            union = set().union(*sets.values())
+            fresh = [pid for pid in sets if len(sets[pid]) == len(union)]
+            stale = [pid for pid in sets if pid not in fresh]
+            if fresh:
+                self.repairs.submit(self._repair, replicas, sets, union,
+                                    stale)
+            else:
+                # Nobody has all the successful writes, a read now could
+                # miss one of them.
+                self._repair(replicas, sets, union, stale)
+                fresh = stale
+        if self.hedger is not None:
+            random.shuffle(fresh)
+            return self.hedger.call([replicas[pid] for pid in fresh],
+                                    "read_local")
+        return self._stub(replicas[random.choice(fresh)]).read_local()
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats["clock"] = self.clock
+            stats["versioned_fortunes"] = len(self.records)
+            return stats
+
+    # Private methods
+
+    def _add(self, key, fortune):
+        # Must be called with 'lock' held.
+        self.records[key] = fortune
+        self.latest = max(self.latest, list(key))
+        self.digest = (self.digest +
+                       digest("{}:{}".format(*key))) % (1 << 64)
+
+    def _recover(self):
+        """Read back the versions stored before a restart."""
+        if not os.path.exists(self.versions_file):
+            return
+        end = 0
+        with open(self.versions_file, "rb") as f:
+            for line in f:
+                try:
+                    if not line.endswith(b"\n"):
+                        raise ValueError("Incomplete line")
+                    version, fortune = json.loads(line.decode("utf-8"))
+                except ValueError:
+                    # The last line may be incomplete.
+                    break
+                end += len(line)
+                key = tuple(version)
+                self.clock = max(self.clock, version[0])
+                if key not in self.records:
+                    self._add(key, fortune)
+        # Appending after a partial line would corrupt the next entry.
+        os.truncate(self.versions_file, end)
+        # A crash may have come between the log and the database.
+        present = set()
+        for db in getattr(self.db, "shards", [self.db]):
+            snapshot = db.snapshot
+            present.update(snapshot.records[:snapshot.version])
+        missing = [fortune for fortune in self.records.values()
+                   if fortune not in present]
+        if missing:
+            self.db.write_batch(missing)
+
+    def _count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def _stub(self, address):
+        return orb.Stub(address, self.fan_out.timeout)
+
+    def _repair(self, replicas, sets, union, stale):
+        """Give the stale replicas the versions of 'union' they lack.
+
+        'sets' maps the consulted replicas to their sets of versions.
+
+        """
+        try:
+            fetched = {}
+            for pid in stale:
+                missing = union - sets[pid]
+                # Fetch each missing version once, from a replica that
+                # has it, the ones that have the most first.
+                wanted = missing - set(fetched)
+                for holder in sorted(sets, key=lambda p: -len(sets[p])):
+                    take = wanted & sets[holder]
+                    if take:
+                        source = self._stub(replicas[holder])
+                        for version, fortune in source.quorum_fetch(
+                                sorted(take)):
+                            fetched[tuple(version)] = fortune
+                        wanted -= take
+                records = [[list(v), fetched[v]] for v in sorted(missing)
+                           if v in fetched]
+                if records:
+                    self._stub(replicas[pid]).quorum_store_batch(records)
+                    self._count("repaired_replicas")
+                    self._count("repaired_fortunes", len(records))
+        except Exception as e:
+            print("Read repair failed: {}".format(e))
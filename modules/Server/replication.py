@@ -0,0 +1,331 @@
+# -----------------------------------------------------------------------------
+# Distributed Systems (TDDD25)
+# -----------------------------------------------------------------------------
+# Author: Sergiu Rafiliu (sergiu.rafiliu@liu.se)
+# Modified: 31 July 2013
+#
+# Copyright 2012 Linkoping University
+# -----------------------------------------------------------------------------
+
+"""Parallel calls to the replicas of the database.
+
+A FanOut calls the same method of a number of replicas at the same
+time, on a bounded pool of threads. Every replica gets at most
+'timeout' seconds to answer (connecting included). The replicas that
+fail or do not answer in time are reported in the result instead of
+stopping the others: the write goes on everywhere else.
+
+With a quorum, the call returns as soon as that many replicas have
+answered; the calls to the others go on in the background.
+
+A WriteBatcher buffers the writes going to each replica and sends them
+as a single write_local_batch call once 'max_batch' of them are waiting
+or the oldest has waited 'max_delay' seconds. Only one batch per
+replica is on its way at any time, so every replica receives the writes
+in the order they were submitted. A batch call that gets no answer
+within the timeout of the FanOut fails, so that a hung replica holds
+neither its writers nor its queue.
+
+"""
+
+import time
+import threading
+from concurrent.futures import (ThreadPoolExecutor, wait, ALL_COMPLETED,
+                                FIRST_COMPLETED)
+
+from Common import orb
+
+
+class FanOutResult(object):
+
+    """Outcome of a FanOut call.
+
+    Attributes:
+        --  results :: answer of each replica that answered in time,
+        --  failures :: error of each replica whose call failed,
+        --  timed_out :: replicas that did not answer in time,
+        --  unfinished :: replicas still working when the quorum was
+            reached,
+        --  elapsed :: duration of the whole call, in seconds.
+
+    """
+
+    def __init__(self):
+        self.results = {}
+        self.failures = {}
+        self.timed_out = []
+        self.unfinished = []
+        self.elapsed = 0.0
+
+    def ok(self):
+        """Return True if all the replicas have answered."""
+        return not self.failures and not self.timed_out
+
+    def errors(self):
+        """Return a description of the replicas that did not answer."""
+        errors = dict((pid, "{}: {}".format(type(e).__name__, e))
+                      for pid, e in self.failures.items())
+        for pid in self.timed_out:
+            errors[pid] = "timed out"
+        return errors
+
+
+class FanOut(object):
+
+    """Call a method of many replicas in parallel.
+
+    Public methods:
+        --  __init__(max_workers=16, timeout=5.0)
+        --  call(replicas, method, *args, quorum=None)
+        --  stats()
+
+    """
+
+    def __init__(self, max_workers=16, timeout=5.0):
+        self.timeout = timeout
+        self.pool = ThreadPoolExecutor(max_workers=max_workers)
+        self.lock = threading.Lock()
+        self.counters = {"calls": 0, "replica_calls": 0, "failures": 0,
+                         "timeouts": 0}
+
+    def call(self, replicas, method, *args, quorum=None):
+        """Call 'method' of the replicas at the same time.
+
+        'replicas' maps the id of each replica to its address. Return a
+        FanOutResult, as soon as 'quorum' replicas (all if None) have
+        answered.
+
+        """
+
+        result = FanOutResult()
+        start = time.time()
+        futures = dict((self.pool.submit(self._call, address, method, *args),
+                        pid)
+                       for pid, address in replicas.items())
+        not_done = set(futures)
+        when = ALL_COMPLETED if quorum is None else FIRST_COMPLETED
+        while not_done:
+            remaining = start + self.timeout - time.time()
+            if remaining <= 0:
+                break
+            done, not_done = wait(not_done, timeout=remaining,
+                                  return_when=when)
+            for future in done:
+                pid = futures[future]
+                if future.exception() is None:
+                    result.results[pid] = future.result()
+                else:
+                    result.failures[pid] = future.exception()
+            if quorum is not None and len(result.results) >= quorum:
+                break
+        if quorum is not None and len(result.results) >= quorum:
+            result.unfinished = sorted(futures[f] for f in not_done)
+        else:
+            result.timed_out = sorted(futures[f] for f in not_done)
+        result.elapsed = time.time() - start
+        with self.lock:
+            self.counters["calls"] += 1
+            self.counters["replica_calls"] += len(futures)
+            self.counters["failures"] += len(result.failures)
+            self.counters["timeouts"] += len(result.timed_out)
+        return result
+
+    def stats(self):
+        """Return the counters of the calls made so far."""
+        with self.lock:
+            return dict(self.counters)
+
+    # Private methods
+
+    def _call(self, address, method, *args):
+        # Bounded as well, so that a hung replica does not keep a thread
+        # of the pool once the call has timed out.
+        stub = orb.Stub(address, self.timeout, self.timeout)
+        return getattr(stub, method)(*args)
+
+
+class WriteTicket(object):
+
+    """A write waiting for its batches to reach the replicas."""
+
+    def __init__(self, replicas):
+        self.lock = threading.Lock()
+        self.waiting = set(replicas)
+        self.failures = {}
+        self.done = threading.Event()
+        if not self.waiting:
+            self.done.set()
+
+    def wait(self, timeout=None):
+        """Wait for the replicas, return the error of those that failed.
+
+        The replicas that have not answered within 'timeout' seconds
+        count as failed.
+
+        """
+        self.done.wait(timeout)
+        with self.lock:
+            for pid in self.waiting:
+                self.failures.setdefault(pid, TimeoutError(
+                    "No answer within {} s".format(timeout)))
+            return dict(self.failures)
+
+    def finished(self, pid, error=None):
+        """Replica pid has written the fortune, or failed with 'error'."""
+        with self.lock:
+            if pid not in self.waiting:
+                return
+            self.waiting.discard(pid)
+            if error is not None:
+                self.failures[pid] = error
+            if not self.waiting:
+                self.done.set()
+
+
+class WriteBatcher(object):
+
+    """Send the writes to the replicas in batches.
+
+    Public methods:
+        --  __init__(fan_out, max_batch=64, max_delay=0.002)
+        --  submit(replicas, fortune)
+        --  forget(pid)
+        --  stats()
+        --  destroy()
+
+    """
+
+    def __init__(self, fan_out, max_batch=64, max_delay=0.002):
+        self.fan_out = fan_out
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.buffers = {}
+        self.running = True
+        self.counters = {"batches": 0, "fortunes": 0, "failed_batches": 0,
+                         "largest_batch": 0, "flush_latency": 0.0,
+                         "largest_flush_latency": 0.0}
+        self.first_flush = None
+        self.last_flush = None
+        self.flusher = threading.Thread(target=self._flush_late)
+        self.flusher.daemon = True
+        self.flusher.start()
+
+    def submit(self, replicas, fortune):
+        """Queue a fortune for the replicas (a map from id to address).
+
+        Return a WriteTicket, wait() on it for the replicas to have
+        written the fortune.
+
+        """
+        ticket = WriteTicket(replicas)
+        with self.lock:
+            now = time.time()
+            for pid, address in replicas.items():
+                buffer = self.buffers.setdefault(
+                    pid, {"entries": [], "since": now, "busy": False})
+                buffer["address"] = address
+                if not buffer["entries"]:
+                    buffer["since"] = now
+                buffer["entries"].append((fortune, ticket))
+                if len(buffer["entries"]) >= self.max_batch:
+                    self._send(pid)
+            self.changed.notify()
+        return ticket
+
+    def forget(self, pid):
+        """Replica pid has left: fail the writes still queued for it."""
+        with self.lock:
+            buffer = self.buffers.pop(pid, None)
+        if buffer is not None:
+            error = orb.CommunicationError(
+                "Replica {} has left".format(pid))
+            for fortune, ticket in buffer["entries"]:
+                ticket.finished(pid, error)
+
+    def stats(self):
+        """Return the batch sizes, flush latencies and throughput."""
+        with self.lock:
+            stats = dict(self.counters)
+            elapsed = (self.last_flush - self.first_flush
+                       if self.first_flush is not None else 0.0)
+        batches = stats["batches"] or 1
+        stats["mean_batch"] = stats["fortunes"] / batches
+        stats["mean_flush_latency"] = stats.pop("flush_latency") / batches
+        stats["fortunes_per_second"] = (stats["fortunes"] / elapsed
+                                        if elapsed else 0.0)
+        return stats
+
+    def destroy(self):
+        with self.lock:
+            self.running = False
+            self.changed.notify()
+
+    # Private methods
+
+    def _send(self, pid):
+        """Send the next batch to replica pid, unless one is on its way.
+
+        Must be called with 'lock' held.
+
+        """
+        buffer = self.buffers[pid]
+        if buffer["busy"] or not buffer["entries"]:
+            return
+        batch = buffer["entries"][:self.max_batch]
+        del buffer["entries"][:self.max_batch]
+        buffer["busy"] = True
+        since, buffer["since"] = buffer["since"], time.time()
+        self.fan_out.pool.submit(self._flush, pid, buffer["address"], batch,
+                                 since)
+
+    def _flush(self, pid, address, batch, since):
+        start = time.time()
+        error = None
+        try:
+            stub = orb.Stub(address, self.fan_out.timeout,
+                            self.fan_out.timeout)
+            stub.write_local_batch([fortune for fortune, ticket in batch])
+        except BaseException as e:
+            # Errors raised by the replica itself come back as
+            # BaseException: they fail the batch like the others.
+            error = e
+        end = time.time()
+        with self.lock:
+            self.counters["batches"] += 1
+            self.counters["fortunes"] += len(batch)
+            self.counters["largest_batch"] = max(
+                self.counters["largest_batch"], len(batch))
+            self.counters["flush_latency"] += end - since
+            self.counters["largest_flush_latency"] = max(
+                self.counters["largest_flush_latency"], end - since)
+            if self.first_flush is None:
+                self.first_flush = start
+            self.last_flush = end
+            if error is not None:
+                self.counters["failed_batches"] += 1
+            for fortune, ticket in batch:
+                ticket.finished(pid, error)
+            buffer = self.buffers.get(pid)
+            if buffer is not None:
+                buffer["busy"] = False
+                if len(buffer["entries"]) >= self.max_batch:
+                    self._send(pid)
+            self.changed.notify()
+
+    def _flush_late(self):
+        """Send the batches whose oldest write has waited long enough."""
+        with self.lock:
+            while self.running:
+                now = time.time()
+                wake_up = None
+                for pid, buffer in self.buffers.items():
+                    if not buffer["entries"] or buffer["busy"]:
+                        continue
+                    due = buffer["since"] + self.max_delay
+                    if due <= now:
+                        self._send(pid)
+                    elif wake_up is None or due < wake_up:
+                        wake_up = due
+                self.changed.wait(None if wake_up is None else wake_up - now)
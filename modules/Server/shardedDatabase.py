@@ -0,0 +1,211 @@
+# -----------------------------------------------------------------------------
+# Distributed Systems (TDDD25)
+# -----------------------------------------------------------------------------
+# Author: Sergiu Rafiliu (sergiu.rafiliu@liu.se)
+# Modified: 24 July 2013
+#
+# Copyright 2012 Linkoping University
+# -----------------------------------------------------------------------------
+
+"""Implementation of a database spread over several files (shards).
+
+Each shard is a regular Database with its own file, its own in-memory
+list and its own write lock, so writers routed to different shards do
+not serialize on each other. Writes are routed to a shard by a stable
+hash of the fortune, reads pick a shard with a probability proportional
+to its size so that every fortune is still equally likely to be read.
+
+The shard files are read by a pool of threads, so that their I/O
+overlaps; the parsing itself still runs one shard at a time under the
+GIL. (A process pool would have to send every record back to this
+process, which costs more than parsing it.)
+
+A database that still consists of a single file is split into shards
+the first time it is opened. When the number of shards changes, or a
+shard file is missing, the records of the shard files that are there
+are merged into a re-split file first, which is then split into the new
+shards: the original file, older than the shards, is never read again
+and no shard file is left behind. An interrupted re-split is finished
+the next time the database is opened.
+
+"""
+
+import os
+import re
+import glob
+import zlib
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+from .database import Database
+
+
+def shard_file_names(db_file, shards):
+    """Return the names of the shard files of 'db_file'."""
+
+    root, ext = os.path.splitext(db_file)
+    return ["{}_shard{}{}".format(root, i, ext) for i in range(shards)]
+
+
+class ShardedDatabase(object):
+
+    """Database whose records are spread over a number of shard files."""
+
+    def __init__(self, db_file, shards=4, workers=None):
+        self.db_file = db_file
+        self.rand = random.Random()
+        self.rand.seed()
+        self.shard_files = shard_file_names(db_file, shards)
+        root, ext = os.path.splitext(db_file)
+        self.resplit_file = "{}_resplit{}".format(root, ext)
+        existing = self._existing_shard_files()
+        if os.path.exists(self.resplit_file):
+            # An earlier re-split was interrupted, finish it.
+            self._split(self.resplit_file)
+        elif existing and existing != self.shard_files:
+            self._merge(existing)
+            self._split(self.resplit_file)
+        elif not existing:
+            self._split(self.db_file)
+        # Reading a shard is independent of the others, read them all at
+        # the same time.
+        with ThreadPoolExecutor(max_workers=workers or shards) as pool:
+            self.shards = list(pool.map(Database, self.shard_files))
+
+    def version(self):
+        """Return the versions of all the shards."""
+
+        return [shard.version() for shard in self.shards]
+
+    def read(self):
+        """Read a random location in the database."""
+
+        snapshots = [shard.snapshot for shard in self.shards]
+        return self._read_snapshots(snapshots,
+                                    [s.version for s in snapshots])
+
+    def read_at(self, versions):
+        """Read a random location in the database as of 'versions'.
+
+        'versions' is a list of shard versions as returned by version().
+
+        """
+
+        if len(versions) != len(self.shards):
+            raise ValueError("Expected {} shard versions, got {}".format(
+                len(self.shards), len(versions)))
+        # One snapshot per shard, for the check and for the read: a
+        # retain() in between could shrink the records list.
+        snapshots = [shard.snapshot for shard in self.shards]
+        for snapshot, version in zip(snapshots, versions):
+            if version > snapshot.version:
+                raise ValueError("Version {} is not available".format(
+                    versions))
+        return self._read_snapshots(snapshots, versions)
+
+    def write(self, fortune):
+        """Write a new fortune to the shard it hashes to."""
+
+        self.shards[self.shard_of(fortune)].write(fortune)
+
+    def write_batch(self, fortunes):
+        """Write a list of new fortunes, one append per shard."""
+
+        batches = {}
+        for fortune in fortunes:
+            batches.setdefault(self.shard_of(fortune), []).append(fortune)
+        for i, batch in batches.items():
+            self.shards[i].write_batch(batch)
+
+    def retain(self, keep):
+        """Rewrite the shards with only the records keep(record) holds
+        for."""
+
+        for shard in self.shards:
+            shard.retain(keep)
+
+    def refresh(self):
+        """Merge the records appended to the shard files by somebody else."""
+
+        for shard in self.shards:
+            shard.refresh()
+
+    def watch(self, interval=1.0):
+        """Poll the shard files for changes every 'interval' seconds."""
+
+        for shard in self.shards:
+            shard.watch(interval)
+
+    def shard_of(self, fortune):
+        """Return the index of the shard 'fortune' is written to."""
+
+        # The built-in hash() of strings changes from one run to another,
+        # use a stable one instead.
+        return zlib.crc32(fortune.encode("utf-8")) % len(self.shard_files)
+
+    # Private methods
+
+    def _read_snapshots(self, snapshots, versions):
+        # Pick a record uniformly among all of them: the shard is chosen
+        # with a probability proportional to its size.
+        index = self.rand.randrange(sum(versions))
+        for snapshot, version in zip(snapshots, versions):
+            if index < version:
+                return snapshot.records[index]
+            index -= version
+
+    def _existing_shard_files(self):
+        """Return the shard files of 'db_file' on disk, whatever their
+        number, in shard order."""
+
+        root, ext = os.path.splitext(self.db_file)
+        pattern = re.compile(re.escape(root) + r"_shard(\d+)" +
+                             re.escape(ext) + "$")
+        found = []
+        for name in glob.glob(glob.escape(root) + "_shard*" +
+                              glob.escape(ext)):
+            match = pattern.match(name)
+            if match:
+                found.append((int(match.group(1)), name))
+        return [name for i, name in sorted(found)]
+
+    def _read_records(self, file_name):
+        with open(file_name, "r", encoding="utf-8") as f:
+            records = f.read().split("\n%\n")
+        # Delete the last entry as it won't be a fortune
+        records.pop()
+        return records
+
+    def _write_records(self, file_name, records):
+        # Write to a temporary file first so that an interrupted
+        # split does not leave a half written file behind.
+        tmp_file = file_name + ".tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            for fortune in records:
+                f.write(fortune + "\n" + "%" + "\n")
+        os.replace(tmp_file, file_name)
+
+    def _merge(self, shard_files):
+        """Gather the records of 'shard_files' into the re-split file."""
+
+        records = []
+        for shard_file in shard_files:
+            records.extend(self._read_records(shard_file))
+        # Once this file is in place it is the only source of truth.
+        self._write_records(self.resplit_file, records)
+
+    def _split(self, source):
+        """Split the records of 'source' into the shard files."""
+
+        buckets = [[] for _ in self.shard_files]
+        if os.path.exists(source):
+            for fortune in self._read_records(source):
+                buckets[self.shard_of(fortune)].append(fortune)
+        for shard_file, bucket in zip(self.shard_files, buckets):
+            self._write_records(shard_file, bucket)
+        if source == self.resplit_file:
+            # Shards of an older layout, all merged in 'source'.
+            for shard_file in self._existing_shard_files():
+                if shard_file not in self.shard_files:
+                    os.remove(shard_file)
+            os.remove(source)
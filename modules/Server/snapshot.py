@@ -0,0 +1,270 @@
+# -----------------------------------------------------------------------------
+# Distributed Systems (TDDD25)
+# -----------------------------------------------------------------------------
+# Author: Sergiu Rafiliu (sergiu.rafiliu@liu.se)
+# Modified: 31 July 2013
+#
+# Copyright 2012 Linkoping University
+# -----------------------------------------------------------------------------
+
+"""Bootstrap of a joining replica from a snapshot of a live one.
+
+The database files are only ever appended to, so a consistent snapshot
+is just a prefix of each file: Database.checkpoint() tells how many
+bytes hold exactly the records of the current version. The donor hands
+out a ticket for each file and streams that prefix over a socket of its
+own with os.sendfile(), straight from the page cache to the socket,
+while the writes go on.
+
+The writes made after the snapshot are the records the donor has got
+since that version (its in-memory list is append-only too), so tail()
+returns them for replay. The joiner replays them until it is almost up
+to date, joins the group and replays the last ones. Fortunes that reach
+it both from the replay and from the other replicas are written once.
+
+"""
+
+import os
+import time
+import socket
+import threading
+import collections
+
+from Common import orb
+
+CHUNK = 1 << 20
+
+
+def _sources(db):
+    # A ShardedDatabase is a number of plain databases.
+    return getattr(db, "shards", [db])
+
+
+class SnapshotDonor(object):
+
+    """Serve snapshots of a database to the joining replicas.
+
+    Public methods:
+        --  __init__(db, host="")
+        --  offer()
+        --  tail(versions)
+        --  stats()
+
+    """
+
+    def __init__(self, db, host=""):
+        self.db = db
+        self.lock = threading.Lock()
+        self.tickets = {}
+        self.next_ticket = 0
+        self.counters = {"snapshots": 0, "bytes_sent": 0, "send_time": 0.0,
+                         "tails": 0, "records_replayed": 0}
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind((host, 0))
+        self.server.listen(5)
+        self.port = self.server.getsockname()[1]
+        thread = threading.Thread(target=self._serve)
+        thread.daemon = True
+        thread.start()
+
+    def offer(self):
+        """Take a snapshot, return where and how to download it.
+
+        For each database file: a ticket to send to 'port', the number
+        of bytes to expect and the version they hold.
+
+        """
+        files = []
+        for db in _sources(self.db):
+            size, version = db.checkpoint()
+            with self.lock:
+                self.next_ticket += 1
+                ticket = self.next_ticket
+                self.tickets[ticket] = (db.db_file, size)
+            files.append([ticket, size, version])
+        with self.lock:
+            self.counters["snapshots"] += 1
+        return {"port": self.port, "files": files}
+
+    def tail(self, versions):
+        """Return the records written to each file after 'versions'."""
+        tail = []
+        for db, version in zip(_sources(self.db), versions):
+            snapshot = db.snapshot
+            tail.append(snapshot.records[version:snapshot.version])
+        with self.lock:
+            self.counters["tails"] += 1
+            self.counters["records_replayed"] += sum(len(t) for t in tail)
+        return tail
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
+
+    # Private methods
+
+    def _serve(self):
+        while True:
+            try:
+                conn, addr = self.server.accept()
+            except socket.error:
+                continue
+            thread = threading.Thread(target=self._send, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def _send(self, conn):
+        """Send the file prefix of the ticket the joiner asks for."""
+        start = time.time()
+        with conn:
+            line = conn.makefile("r").readline()
+            with self.lock:
+                db_file, size = self.tickets.pop(int(line))
+            offset = 0
+            with open(db_file, "rb") as f:
+                while offset < size:
+                    sent = os.sendfile(conn.fileno(), f.fileno(), offset,
+                                       size - offset)
+                    if sent == 0:
+                        break
+                    offset += sent
+        with self.lock:
+            self.counters["bytes_sent"] += offset
+            self.counters["send_time"] += time.time() - start
+
+
+def fetch(donor_address, db_files, timeout=5.0):
+    """Download a snapshot of the donor's database into 'db_files'.
+
+    Return the versions of the snapshot, to replay the rest from.
+
+    """
+
+    donor = orb.Stub(donor_address, timeout)
+    offer = donor.snapshot_offer()
+    if len(offer["files"]) != len(db_files):
+        raise ValueError("The donor has {} database files, we have {}".format(
+            len(offer["files"]), len(db_files)))
+    address = (donor_address[0], offer["port"])
+    for (ticket, size, version), db_file in zip(offer["files"], db_files):
+        _receive(address, ticket, size, db_file, timeout)
+    return [version for ticket, size, version in offer["files"]]
+
+
+def _receive(address, ticket, size, db_file, timeout):
+    # Write to a temporary file first so that an interrupted download
+    # does not leave a half written database behind.
+    tmp_file = db_file + ".tmp"
+    view = memoryview(bytearray(CHUNK))
+    received = 0
+    with socket.create_connection(address, timeout) as conn, \
+            open(tmp_file, "wb") as f:
+        conn.sendall("{}\n".format(ticket).encode("utf-8"))
+        while received < size:
+            n = conn.recv_into(view, min(CHUNK, size - received))
+            if not n:
+                raise orb.CommunicationError(
+                    "The snapshot of {} stopped after {} of {} bytes".format(
+                        db_file, received, size))
+            f.write(view[:n])
+            received += n
+    os.replace(tmp_file, db_file)
+
+
+class CatchUp(object):
+
+    """Replay of the writes the donor has got after the snapshot.
+
+    Public methods:
+        --  __init__(db, donor_address, versions, timeout=5.0, grace=10.0)
+        --  replay(rounds=10, close_enough=100)
+        --  finish()
+        --  received(fortunes)
+        --  stats()
+
+    'ready' is set once finish() has replayed the last writes.
+
+    """
+
+    def __init__(self, db, donor_address, versions, timeout=5.0,
+                 grace=10.0):
+        self.db = db
+        self.donor = orb.Stub(donor_address, timeout)
+        self.versions = list(versions)
+        self.grace = grace
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.joined = None
+        # Fortunes received from the other replicas and from the replay
+        # since we joined, the other one may still bring them too.
+        self.direct = collections.Counter()
+        self.replayed = collections.Counter()
+        self.counters = {"rounds": 0, "replayed": 0, "duplicates": 0}
+
+    def replay(self, rounds=10, close_enough=100):
+        """Replay the tail until it has less than 'close_enough' records."""
+        for i in range(rounds):
+            if self._replay() < close_enough:
+                break
+
+    def finish(self):
+        """Replay the last writes, once we receive the new ones."""
+        with self.lock:
+            self.joined = time.time()
+        self._replay()
+        self.ready.set()
+
+    def received(self, fortunes):
+        """Filter the fortunes written to us by the other replicas.
+
+        Return the ones that have not been replayed already.
+
+        """
+        with self.lock:
+            if self.joined is None:
+                return fortunes
+            if time.time() - self.joined > self.grace and self.ready.is_set():
+                self.direct.clear()
+                self.replayed.clear()
+                return fortunes
+            new = []
+            for fortune in fortunes:
+                if self.replayed[fortune]:
+                    self.replayed[fortune] -= 1
+                    self.counters["duplicates"] += 1
+                else:
+                    self.direct[fortune] += 1
+                    new.append(fortune)
+            return new
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+        stats["ready"] = self.ready.is_set()
+        return stats
+
+    # Private methods
+
+    def _replay(self):
+        tail = self.donor.snapshot_tail(self.versions)
+        count = 0
+        for i, (db, records) in enumerate(zip(_sources(self.db), tail)):
+            self.versions[i] += len(records)
+            with self.lock:
+                if self.joined is not None:
+                    new = []
+                    for fortune in records:
+                        if self.direct[fortune]:
+                            self.direct[fortune] -= 1
+                            self.counters["duplicates"] += 1
+                        else:
+                            self.replayed[fortune] += 1
+                            new.append(fortune)
+                    records = new
+                if records:
+                    db.write_batch(records)
+            count += len(records)
+        with self.lock:
+            self.counters["rounds"] += 1
+            self.counters["replayed"] += count
+        return count
@@ -0,0 +1,76 @@
+# -----------------------------------------------------------------------------
+# Distributed Systems (TDDD25)
+# -----------------------------------------------------------------------------
+
+"""Tests of the lease mode of DistributedReadWriteLock."""
+
+import os
+import sys
+import time
+import threading
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "modules"))
+from Server.Lock.distributedReadWriteLock import DistributedReadWriteLock
+
+
+class FakeDistributedLock(object):
+
+    """A distributed lock nobody else ever asks for."""
+
+    def __init__(self):
+        self.acquired = 0
+        self.released = 0
+
+    def acquire(self, timeout=None):
+        self.acquired += 1
+        return True
+
+    def release(self):
+        self.released += 1
+
+    def has_pending_requests(self):
+        return False
+
+
+class LeaseTest(unittest.TestCase):
+
+    def test_write_combined_reuses_lease(self):
+        token = FakeDistributedLock()
+        lock = DistributedReadWriteLock(token, lease_writes=8, lease_time=5)
+        blocked = threading.Event()
+        go = threading.Event()
+
+        def first():
+            blocked.set()
+            go.wait()
+
+        leader = threading.Thread(target=lock.write_combined, args=(first,))
+        leader.start()
+        blocked.wait()
+        # Queue more operations while the leader holds the lock.
+        results = []
+        others = [threading.Thread(
+                      target=lambda i=i: results.append(
+                          lock.write_combined(lambda: i)))
+                  for i in range(3)]
+        for thread in others:
+            thread.start()
+        while True:
+            with lock.combine_lock:
+                if len(lock.combine_queue) == len(others):
+                    break
+            time.sleep(0.001)
+        go.set()
+        for thread in [leader] + others:
+            thread.join(5)
+        self.assertEqual(sorted(results), [0, 1, 2])
+        counters = lock.stats()["counters"]
+        self.assertGreater(counters.get("lease_reused", 0), 0)
+        # One token round for both batches, and the token is given back.
+        self.assertEqual(token.acquired, 1)
+        self.assertEqual(token.released, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()